@@ -20,6 +20,9 @@ class SelectionLogic(BaseModel):
 
 class PairWiseTopKConversation(SelectionLogic):
     top_k: int = 5
+    # "greedy" pairs one agent at a time, "parallel" matches everyone in vectorised rounds
+    matching: str = "greedy"
+    resolve: str = "mutual"
 
     def group_agents(self, agents: List[Agent]) -> List[List[Agent]]:
         # If no agents or only one agent, no valid pairs
@@ -39,6 +42,13 @@ class PairWiseTopKConversation(SelectionLogic):
         max_val = 1e6
         all_dists.fill_diagonal_(max_val)
 
+        if self.matching == "parallel":
+            from assign_pairs import match_in_rounds
+
+            candidates = torch.topk(all_dists, min(self.top_k, len(agents) - 1), dim=1, largest=False).indices
+            agent1_ids, agent2_ids = match_in_rounds(candidates, self.top_k, resolve=self.resolve)
+            return [[agents[a1], agents[a2]] for a1, a2 in zip(agent1_ids.tolist(), agent2_ids.tolist())]
+
         all_pairs = []
 
         # 4) Randomize the order of agents to avoid bias
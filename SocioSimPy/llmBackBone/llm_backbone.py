@@ -1,5 +1,10 @@
-from typing import List, Protocol
+from typing import List, Optional, Protocol
 
 class BackBoneLLM(Protocol):
-    def generate(self):
+    def generate(self, prompts: List[str], sampling_params, stage: Optional[str] = None, **kwargs) -> list:
+        """
+        One output per prompt, in prompt order, shaped like vLLM's `RequestOutput`:
+        `output.outputs[0].text` is the generated text. `stage` names the simulation stage
+        ("conversation", "reply", "questionnaire", "judge", ...) for backends that care.
+        """
         pass
@@ -0,0 +1,61 @@
+import json
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+from population import Population
+
+
+class ActivityScheduler:
+    """
+    Picks the agents that converse in each iteration.
+
+    Every agent has an activity rate, the expected number of conversations per iteration
+    (at most 1). `bernoulli` flips an independent coin per agent and iteration; `poisson`
+    draws exponential waiting times between an agent's conversations, so activity is spread
+    evenly over time instead of clumping. Inactive agents keep their location and answers.
+    """
+
+    def __init__(self, rates: np.ndarray, mode="bernoulli", seed: Optional[int] = None):
+        if mode not in ("bernoulli", "poisson"):
+            raise ValueError(f"Unknown activity mode: {mode}")
+        self.rates = np.clip(np.asarray(rates, dtype=np.float64), 0.0, 1.0)
+        self.mode = mode
+        self.rng = np.random.default_rng(seed)
+        if mode == "poisson":
+            # Time of every agent's next conversation, in iterations
+            self.next_time = self._waiting_times(np.arange(len(self.rates)))
+
+    @classmethod
+    def from_demographics(cls, population: Population, rate: float, multipliers: Dict[str, Dict[str, float]],
+                          mode="bernoulli", seed: Optional[int] = None) -> "ActivityScheduler":
+        """
+        Per-agent rates: `rate` times the multiplier of each of the agent's attribute values,
+        e.g. {"urbanicity": {"Urban": 1.5, "Rural": 0.5}}. Values not listed count as 1.
+        """
+        rates = np.full(len(population), rate, dtype=np.float64)
+        for name, by_value in multipliers.items():
+            # JSON keys are strings, while some attribute values (age) are ints
+            table = np.array([by_value.get(str(value), 1.0) for value in population.vocab[name]])
+            rates *= table[population.codes[name]]
+        return cls(rates, mode=mode, seed=seed)
+
+    @classmethod
+    def from_json(cls, path: str, population: Population, rate: float, mode="bernoulli",
+                  seed: Optional[int] = None) -> "ActivityScheduler":
+        with open(path) as f:
+            return cls.from_demographics(population, rate, json.load(f), mode=mode, seed=seed)
+
+    def _waiting_times(self, agent_ids: np.ndarray) -> np.ndarray:
+        with np.errstate(divide="ignore"):
+            return self.rng.exponential(1.0, len(agent_ids)) / self.rates[agent_ids]
+
+    def active(self, iter_idx: int) -> torch.Tensor:
+        """Sorted LongTensor of the ids of the agents that converse at iteration `iter_idx`."""
+        if self.mode == "bernoulli":
+            return torch.from_numpy(np.flatnonzero(self.rng.random(len(self.rates)) < self.rates))
+        active = np.flatnonzero(self.next_time < iter_idx + 1)
+        # An agent converses at most once per iteration, even if several events fell into it
+        self.next_time[active] = np.maximum(self.next_time[active], iter_idx) + self._waiting_times(active)
+        return torch.from_numpy(active)
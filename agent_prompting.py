@@ -14,4 +14,5 @@ gen_sys = (
 #     return r_sys if is_gop else d_sys
 
 def get_sys_prompt(agent_property: StaticAgentProperty2):
-    return agent_property.get_sys_prompt() + gen_sys
+    # Instructions shared by all agents first, the persona after, so the shared part is one cached prefix
+    return gen_sys + "\n" + agent_property.get_sys_prompt()
@@ -1,6 +1,8 @@
 import torch
 import random
 
+from knn_backends import KNN_BACKENDS
+
 
 def batched_cdist(locs, batch_size=10000):
     num_agents = locs.shape[0]
@@ -13,7 +15,17 @@ def batched_cdist(locs, batch_size=10000):
 
 # Choose among k nearest neighbors at random
 # Returns pairs of agents
-def assign_pairs1(locs, top_k=3):
+def assign_pairs1(locs, top_k=3, backend="dense", matching="greedy", resolve="mutual", index=None):
+    # Neighbors from a persistent `spatial_index.SpatialIndex` kept up to date across iterations
+    if index is not None:
+        return assign_pairs_knn(locs, top_k, backend="grid", matching=matching, resolve=resolve, index=index)
+    # Sub-quadratic neighbor search instead of the dense N*N distance matrix
+    if backend != "dense":
+        return assign_pairs_knn(locs, top_k, backend=backend, matching=matching, resolve=resolve)
+    # Round-based matching on the exact neighbors
+    if matching == "parallel":
+        return assign_pairs_knn(locs, top_k, backend="brute", matching=matching, resolve=resolve)
+
     # Get pairwise distances
     all_dists = batched_cdist(locs, 10000)
     # Set diagonal to large value so that we don't communicate with ourselves
@@ -51,8 +63,142 @@ def assign_pairs1(locs, top_k=3):
 
     return all_pairs
 
-import torch
-import random
+
+def greedy_match(candidates, top_k=3):
+    """
+    Visits the agents in random order; each free agent picks at random among the first top_k
+    free agents of its candidate row. `candidates` is an (N, C) LongTensor of neighbor ids,
+    nearest first, padded with -1.
+
+    Returns the (agent1, agent2) LongTensors of the formed pairs.
+    """
+    rows = candidates.tolist()
+    taken = bytearray(len(rows))
+    agent1_lst, agent2_lst = [], []
+    for agent1 in torch.randperm(len(rows)).tolist():
+        if taken[agent1]:
+            continue
+
+        # Nearest candidates that don't have a partner yet
+        free = [agent2 for agent2 in rows[agent1] if agent2 >= 0 and not taken[agent2]][:top_k]
+        if not free:
+            continue
+
+        agent2 = random.choice(free)
+        taken[agent1] = taken[agent2] = 1
+        agent1_lst.append(agent1)
+        agent2_lst.append(agent2)
+    return torch.tensor(agent1_lst, dtype=torch.long), torch.tensor(agent2_lst, dtype=torch.long)
+
+
+def match_in_rounds(candidates, top_k=3, resolve="mutual", max_idle_rounds=10):
+    """
+    Vectorised alternative to `greedy_match` that works in rounds on whole tensors.
+
+    Every round, each free agent proposes to a random free agent among the first top_k free
+    agents of its candidate row. Mutual proposals always form a pair. With
+    resolve="lowest_id", every other proposed-to agent additionally accepts its lowest-id
+    proposer, unless that proposer already accepted someone itself this round.
+    Rounds repeat until no free agent has a free candidate left (or nothing pairs for
+    `max_idle_rounds` rounds in a row).
+
+    Returns the (agent1, agent2) LongTensors of the formed pairs.
+    """
+    num_agents = candidates.shape[0]
+    partner = torch.full((num_agents,), -1, dtype=torch.long)
+    agent_ids = torch.arange(num_agents)
+    # Rows of the agents that may still propose; shrinks as agents get paired
+    active = agent_ids
+
+    idle_rounds = 0
+    while idle_rounds < max_idle_rounds:
+        rows = candidates[active]
+        available = (rows >= 0) & (partner[rows.clamp(min=0)] < 0)
+        # Only the top_k nearest free candidates are eligible
+        available &= available.cumsum(dim=1) <= top_k
+        has_options = available.any(dim=1)
+        active, rows, available = active[has_options], rows[has_options], available[has_options]
+        if active.numel() == 0:
+            break
+
+        # Uniform pick among the eligible candidates of every row
+        choice = torch.rand(rows.shape).masked_fill_(~available, -1).argmax(dim=1)
+        proposed_to = rows.gather(1, choice[:, None]).squeeze(1)
+        target = torch.full((num_agents,), -1, dtype=torch.long)
+        target[active] = proposed_to
+
+        mutual = target[proposed_to] == active
+        agent1 = active[mutual & (active < proposed_to)]
+        agent2 = target[agent1]
+        partner[agent1] = agent2
+        partner[agent2] = agent1
+
+        if resolve == "lowest_id":
+            still_free = (partner[active] < 0) & (partner[proposed_to] < 0)
+            proposer_ids, proposed_to = active[still_free], proposed_to[still_free]
+            lowest = torch.full((num_agents,), num_agents, dtype=torch.long)
+            lowest.scatter_reduce_(0, proposed_to, proposer_ids, reduce="amin")
+            accepted = lowest[proposed_to] == proposer_ids
+            accepted_someone = torch.zeros(num_agents, dtype=torch.bool)
+            accepted_someone[proposed_to[accepted]] = True
+            accepted &= ~accepted_someone[proposer_ids]
+            partner[proposer_ids[accepted]] = proposed_to[accepted]
+            partner[proposed_to[accepted]] = proposer_ids[accepted]
+        elif resolve != "mutual":
+            raise ValueError(f"Unknown conflict resolution: {resolve}")
+
+        newly_paired = partner[active] >= 0
+        idle_rounds = 0 if newly_paired.any() else idle_rounds + 1
+        active = active[~newly_paired]
+
+    agent1 = agent_ids[(partner >= 0) & (agent_ids < partner)]
+    return agent1, partner[agent1]
+
+
+def assign_pairs_knn(locs, top_k=3, backend="kdtree", num_candidates=None, matching="greedy", resolve="mutual",
+                     index=None):
+    """
+    Same random pick among the top_k nearest free neighbors as `assign_pairs1`, but the
+    neighbors come from a k-NN backend (see `knn_backends.KNN_BACKENDS`) so memory is O(N*k).
+
+    Each agent only looks at its `num_candidates` nearest neighbors. Agents whose candidates
+    were all taken are re-queried among the agents still free, until everyone who can be
+    paired is. `matching` is "greedy" (`greedy_match`) or "parallel" (`match_in_rounds`).
+
+    With an `index` (`spatial_index.SpatialIndex`), the first pass reuses its cached neighbors.
+    """
+    knn = KNN_BACKENDS[backend]
+    num_candidates = num_candidates or 4 * top_k
+
+    all_pairs = []
+    remaining = torch.arange(locs.shape[0])
+
+    while remaining.numel() >= 2:
+        if index is not None and remaining.numel() == locs.shape[0]:
+            candidates = index.knn()
+        else:
+            candidates = knn(locs[remaining], min(num_candidates, remaining.numel() - 1))
+        if matching == "parallel":
+            agent1, agent2 = match_in_rounds(candidates, top_k, resolve=resolve)
+        else:
+            agent1, agent2 = greedy_match(candidates, top_k)
+        if agent1.numel() == 0:
+            break
+
+        all_pairs.extend(zip(remaining[agent1].tolist(), remaining[agent2].tolist()))
+        paired = torch.zeros(remaining.numel(), dtype=torch.bool)
+        paired[agent1] = True
+        paired[agent2] = True
+        remaining = remaining[~paired]
+
+    return all_pairs
+
+
+def unpaired_fraction(all_pairs, num_agents):
+    """Fraction of the agents that didn't get a conversation partner."""
+    return 1 - 2 * len(all_pairs) / max(num_agents, 1)
+
+
 import numpy as np
 import faiss
 
@@ -109,6 +255,12 @@ def assign_pairs_faiss(locs, top_k=3):
     return all_pairs
 
 
+def assign_pairs_faiss_batched(locs, top_k=3):
+    """
+    `assign_pairs_faiss` with a single `index.search` call for every agent instead of one per agent.
+    """
+    return assign_pairs_knn(locs, top_k, backend="faiss")
+
 
 if __name__ == '__main__':
     # Example usage with 250k agents at the same location (for demonstration)
@@ -1,6 +1,16 @@
 from qeustionnaire_questions import questionnaire_questions
 from typing import List
 
+import numpy as np
+
+# Questionnaire tag -> (latent dimension, answer that scores a point), same rules as `calculate_score`
+LATENT_TAGS = {
+    "[Extroverted]": (0, 1), "[Introverted]": (0, 0),
+    "[Intuition]": (1, 1), "[Sensing]": (1, 0),
+    "[Feeling]": (2, 1), "[Thinking]": (2, 0),
+    "[Judging]": (3, 1), "[Perceiving]": (3, 0),
+}
+
 
 def parse_binary_strings(binary_strings: List[str], list_len) -> List[List[int]]:
     parsed_lists = []
@@ -59,6 +69,39 @@ def calculate_score(questions, answer_vec: List[int]):
     return scores
 
 
+def latent_scoring(questions: List[str]):
+    """(num_questions, 4) one-hot latent dimension of every tagged item, and the answer that scores it (-1 if untagged)."""
+    scoring = np.zeros((len(questions), 4), dtype=np.int64)
+    target = np.full(len(questions), -1, dtype=np.int64)
+    for idx, text in enumerate(questions):
+        for tag, (dim, answer) in LATENT_TAGS.items():
+            if tag in text:
+                scoring[idx, dim] = 1
+                target[idx] = answer
+                break
+    return scoring, target
+
+
+def latent_scores_from_matrix(questions: List[str], answers: np.ndarray) -> np.ndarray:
+    """
+    Vectorised `calculate_score` for an (N, num_questions) matrix of 0/1 answers.
+    Returns the (N, 4) latent scores.
+    """
+    scoring, target = latent_scoring(questions)
+    return (np.asarray(answers) == target).astype(np.int64) @ scoring
+
+
+def expected_latent_scores(questions: List[str], probabilities: np.ndarray) -> np.ndarray:
+    """
+    `latent_scores_from_matrix` for an (N, num_questions) matrix of P(answer = 1): the
+    expected (N, 4) latent scores.
+    """
+    scoring, target = latent_scoring(questions)
+    probabilities = np.asarray(probabilities, dtype=np.float64)
+    # P(answer == target); untagged items have no scoring row
+    return np.where(target == 1, probabilities, 1 - probabilities) @ scoring.astype(np.float64)
+
+
 def questionnaire_res_to_latent_score(questions: List[str], responses: List[List[int]]) -> List[List[int]]:
     agents_latent_vec_scores = [calculate_score(questions, response_int) for response_int in responses]
     return agents_latent_vec_scores
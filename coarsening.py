@@ -0,0 +1,83 @@
+from typing import List, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from population import ATTRIBUTE_NAMES, Population
+
+
+class PairGroups:
+    """
+    Pairs grouped by (persona of agent 1, persona of agent 2, question, spatial cell of agent 1).
+
+    Pairs in a group would get near-identical prompts, so only the group's representative
+    (its first pair) goes through the LLM and every member gets the representative's outcome.
+    """
+
+    def __init__(self, group_of: np.ndarray, representatives: np.ndarray):
+        self.group_of = group_of  # group id of every pair
+        self.representatives = representatives  # pair index of every group's representative
+
+    def __len__(self):
+        return len(self.representatives)
+
+    def select(self, values: Sequence) -> list:
+        """The entries of a per-pair list that belong to the representatives."""
+        return [values[i] for i in self.representatives.tolist()]
+
+    def expand(self, values: Sequence) -> list:
+        """Fans a per-group list out to one entry per pair."""
+        return [values[g] for g in self.group_of.tolist()]
+
+    def expand_tensor(self, values: torch.Tensor) -> torch.Tensor:
+        return values[torch.from_numpy(self.group_of)]
+
+
+def group_pairs(all_pairs: List[Tuple[int, int]], all_questions: List[str], population: Population,
+                agents_loc: torch.Tensor, cells_per_side=32, max_group_size=16,
+                attributes: Tuple[str, ...] = ATTRIBUTE_NAMES) -> PairGroups:
+    """
+    Groups pairs sharing both personas and the question, with agent 1 in the same cell of a
+    `cells_per_side` x `cells_per_side` grid. Groups are split into chunks of at most
+    `max_group_size` pairs so one LLM sample isn't reused too widely.
+
+    With independently sampled attributes there are 72k personas, so exact matches are rare
+    below millions of agents. Passing a subset of `attributes` treats agents that only differ
+    in the others as equivalent and the representative's persona stands in for theirs.
+    """
+    pairs = np.asarray(all_pairs, dtype=np.int64).reshape(-1, 2)
+    if len(pairs) == 0:
+        return PairGroups(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+
+    persona = population.persona_keys(attributes)
+    question_ids = {}
+    question = np.array([question_ids.setdefault(q, len(question_ids)) for q in all_questions], dtype=np.int64)
+    xy = np.clip((agents_loc[torch.from_numpy(pairs[:, 0])].cpu().numpy() * cells_per_side).astype(np.int64),
+                 0, cells_per_side - 1)
+    cell = xy[:, 0] * cells_per_side + xy[:, 1]
+
+    # Stable sort, so the first pair of each run is the lowest pair index of the group
+    order = np.lexsort((cell, question, persona[pairs[:, 1]], persona[pairs[:, 0]]))
+    keys = np.stack([persona[pairs[:, 0]], persona[pairs[:, 1]], question, cell], axis=1)[order]
+    new_key = np.concatenate([[True], (keys[1:] != keys[:-1]).any(axis=1)])
+    run_start = np.flatnonzero(new_key)
+    rank = np.arange(len(order)) - np.repeat(run_start, np.diff(np.append(run_start, len(order))))
+    # Pairs beyond `max_group_size` in a run start a new group
+    starts = new_key | (rank % max_group_size == 0)
+
+    group_of = np.empty(len(pairs), dtype=np.int64)
+    group_of[order] = np.cumsum(starts) - 1
+    return PairGroups(group_of, order[starts])
+
+
+def expand_questionnaire(groups: PairGroups, all_pairs, rep_pairs, rep_answers: List, num_agents: int) -> List:
+    """
+    Fans the representatives' questionnaire answers (indexed by agent id) out to the members:
+    every agent gets the answers of the representative agent in the same position of its
+    group's pair. Agents outside `all_pairs` get "", like in `generate_questionnaire_answer`.
+    """
+    answers = ["" for _ in range(num_agents)]
+    pair_answers = groups.expand([(rep_answers[a], rep_answers[b]) for a, b in rep_pairs])
+    for (agent1, agent2), (answers1, answers2) in zip(all_pairs, pair_answers):
+        answers[agent1], answers[agent2] = answers1, answers2
+    return answers
@@ -0,0 +1,96 @@
+import math
+from collections import deque
+from typing import Optional
+
+import torch
+
+
+class ConvergenceMonitor:
+    """
+    Online convergence test, updated once per iteration from cheap running statistics:
+
+    - the mean agreement score,
+    - the mean displacement of the agents,
+    - the neighbor drift: 1 - overlap of the k nearest neighbors of a fixed random sample of
+      agents between two iterations,
+    - on a social graph, where agents don't move, the share of ties rewired.
+
+    The run counts as converged once, over the last `window` iterations, the agreement stays
+    within `agreement_tol` and the displacement, drift and rewired share stay below their
+    tolerances. Iterations without pairs have no agreement score and leave it out.
+    """
+
+    def __init__(self, window=10, agreement_tol=0.01, displacement_tol=1e-3, drift_tol=0.05, rewire_tol=0.01,
+                 num_probes=256, k=5, seed: Optional[int] = None):
+        self.window = window
+        self.agreement_tol = agreement_tol
+        self.displacement_tol = displacement_tol
+        self.drift_tol = drift_tol
+        self.rewire_tol = rewire_tol
+        self.num_probes = num_probes
+        self.k = k
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        else:
+            self.generator.seed()
+        self.probes = None
+        self.prev_neighbors = None
+        self.agreement = deque(maxlen=window)
+        self.displacement = deque(maxlen=window)
+        self.drift = deque(maxlen=window)
+        self.rewired = deque(maxlen=window)
+
+    def _probe_neighbors(self, agents_loc: torch.Tensor) -> torch.Tensor:
+        if self.probes is None:
+            num_probes = min(self.num_probes, len(agents_loc))
+            self.probes = torch.randperm(len(agents_loc), generator=self.generator)[:num_probes]
+        k = min(self.k, len(agents_loc) - 1)
+        dists = torch.cdist(agents_loc[self.probes], agents_loc)
+        dists[torch.arange(len(self.probes)), self.probes] = float("inf")
+        return torch.topk(dists, k, dim=1, largest=False).indices
+
+    def update(self, agents_loc: torch.Tensor, prev_loc: torch.Tensor, agreement: float,
+               rewired: Optional[float] = None) -> Optional[str]:
+        """
+        Adds one iteration's statistics, with `rewired` the share of social graph ties rewired.
+        Returns why the run converged, or None if it hasn't.
+        """
+        if not math.isnan(agreement):
+            self.agreement.append(agreement)
+        if rewired is not None:
+            self.rewired.append(rewired)
+        self.displacement.append((agents_loc - prev_loc).norm(dim=1).mean().item())
+
+        neighbors = self._probe_neighbors(agents_loc)
+        if self.prev_neighbors is not None and neighbors.shape[1] > 0:
+            kept = (neighbors[:, :, None] == self.prev_neighbors[:, None, :]).any(dim=2)
+            self.drift.append(1 - kept.float().mean().item())
+        self.prev_neighbors = neighbors
+
+        if len(self.drift) < self.window or len(self.agreement) < self.window:
+            return None
+        agreement_range = max(self.agreement) - min(self.agreement)
+        max_displacement, max_drift = max(self.displacement), max(self.drift)
+        max_rewired = max(self.rewired, default=0.0)
+        if agreement_range <= self.agreement_tol and max_displacement <= self.displacement_tol \
+                and max_drift <= self.drift_tol and max_rewired <= self.rewire_tol:
+            reason = (f"over the last {self.window} iterations the agreement score varied by {agreement_range:.4f}, "
+                      f"agents moved at most {max_displacement:.2e} on average and at most {max_drift:.1%} "
+                      f"of the probed neighbors changed")
+            if self.rewired:
+                reason += f", and at most {max_rewired:.1%} of the ties were rewired"
+            return reason
+        return None
+
+    @property
+    def last_displacement(self) -> float:
+        return self.displacement[-1] if self.displacement else 0.0
+
+    @property
+    def last_drift(self) -> float:
+        return self.drift[-1] if self.drift else 0.0
+
+    @property
+    def last_rewired(self) -> float:
+        return self.rewired[-1] if self.rewired else 0.0
@@ -1,30 +1,197 @@
-from typing import List, Tuple, Any
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Any, TYPE_CHECKING
+
+import numpy as np
 
 from conversation_prompting import prompt_constructor, generate_initial_question_prompts
-from vllm_wrapper import LLM
+from prompt_chaining import continue_prompt, engine_sequence_ids
+from prompt_layout import generate_in_prefix_order
+from stage_config import stage_profiles
+from token_batching import estimate_lengths
 
+if TYPE_CHECKING:
+    from vllm_wrapper import LLM
 
-def generate_conversation(llm: LLM, sampling_params, all_pairs, all_questions, agent_properties_lst) -> Tuple[
-    List[str], List[str]]:
+
+def build_reply_prompt(agent_properties_lst, pair, question, response) -> str:
+    """Prompt for the second agent's answer to the first agent's opening response."""
+    return prompt_constructor(agent_properties_lst[pair[1]], [question, response])
+
+
+def conversation_prefixes(agent_properties_lst, pair, question, reply, final_response) -> Tuple[str, str]:
     """
-    Accepts N*2, N*1, N*1
-    Returns N*1
+    The token sequences each agent's engine request ended with: its conversation prompt
+    followed by what it generated. Chained prompts continue these.
     """
+    return (prompt_constructor(agent_properties_lst[pair[0]], [question]) + reply,
+            build_reply_prompt(agent_properties_lst, pair, question, reply) + final_response)
 
-    # Populate prompts
-    initial_prompts = generate_initial_question_prompts(all_pairs, all_questions, agent_properties_lst)
-    print(f"The prompts given to the agents were: {initial_prompts}\n\n\n\n")
-    # Generate first level response for the whole batch
-    responses: List[str] = [r.outputs[0].text for r in llm.generate(initial_prompts, sampling_params)]
 
-    # Generate reply
-    reply_prompts = []
+@dataclass
+class Conversations:
+    """
+    Multi-turn conversations of a batch of pairs. Every message of a pair alternates between
+    the primary and the secondary agent; `sequences` are each agent's last prompt plus its
+    last message, which the next turn and chained prompts continue. `sequence_ids` are the
+    engine's token ids of those, when kept and the backend returns them.
+
+    The per-pair counters cover all of a pair's turns: rounds run, seconds spent in the
+    engine calls it was part of, prompt tokens, of those the prefix-cache hits, prompt tokens
+    new since the agent's previous request, and generated tokens.
+    """
+    messages: List[List[str]]
+    sequences: List[List[str]]
+    turns: np.ndarray
+    seconds: np.ndarray
+    prompt_tokens: np.ndarray
+    cached_tokens: np.ndarray
+    new_tokens: np.ndarray
+    output_tokens: np.ndarray
+    sequence_ids: List[List[Optional[np.ndarray]]]
+
+    @classmethod
+    def start(cls, initial_prompts: List[str]) -> "Conversations":
+        num_pairs = len(initial_prompts)
+        counters = [np.zeros(num_pairs, dtype=np.float64 if name == "seconds" else np.int64)
+                    for name in ("turns", "seconds", "prompt_tokens", "cached_tokens", "new_tokens", "output_tokens")]
+        return cls([[] for _ in range(num_pairs)], [[prompt, ""] for prompt in initial_prompts], *counters,
+                   [[None, None] for _ in range(num_pairs)])
+
+    @property
+    def replies(self) -> List[str]:
+        """The primary agent's last message of every pair."""
+        return [messages[-2] for messages in self.messages]
+
+    @property
+    def final_responses(self) -> List[str]:
+        """The secondary agent's last message of every pair."""
+        return [messages[-1] for messages in self.messages]
+
+
+class TurnStats:
+    """Per-turn cost of the conversations, summed over pairs until `reset`."""
+
+    def __init__(self):
+        self.totals: Dict[str, float] = defaultdict(float)
+
+    def record(self, conversations: Conversations):
+        self.totals["pairs"] += len(conversations.turns)
+        for name in ("turns", "seconds", "prompt_tokens", "cached_tokens", "new_tokens", "output_tokens"):
+            self.totals[name] += float(getattr(conversations, name).sum())
 
-    for idx, response in enumerate(responses):
-        question = all_questions[idx]
-        reply_prompts.append(prompt_constructor(agent_properties_lst[idx], [question, response]))
+    def report(self) -> Dict[str, float]:
+        """Mean turns per pair and, per turn, seconds and prefilled (uncached), new and generated tokens."""
+        turns = self.totals["turns"]
+        if not turns:
+            return {}
+        return {"turns per pair": turns / self.totals["pairs"],
+                "seconds per turn": self.totals["seconds"] / turns,
+                "prefill tokens per turn": (self.totals["prompt_tokens"] - self.totals["cached_tokens"]) / turns,
+                "new prompt tokens per turn": self.totals["new_tokens"] / turns,
+                "output tokens per turn": self.totals["output_tokens"] / turns}
 
-    # Get the other LLM's response
-    final_responses: List[str] = [r.outputs[0].text for r in llm.generate(reply_prompts, sampling_params)]
+    def reset(self):
+        self.totals.clear()
 
-    return responses, final_responses
+
+turn_stats = TurnStats()
+
+
+def next_turn_tokens(conversations: Conversations, idx: int, sequence_tokens: np.ndarray,
+                     max_tokens: Sequence[int]) -> int:
+    """
+    Most tokens the engine may need for the pair's next round: the longer of both agents'
+    next prompt plus what they may generate, the secondary agent's prompt including the
+    primary agent's next message. Known sequence lengths are used, estimates otherwise.
+    """
+    sequences = conversations.sequences[idx]
+    lengths = [int(sequence_tokens[idx, side]) or int(estimate_lengths([sequences[side]])[0]) for side in (0, 1)]
+    turn_tokens = int(estimate_lengths([continue_prompt("", "")])[0])
+    new_message = int(estimate_lengths([conversations.messages[idx][-1]])[0])
+    return max(lengths[0] + turn_tokens + new_message + max_tokens[0],
+               lengths[1] + turn_tokens + max_tokens[0] + max_tokens[1])
+
+
+def run_conversation(llm: "LLM", sampling_params, all_pairs, all_questions, agent_properties_lst, turns=1,
+                     stop_phrases: Sequence[str] = (),
+                     stop_pairs: Optional[Callable[[List[int], List[str], List[str]], Sequence[bool]]] = None,
+                     max_model_len: Optional[int] = None, keep_token_ids=False) -> Conversations:
+    """
+    Up to `turns` rounds of the primary agent speaking and the secondary agent answering.
+
+    Every turn continues each agent's previous prompt and message exactly (`continue_prompt`),
+    so the engine's prefix cache covers everything already said and a turn only prefills the
+    other agent's new message. After each round, pairs whose last exchange contains one of
+    `stop_phrases`, or that `stop_pairs(pair_idxs, replies, final_responses)` flags, drop
+    out of the batch, as do pairs whose next round might not fit into `max_model_len` tokens.
+    With `keep_token_ids`, the engine's ids of the sequences are kept for checking chained prompts.
+    """
+    initial_prompts = generate_initial_question_prompts(all_pairs, all_questions, agent_properties_lst)
+    print(f"The prompts given to the agents were: {initial_prompts}\n\n\n\n")
+    conversations = Conversations.start(initial_prompts)
+    # Tokens of each agent's sequence so far, to tell the new prompt tokens apart
+    sequence_tokens = np.zeros((len(all_pairs), 2), dtype=np.int64)
+    active = list(range(len(all_pairs)))
+    max_tokens = [getattr(stage_profiles.sampling_params(sampling_params, stage), "max_tokens", None) or 0
+                  for stage in ("conversation", "reply")]
+    for turn in range(turns):
+        for side, stage in ((0, "conversation"), (1, "reply")):
+            prompts = []
+            for idx in active:
+                if turn == 0:
+                    prompts.append(initial_prompts[idx] if side == 0 else build_reply_prompt(
+                        agent_properties_lst, all_pairs[idx], all_questions[idx], conversations.messages[idx][-1]))
+                else:
+                    prompts.append(continue_prompt(conversations.sequences[idx][side],
+                                                   conversations.messages[idx][-1]))
+            start = time.perf_counter()
+            outputs = generate_in_prefix_order(llm, prompts, stage_profiles.sampling_params(sampling_params, stage),
+                                               stage=stage)
+            seconds = time.perf_counter() - start
+            for idx, prompt, output in zip(active, prompts, outputs):
+                completion = output.outputs[0]
+                conversations.messages[idx].append(completion.text)
+                conversations.sequences[idx][side] = prompt + completion.text
+                if keep_token_ids:
+                    conversations.sequence_ids[idx][side] = engine_sequence_ids(output)
+                conversations.seconds[idx] += seconds
+                # Backends that don't return token ids (HTTP, cached outputs) aren't counted
+                prompt_tokens = len(output.prompt_token_ids or ())
+                if prompt_tokens:
+                    conversations.prompt_tokens[idx] += prompt_tokens
+                    conversations.cached_tokens[idx] += getattr(output, "num_cached_tokens", None) or 0
+                    conversations.new_tokens[idx] += prompt_tokens - sequence_tokens[idx, side]
+                    sequence_tokens[idx, side] = prompt_tokens + len(completion.token_ids or ())
+                conversations.output_tokens[idx] += len(completion.token_ids or ())
+        conversations.turns[active] += 1
+        if turn == turns - 1:
+            break
+        ended = np.asarray([any(phrase in message for phrase in stop_phrases
+                                for message in conversations.messages[idx][-2:]) for idx in active], dtype=bool)
+        if stop_pairs is not None:
+            ended |= np.asarray(stop_pairs(active, [conversations.messages[idx][-2] for idx in active],
+                                           [conversations.messages[idx][-1] for idx in active]), dtype=bool)
+        if max_model_len is not None:
+            too_long = np.asarray([next_turn_tokens(conversations, idx, sequence_tokens, max_tokens) > max_model_len
+                                   for idx in active], dtype=bool)
+            if (too_long & ~ended).any():
+                print(f"{(too_long & ~ended).sum()} conversations end after turn {turn + 1}, "
+                      f"their next turn might exceed {max_model_len} tokens")
+            ended |= too_long
+        active = [idx for idx, stop in zip(active, ended) if not stop]
+        if not active:
+            break
+    turn_stats.record(conversations)
+    return conversations
+
+
+def generate_conversation(llm: "LLM", sampling_params, all_pairs, all_questions, agent_properties_lst) -> Tuple[
+    List[str], List[str]]:
+    """
+    Accepts N*2, N*1, N*1
+    Returns N*1: the primary agent's response and the secondary agent's reply
+    """
+    conversations = run_conversation(llm, sampling_params, all_pairs, all_questions, agent_properties_lst)
+    return conversations.replies, conversations.final_responses
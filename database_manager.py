@@ -75,6 +75,20 @@ class SimLogger:
         connection.commit()
         connection.close()
 
+    def insert_agent_logs_many(self, rows):
+        """Inserts (agent_id, iter_idx, location, questionnaire_r, latent_attributes) rows in one transaction."""
+        connection = sqlite3.connect(self.db_path)
+        cursor = connection.cursor()
+        sql = """
+        INSERT INTO AgentLog (agent_id, iter_idx, location_x, location_y, questionnaire_r, latent_attributes)
+        VALUES (?, ?, ?, ?, ?, ?)
+        """
+        cursor.executemany(sql, ((agent_id, iter_idx, location[0], location[1],
+                                  json.dumps(questionnaire_r), json.dumps(latent_attributes))
+                                 for agent_id, iter_idx, location, questionnaire_r, latent_attributes in rows))
+        connection.commit()
+        connection.close()
+
     def insert_conversation_log(self, id: str, conv_pair: Tuple[int, int], iteration_idx: int,
                                 question: str, reply: str, final_response: str, agreement_score: int):
         connection = sqlite3.connect(self.db_path)
@@ -89,6 +103,25 @@ class SimLogger:
         connection.commit()
         connection.close()
 
+    def insert_conversation_logs_many(self, rows):
+        """
+        Inserts (id, conv_pair, iteration_idx, question, reply, final_response, agreement_score)
+        rows in one transaction.
+        """
+        connection = sqlite3.connect(self.db_path)
+        cursor = connection.cursor()
+        sql = """
+        INSERT INTO ConversationLog
+        (id, conv_member_1, conv_member_2, iteration_idx, question, reply, final_response, agreement_score) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """
+        cursor.executemany(sql, ((id, conv_pair[0], conv_pair[1], iteration_idx, question, reply, final_response,
+                                  agreement_score)
+                                 for id, conv_pair, iteration_idx, question, reply, final_response, agreement_score
+                                 in rows))
+        connection.commit()
+        connection.close()
+
     def insert_metric_log(self, iter_idx: int, metric_name: List[str], metric: List[float]):
         connection = sqlite3.connect(self.db_path)
         cursor = connection.cursor()
@@ -111,6 +144,18 @@ class SimLogger:
         connection.commit()
         connection.close()
 
+    def insert_agent_properties_many(self, rows):
+        """Inserts (agent_id, age, gender, location, urbanicity, ethnicity, education) rows in one transaction."""
+        connection = sqlite3.connect(self.db_path)
+        cursor = connection.cursor()
+        sql = """
+        INSERT INTO AgentProperties (agent_id, age, gender, location, urbanicity, ethnicity, education)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """
+        cursor.executemany(sql, rows)
+        connection.commit()
+        connection.close()
+
 # Example usage:
 # logger = Logger("/path/to/logs")
 # logger.insert_agent_log(1, 0, (10, 20), ["Yes", "No"], [0.5, 1.2])
@@ -0,0 +1,147 @@
+from typing import List, Optional, Protocol, Tuple
+
+import torch
+
+from conversation import build_reply_prompt, conversation_prefixes
+from conversation_prompting import generate_initial_question_prompts
+from generate_questionnaire_answer import (assign_to_agents, build_chained_questionnaire_item_prompts,
+                                           build_chained_questionnaire_prompts, build_questionnaire_item_prompts,
+                                           build_questionnaire_prompts, collect_questionnaire_answers,
+                                           item_probabilities)
+from judge_prompting import construct_chained_judge_prompt, construct_judge_prompt
+from prompt_chaining import chain_stats, engine_sequence_ids
+from property_updates import JudgeScoring, log_grades, parse_grades
+from stage_config import stage_profiles
+
+
+class Engine(Protocol):
+    """The part of vLLM's `LLMEngine` (`LLM.llm_engine`) the pipeline drives."""
+
+    def add_request(self, request_id: str, prompt: str, params) -> None:
+        ...
+
+    def step(self) -> list:
+        ...
+
+    def has_unfinished_requests(self) -> bool:
+        ...
+
+
+def get_engine(llm) -> Optional[Engine]:
+    """The step-wise engine behind `llm`, or None if it only offers `generate`."""
+    engine = getattr(llm, "llm_engine", None)
+    if engine is None or not all(hasattr(engine, name) for name in ("add_request", "step", "has_unfinished_requests")):
+        return None
+    return engine
+
+
+def run_pipelined_stages(engine: Engine, sampling_params, all_pairs, all_questions, agent_properties_lst,
+                         questionnaire_question_lst: List[str],
+                         judge_scoring: Optional[JudgeScoring] = None,
+                         questionnaire_scoring=False, chain=False,
+                         chain_judge=False) -> Tuple[List[str], List[str], list, torch.Tensor]:
+    """
+    Runs the conversation, reply, judge and questionnaire stages as one dataflow instead of
+    four barriers: each pair's next prompts are submitted as soon as its previous output is
+    finished, so the engine always has a mix of work and no stage waits for the slowest
+    prompt of the one before.
+
+    Returns the same structures as running the stages one after another: the replies, final
+    responses, per-agent questionnaire answers and the agreement score of every pair, from
+    the sampled grades or, with `judge_scoring`, the grade logprobs. With `questionnaire_scoring`,
+    the answers are per-item P(answer = 1) like `score_questionnaire_answers`. `chain` and
+    `chain_judge` build the questionnaire and judge prompts as continuations of the
+    conversation sequences, like the sequential stages do.
+    """
+    num_pairs = len(all_pairs)
+    replies = ["" for _ in range(num_pairs)]
+    final_responses = ["" for _ in range(num_pairs)]
+    grades = ["" for _ in range(num_pairs)]
+    judge_prompts = ["" for _ in range(num_pairs)]
+    num_items = len(questionnaire_question_lst)
+    # (conv1_prim, conv1_second, conv2_prim, ...), like `generate_questionnaire_answer`; one entry per item when scoring
+    questionnaire_outputs = [None for _ in range(2 * num_pairs * (num_items if questionnaire_scoring else 1))]
+
+    # Each stage decodes with its own profile
+    judge_stage = "judge" if judge_scoring is None else "judge_scoring"
+    questionnaire_stage = "questionnaire" if not questionnaire_scoring else "questionnaire_scoring"
+    profile_of = {"conversation": "conversation", "reply": "reply", "judge": judge_stage,
+                  "questionnaire": questionnaire_stage}
+    stage_params = {stage: stage_profiles.sampling_params(sampling_params, profile, num_items)
+                    for stage, profile in profile_of.items()}
+    judge_outputs = [None for _ in range(num_pairs)]
+    # One questionnaire prompt per side, or one per item when scoring
+    if questionnaire_scoring:
+        build_questionnaire = build_chained_questionnaire_item_prompts if chain else build_questionnaire_item_prompts
+    else:
+        build_questionnaire = build_chained_questionnaire_prompts if chain else build_questionnaire_prompts
+    # Chained prompts and the sequences they continue, checked once the engine is done
+    chained = {"questionnaire": ([], []), "judge": ([], [])}
+
+    def submit(stage, idx, prompt):
+        engine.add_request(f"{stage}-{idx}", prompt, stage_params[stage])
+
+    for idx, prompt in enumerate(generate_initial_question_prompts(all_pairs, all_questions, agent_properties_lst)):
+        submit("conversation", idx, prompt)
+
+    while engine.has_unfinished_requests():
+        for output in engine.step():
+            if not output.finished:
+                continue
+            stage, idx = output.request_id.rsplit("-", 1)
+            idx, text = int(idx), output.outputs[0].text
+            if stage in ("conversation", "reply") and (chain or chain_judge):
+                # The sequence chained prompts continue, with the ids the engine holds for it
+                chain_stats.add_sequences([[output.prompt + text]], [[engine_sequence_ids(output)]])
+            if stage == "conversation":
+                replies[idx] = text
+                submit("reply", idx, build_reply_prompt(agent_properties_lst, all_pairs[idx],
+                                                        all_questions[idx], text))
+            elif stage == "reply":
+                final_responses[idx] = text
+                pair_args = (agent_properties_lst, all_pairs[idx], all_questions[idx], replies[idx], text)
+                if chain_judge:
+                    prefix = conversation_prefixes(*pair_args)[1]
+                    judge_prompts[idx] = construct_chained_judge_prompt(prefix)
+                    chained["judge"][0].append(prefix)
+                    chained["judge"][1].append(judge_prompts[idx])
+                else:
+                    judge_prompts[idx] = construct_judge_prompt(all_questions[idx], replies[idx], text)
+                submit("judge", idx, judge_prompts[idx])
+                sides = build_questionnaire(*pair_args, questionnaire_question_lst)
+                if chain:
+                    prefixes, sides = sides
+                if not questionnaire_scoring:
+                    sides = [[prompt] for prompt in sides]
+                # Item `item` of conversation side `side` is request (2 * idx + side) * num_items + item
+                for side, side_prompts in enumerate(sides):
+                    for item, prompt in enumerate(side_prompts):
+                        submit("questionnaire", (2 * idx + side) * len(side_prompts) + item, prompt)
+                    if chain:
+                        chained["questionnaire"][0].extend(prefixes[side] for _ in side_prompts)
+                        chained["questionnaire"][1].extend(side_prompts)
+            elif stage == "judge":
+                grades[idx] = text
+                judge_outputs[idx] = output
+            else:
+                questionnaire_outputs[idx] = output
+
+    for stage, (prefixes, prompts) in chained.items():
+        if prompts:
+            chain_stats.check(engine, stage, prefixes, prompts)
+    if questionnaire_scoring:
+        probabilities = item_probabilities(questionnaire_outputs, strict=stage_profiles.strict(questionnaire_stage))
+        questionnaire_responses = assign_to_agents(
+            all_pairs, [probabilities[i: i + num_items] for i in range(0, len(probabilities), num_items)],
+            len(agent_properties_lst))
+    else:
+        questionnaire_responses, _ = collect_questionnaire_answers(
+            all_pairs, [output.outputs[0].text for output in questionnaire_outputs], len(agent_properties_lst),
+            questionnaire_question_lst, strict=stage_profiles.strict(questionnaire_stage))
+    if judge_scoring is not None:
+        agreements = judge_scoring.agreements(judge_outputs, strict=stage_profiles.strict(judge_stage))
+        log_grades([f"{a:.3f}" for a in agreements.tolist()], judge_prompts)
+    else:
+        agreements = parse_grades(grades, strict=stage_profiles.strict(judge_stage))
+        log_grades(grades, judge_prompts)
+    return replies, final_responses, questionnaire_responses, agreements
@@ -1,10 +1,14 @@
-import random
-from typing import List, TypedDict, Dict, Union, Tuple
+import math
+from typing import List, Optional, Sequence, TypedDict, Dict, Union, Tuple
 from agent_prompting import get_sys_prompt
 
 from log_schemas import StaticAgentProperty2
 
 from calculate_latent_vec_score import questionnaire_res_to_latent_score
+from conversation import conversation_prefixes
+from prompt_chaining import chain_stats, continue_prompt
+from prompt_layout import generate_in_prefix_order
+from stage_config import stage_profiles
 
 class ConversationSchema(TypedDict):
     conversation_topic: str
@@ -12,17 +16,33 @@ class ConversationSchema(TypedDict):
     second_agent_response: str
 
 
-def questionnaire_answering_prompt_constructor(agent_property: StaticAgentProperty2, previous_conversations: ConversationSchema, questionnaire_question_lst: List[str], primary_agent: bool):
-    # sys_inst = get_sys_prompt(agent_property) # political debate case
-    sys_inst = get_sys_prompt(agent_property) # political debate case
-    conversation_topic = previous_conversations['conversation_topic']
+# Shared by every questionnaire prompt, so it goes first and stays in the engine's prefix cache
+QUESTIONNAIRE_INSTRUCTIONS = (
+    "Answer the questionnaire based on your political stance and the conversation.\n"
+    "Your output must follow these strict rules:\n"
+    "1. The answer should be a list of binary integers (0 or 1), nothing else.\n"
+    "2. Each element in the list corresponds to the questionnaire items in order.\n"
+    "3. Provide no explanations, text, disclaimers, or any other output.\n"
+    "4. Do not include any extra punctuation or formatting. No additional keys or words.\n\n"
+)
+
+
+def format_questionnaire(questionnaire_question_lst: List[str]) -> str:
+    formatted_questions = "\n".join(f"{idx + 1}. {question.strip()}" for idx, question in enumerate(questionnaire_question_lst))
+    # The format without example values, which every agent would be anchored to alike
+    response_format = ", ".join(f"<answer {idx + 1}>" for idx in range(len(questionnaire_question_lst)))
+    return (
+        "=== Questionnaire ===\n"
+        f"{formatted_questions}\n"
+        "=== End of Questionnaire ===\n\n"
+        f"Response format: [{response_format}]\n\n"
+    )
+
+
+def format_conversation_history(previous_conversations: ConversationSchema, primary_agent: bool) -> str:
     primary_agent_response = previous_conversations['primary_agent_response']
     second_agent_response = previous_conversations['second_agent_response']
 
-    prompt = "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n" + sys_inst
-    prompt += (f"You are discussing on the topic '{conversation_topic}'. Below is the interaction between you and another agent. Answer the questionnaire base on your political standings and interactions. \n\n"
-               f"=== Conversation History ===\n"
-               f"")
     # Build conversation history according to whether this agent is primary or not
     if primary_agent:
         # First message => agent's output; rest => user input
@@ -36,87 +56,265 @@ def questionnaire_answering_prompt_constructor(agent_property: StaticAgentProper
             f"User input: {primary_agent_response}\n"
             f"Your output: {second_agent_response}\n"
         )
+    return (
+        f"You discussed the topic '{previous_conversations['conversation_topic']}'.\n"
+        "Below is the interaction between you and another agent.\n\n"
+        "=== Conversation History ===\n"
+        f"{conversation_history}"
+        "\n=== End of Conversation History ===\n\n"
+    )
 
-    def format_questionnaire():
-        formatted_questions = "\n".join(f"{idx + 1}. {question.strip()}" for idx, question in enumerate(questionnaire_question_lst))
-        return formatted_questions
 
-    example_response = [random.randint(0,1) for _ in range(len(questionnaire_question_lst))]
+def questionnaire_answering_prompt_constructor(agent_property: StaticAgentProperty2, previous_conversations: ConversationSchema, questionnaire_question_lst: List[str], primary_agent: bool):
+    # Shared content first (instructions, questionnaire), then the persona, then the per-pair conversation
+    sys_inst = get_sys_prompt(agent_property) # political debate case
+
     prompt = (
         "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n"
+        f"{QUESTIONNAIRE_INSTRUCTIONS}"
+        f"{format_questionnaire(questionnaire_question_lst)}"
         f"{sys_inst}\n"
-        f"You are discussing the topic '{conversation_topic}'.\n"
-        "Below is the interaction between you and another agent.\n\n"
-        "Answer the questionnaire based on your political stance and the conversation.\n"
-        "Your output must follow these strict rules:\n"
-        "1. The answer should be a list of binary integers (0 or 1), nothing else.\n"
-        "2. Each element in the list corresponds to the questionnaire items in order.\n"
-        "3. Provide no explanations, text, disclaimers, or any other output.\n"
-        "4. Do not include any extra punctuation or formatting. No additional keys or words.\n\n"
-        "=== Conversation History ===\n"
-        f"{conversation_history}"
-        "\n=== End of Conversation History ===\n\n"
         "<|eot_id|><|start_header_id|>user<|end_header_id|>\n"
-        f"{format_questionnaire()}\n\n"
-        "Please respond with your answers as a single list of binary integers.\n"
-        f"Example response: {example_response}\n\n"
+        f"{format_conversation_history(previous_conversations, primary_agent)}"
+        "Please respond with your answers to the questionnaire as a single list of binary integers.\n\n"
         "<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
     )
     return prompt
 
 
 
-def generate_questionnaire_answer(llm, sampling_params, all_pairs, agent_properties_lst, all_questions, all_replies,
-                                  final_responses, questionnaire_question_lst: List[str]) -> Tuple[List[List[int]], List[List[Union[int, float]]]]:
-    prompts = []
-    agent_questionnaire_answers = ["" for _ in range(len(agent_properties_lst))]
-    for i, (pair, q, r, final_r) in enumerate(zip(all_pairs, all_questions, all_replies
-                                            , final_responses)):
-        # q, r, final_r, questionnaire_question
-        primary_agent_id, second_agent_id = pair
+QUESTIONNAIRE_ITEM_INSTRUCTIONS = (
+    "Answer the questionnaire based on your political stance and the conversation.\n"
+    "You are given one questionnaire item at a time. Answer it with a single binary integer: "
+    "1 if it applies to you, 0 if it does not. Provide no other output.\n\n"
+)
 
-        # Create the conversation schema for passing to prompt constructor
-        previous_conversations: ConversationSchema = {
-            'conversation_topic': q,
-            'primary_agent_response': r,
-            'second_agent_response': final_r
-        }
-
-        # primary agent questionnaire
-        primary_prompt = questionnaire_answering_prompt_constructor(
-            agent_property=agent_properties_lst[i],
-            previous_conversations=previous_conversations,
-            questionnaire_question_lst=questionnaire_question_lst,
-            primary_agent=True
-        )
-        prompts.append(primary_prompt)
-        # secondary agent questionnaire
-        secondary_prompt = questionnaire_answering_prompt_constructor(
-            agent_property=agent_properties_lst[i],
-            previous_conversations=previous_conversations,
-            questionnaire_question_lst=questionnaire_question_lst,
-            primary_agent=False
-        )
-        prompts.append(secondary_prompt)
-    questionnaire_answers: List[str] = [r.outputs[0].text for r in llm.generate(prompts, sampling_params)]
-    questionnaire_answers: List[List[int]] = parse_binary_strings(questionnaire_answers, len(questionnaire_question_lst))
-    
+
+def questionnaire_item_prompts(agent_property: StaticAgentProperty2, previous_conversations: ConversationSchema,
+                               questionnaire_question_lst: List[str], primary_agent: bool) -> List[str]:
+    """
+    One prompt per questionnaire item, all sharing the agent's persona and conversation as
+    their prefix, so the engine prefills that prefix once and each item costs a few tokens.
+    """
+    prefix = (
+        "<|begin_of_text|><|start_header_id|>system<|end_header_id|>\n"
+        f"{QUESTIONNAIRE_ITEM_INSTRUCTIONS}"
+        f"{get_sys_prompt(agent_property)}\n"
+        "<|eot_id|><|start_header_id|>user<|end_header_id|>\n"
+        f"{format_conversation_history(previous_conversations, primary_agent)}"
+    )
+    return [prefix + "=== Questionnaire ===\n"
+                     f"{idx + 1}. {question.strip()}\n"
+                     "=== End of Questionnaire ===\n\n"
+                     "<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
+            for idx, question in enumerate(questionnaire_question_lst)]
+
+
+def build_questionnaire_item_prompts(agent_properties_lst, pair, question, reply, final_response,
+                                     questionnaire_question_lst: List[str]) -> Tuple[List[str], List[str]]:
+    """`build_questionnaire_prompts` with one prompt per item, for the scoring mode."""
+    previous_conversations: ConversationSchema = {
+        'conversation_topic': question,
+        'primary_agent_response': reply,
+        'second_agent_response': final_response
+    }
+    return (questionnaire_item_prompts(agent_properties_lst[pair[0]], previous_conversations,
+                                       questionnaire_question_lst, primary_agent=True),
+            questionnaire_item_prompts(agent_properties_lst[pair[1]], previous_conversations,
+                                       questionnaire_question_lst, primary_agent=False))
+
+
+def build_questionnaire_prompts(agent_properties_lst, pair, question, reply, final_response,
+                                questionnaire_question_lst: List[str]) -> Tuple[str, str]:
+    """The questionnaire prompts of the primary and the secondary agent of one conversation."""
+    # Create the conversation schema for passing to prompt constructor
+    previous_conversations: ConversationSchema = {
+        'conversation_topic': question,
+        'primary_agent_response': reply,
+        'second_agent_response': final_response
+    }
+
+    # primary agent questionnaire
+    primary_prompt = questionnaire_answering_prompt_constructor(
+        agent_property=agent_properties_lst[pair[0]],
+        previous_conversations=previous_conversations,
+        questionnaire_question_lst=questionnaire_question_lst,
+        primary_agent=True
+    )
+    # secondary agent questionnaire
+    secondary_prompt = questionnaire_answering_prompt_constructor(
+        agent_property=agent_properties_lst[pair[1]],
+        previous_conversations=previous_conversations,
+        questionnaire_question_lst=questionnaire_question_lst,
+        primary_agent=False
+    )
+    return primary_prompt, secondary_prompt
+
+
+def build_chained_questionnaire_prompts(agent_properties_lst, pair, question, reply, final_response,
+                                        questionnaire_question_lst: List[str], prefixes: Optional[Sequence[str]] = None
+                                        ) -> Tuple[Sequence[str], Tuple[str, str]]:
+    """
+    `build_questionnaire_prompts` as continuations of each agent's conversation sequence, so
+    the engine reuses the conversation's KV cache. Returns those sequences and the prompts.
+    Multi-turn conversations pass their `prefixes`; one exchange is rebuilt from the texts.
+    """
+    if prefixes is None:
+        prefixes = conversation_prefixes(agent_properties_lst, pair, question, reply, final_response)
+    questionnaire = (f"{QUESTIONNAIRE_INSTRUCTIONS}{format_questionnaire(questionnaire_question_lst)}"
+                     "Please respond with your answers to the questionnaire as a single list of binary integers.\n\n")
+    # The primary agent hasn't seen the other agent's answer yet
+    return prefixes, (continue_prompt(prefixes[0], f"{final_response}\n\n{questionnaire}"),
+                      continue_prompt(prefixes[1], questionnaire))
+
+
+def build_chained_questionnaire_item_prompts(agent_properties_lst, pair, question, reply, final_response,
+                                             questionnaire_question_lst: List[str],
+                                             prefixes: Optional[Sequence[str]] = None
+                                             ) -> Tuple[Sequence[str], Tuple[List[str], List[str]]]:
+    """`build_questionnaire_item_prompts` as continuations of each agent's conversation sequence."""
+    if prefixes is None:
+        prefixes = conversation_prefixes(agent_properties_lst, pair, question, reply, final_response)
+    blocks = [f"{QUESTIONNAIRE_ITEM_INSTRUCTIONS}=== Questionnaire ===\n"
+              f"{idx + 1}. {item.strip()}\n"
+              "=== End of Questionnaire ===\n\n"
+              for idx, item in enumerate(questionnaire_question_lst)]
+    return prefixes, ([continue_prompt(prefixes[0], f"{final_response}\n\n{block}") for block in blocks],
+                      [continue_prompt(prefixes[1], block) for block in blocks])
+
+
+def assign_to_agents(all_pairs, rows: list, num_agents: int) -> list:
+    """
+    Spreads per-conversation rows (conv1_prim, conv1_second, conv2_prim, ...) over the agents,
+    with "" for agents that didn't converse.
+    """
+    agent_rows = ["" for _ in range(num_agents)]
     idx = 0
-    # questionnaire_answers has length: 2*len(conversations): (conv1_prim, conv1_second, conv2_prim, conv2_second, ...)
-    # Iterate through the responses, and fill the agent_questionnaire_answers list. This has length: len(agents)
-    for (pair, _, _, _) in zip(all_pairs, all_questions, all_replies, final_responses):
+    # rows has length: 2*len(conversations): (conv1_prim, conv1_second, conv2_prim, conv2_second, ...)
+    # Iterate through the responses, and fill the agent_rows list. This has length: len(agents)
+    for pair in all_pairs:
         primary_agent_id, second_agent_id = pair
         # Primary agent's questionnaire
-        agent_questionnaire_answers[primary_agent_id] = questionnaire_answers[idx]
+        agent_rows[primary_agent_id] = rows[idx]
         idx += 1
         # Secondary agent's questionnaire
-        agent_questionnaire_answers[second_agent_id] = questionnaire_answers[idx]
+        agent_rows[second_agent_id] = rows[idx]
         idx += 1
+    return agent_rows
+
 
+def collect_questionnaire_answers(all_pairs, questionnaire_answers: List[str], num_agents: int,
+                                  questionnaire_question_lst: List[str],
+                                  strict=False) -> Tuple[List[List[int]], List[List[Union[int, float]]]]:
+    """
+    Parses the questionnaire outputs, ordered (conv1_prim, conv1_second, conv2_prim, ...), into
+    one answer list per agent ("" for agents that didn't converse) and the latent scores.
+    """
+    questionnaire_answers: List[List[int]] = parse_binary_strings(questionnaire_answers, len(questionnaire_question_lst),
+                                                                  strict=strict)
+    agent_questionnaire_answers = assign_to_agents(all_pairs, questionnaire_answers, num_agents)
     latent_factor = questionnaire_res_to_latent_score(questionnaire_question_lst, questionnaire_answers)
     return agent_questionnaire_answers, latent_factor
 
-def parse_binary_strings(binary_strings: List[str], list_len) -> List[List[int]]:
+
+def generate_questionnaire_answer(llm, sampling_params, all_pairs, agent_properties_lst, all_questions, all_replies,
+                                  final_responses, questionnaire_question_lst: List[str],
+                                  stage="questionnaire", chain=False, sequences=None
+                                  ) -> Tuple[List[List[int]], List[List[Union[int, float]]]]:
+    """
+    Asks both agents of every conversation the questionnaire. With `chain`, each prompt
+    continues the agent's conversation sequence (see `build_chained_questionnaire_prompts`),
+    taken from `sequences` (`Conversations.sequences`) when given.
+    """
+    prompts, prefixes = [], []
+    for i, (pair, q, r, final_r) in enumerate(zip(all_pairs, all_questions, all_replies
+                                            , final_responses)):
+        # q, r, final_r, questionnaire_question
+        if chain:
+            pair_prefixes, pair_prompts = build_chained_questionnaire_prompts(
+                agent_properties_lst, pair, q, r, final_r, questionnaire_question_lst,
+                sequences[i] if sequences is not None else None)
+            prefixes.extend(pair_prefixes)
+            prompts.extend(pair_prompts)
+        else:
+            prompts.extend(build_questionnaire_prompts(agent_properties_lst, pair, q, r, final_r,
+                                                       questionnaire_question_lst))
+    if chain:
+        chain_stats.check(llm, stage, prefixes, prompts)
+    stage_params = stage_profiles.sampling_params(sampling_params, stage, len(questionnaire_question_lst))
+    questionnaire_answers: List[str] = [r.outputs[0].text for r in
+                                        generate_in_prefix_order(llm, prompts, stage_params, stage=stage)]
+    return collect_questionnaire_answers(all_pairs, questionnaire_answers, len(agent_properties_lst),
+                                         questionnaire_question_lst, strict=stage_profiles.strict(stage))
+
+def item_probabilities(outputs, strict=False) -> List[float]:
+    """
+    P(answer = 1) of every questionnaire item output, from the logprobs of its first token
+    renormalised over "0" and "1".
+    """
+    probabilities = []
+    for output in outputs:
+        p_zero = p_one = 0.0
+        logprobs = output.outputs[0].logprobs
+        for logprob in (logprobs[0].values() if logprobs else ()):
+            token = (logprob.decoded_token or "").strip()
+            if token == "0":
+                p_zero += math.exp(logprob.logprob)
+            elif token == "1":
+                p_one += math.exp(logprob.logprob)
+        if p_zero + p_one == 0:
+            if strict:
+                raise ValueError(f"no answer token among the questionnaire logprobs of request {output.request_id}")
+            print("no answer token among the questionnaire logprobs")
+            # No information either way
+            probabilities.append(0.5)
+        else:
+            probabilities.append(p_one / (p_zero + p_one))
+    return probabilities
+
+
+def hard_answers(probabilities: List[List[float]]) -> List[List[int]]:
+    """The most likely 0/1 answer of every item, keeping "" for agents without answers."""
+    return [[int(p > 0.5) for p in row] if row != "" else "" for row in probabilities]
+
+
+def score_questionnaire_answers(llm, sampling_params, all_pairs, agent_properties_lst, all_questions, all_replies,
+                                final_responses, questionnaire_question_lst: List[str],
+                                stage="questionnaire", chain=False, sequences=None) -> List[List[float]]:
+    """
+    Scoring mode of `generate_questionnaire_answer`: every item of every agent is one prompt
+    decoded for a single token, all in one call. Returns each agent's P(answer = 1) per item
+    ("" for agents that didn't converse).
+    """
+    prompts, prefixes = [], []
+    for i, (pair, q, r, final_r) in enumerate(zip(all_pairs, all_questions, all_replies, final_responses)):
+        if chain:
+            pair_prefixes, pair_prompts = build_chained_questionnaire_item_prompts(
+                agent_properties_lst, pair, q, r, final_r, questionnaire_question_lst,
+                sequences[i] if sequences is not None else None)
+            for prefix, item_prompts in zip(pair_prefixes, pair_prompts):
+                prefixes.extend(prefix for _ in item_prompts)
+                prompts.extend(item_prompts)
+        else:
+            for item_prompts in build_questionnaire_item_prompts(agent_properties_lst, pair, q, r, final_r,
+                                                                 questionnaire_question_lst):
+                prompts.extend(item_prompts)
+    if chain:
+        chain_stats.check(llm, stage, prefixes, prompts)
+    outputs = generate_in_prefix_order(llm, prompts, stage_profiles.sampling_params(sampling_params,
+                                                                                    "questionnaire_scoring"),
+                                       stage=stage)
+    probabilities = item_probabilities(outputs, strict=stage_profiles.strict("questionnaire_scoring"))
+    num_items = len(questionnaire_question_lst)
+    rows = [probabilities[i: i + num_items] for i in range(0, len(probabilities), num_items)]
+    return assign_to_agents(all_pairs, rows, len(agent_properties_lst))
+
+
+def parse_binary_strings(binary_strings: List[str], list_len, strict=False) -> List[List[int]]:
+    """
+    Parses "0, 1, ..." answers. Unparsable ones become [-1] * list_len, or raise with `strict`
+    (constrained questionnaire decoding), where they can only come from a misconfigured engine.
+    """
     parsed_lists = []
 
     for binary_string in binary_strings:
@@ -127,14 +325,16 @@ def parse_binary_strings(binary_strings: List[str], list_len) -> List[List[int]]
             parsed_list = [int(num.strip()) for num in cleaned_string.split(',')]
 
             # Validate that all elements are binary (0 or 1)
-            if all(num in [0, 1] for num in parsed_list):
-                parsed_lists.append(parsed_list)
-            elif len(parsed_list) != list_len:
+            if len(parsed_list) != list_len:
                 raise ValueError("LLM fails to answer to some questionnaire questions")
+            elif all(num in [0, 1] for num in parsed_list):
+                parsed_lists.append(parsed_list)
             else:
                 raise ValueError("Non-binary values detected")
 
         except Exception as e:
+            if strict:
+                raise ValueError(f"invalid questionnaire output {binary_string!r}") from e
             print(f"Parsing error for: {binary_string}\nError: {e}")
             # If an error occurs, replace with a list of -1s of the same length
             fallback_list = [-1] * list_len
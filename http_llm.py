@@ -0,0 +1,172 @@
+import asyncio
+import json
+import random
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from llm_outputs import CompletionOutput, Logprob, RequestOutput
+
+# Transient server answers worth retrying
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, body: bytes):
+        super().__init__(f"HTTP {status}: {body[:200]!r}")
+        self.status = status
+
+
+def completion_request(model: str, prompt: str, sampling_params) -> Dict:
+    """OpenAI `/v1/completions` body for one prompt, with vLLM's `guided_regex` extension."""
+    payload = {"model": model, "prompt": prompt}
+    for name in ("max_tokens", "temperature", "top_p", "n", "seed", "stop", "logprobs"):
+        value = getattr(sampling_params, name, None)
+        if value is not None and value != []:
+            payload[name] = value
+    regex = getattr(getattr(sampling_params, "guided_decoding", None), "regex", None)
+    if regex is not None:
+        payload["guided_regex"] = regex
+    return payload
+
+
+def completion_output(request_id: str, prompt: str, response: Dict) -> RequestOutput:
+    """An OpenAI completion response as a `RequestOutput`, like `BatchedLLM.generate` returns."""
+    outputs = []
+    for choice in sorted(response["choices"], key=lambda choice: choice["index"]):
+        logprobs, cumulative = None, None
+        if choice.get("logprobs"):
+            token_logprobs = choice["logprobs"].get("token_logprobs") or []
+            cumulative = sum(lp for lp in token_logprobs if lp is not None)
+            # The API gives no token ids; alternatives are keyed by rank instead
+            logprobs = [{rank: Logprob(lp, rank + 1, token) for rank, (token, lp) in
+                         enumerate(sorted(top.items(), key=lambda item: -item[1]))}
+                        for top in choice["logprobs"].get("top_logprobs") or []]
+        outputs.append(CompletionOutput(index=choice["index"], text=choice["text"], cumulative_logprob=cumulative,
+                                        logprobs=logprobs, finish_reason=choice.get("finish_reason")))
+    usage = response.get("usage") or {}
+    cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+    return RequestOutput(request_id=request_id, prompt=prompt, outputs=outputs, num_cached_tokens=cached)
+
+
+class HTTPLLM:
+    """
+    Client for an OpenAI-compatible completion server (e.g. `vllm serve`), with the same
+    `generate` as `BatchedLLM`.
+
+    Every prompt is one request. Up to `concurrency` requests are in flight at once over a
+    pool of keep-alive HTTP/1.1 connections, which persist between `generate` calls.
+    Connection errors, timeouts (`timeout` seconds per request) and transient statuses are
+    retried up to `max_retries` times with full-jitter exponential backoff.
+    """
+    # `guided_regex` is sent, but servers other than vLLM may ignore it
+    supports_guided_decoding = False
+
+    def __init__(self, base_url: str, model: str, concurrency=64, timeout=120.0, max_retries=4, backoff=0.5,
+                 api_key: Optional[str] = None, seed: Optional[int] = None):
+        url = urlsplit(base_url)
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == "https" else 80)
+        self.ssl = url.scheme == "https"
+        self.path = url.path.rstrip("/") + "/v1/completions"
+        self.model = model
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.api_key = api_key
+        self.rng = random.Random(seed)
+        self.retries = 0
+        self.connections_opened = 0
+        self._loop = asyncio.new_event_loop()
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+
+    def generate(self, prompts, sampling_params, stage: Optional[str] = None, **kwargs) -> List[RequestOutput]:
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        return self._loop.run_until_complete(self._generate_all(prompts, sampling_params))
+
+    async def _generate_all(self, prompts: List[str], sampling_params) -> List[RequestOutput]:
+        limit = asyncio.Semaphore(self.concurrency)
+
+        async def complete(idx: int, prompt: str) -> RequestOutput:
+            async with limit:
+                response = await self._post_with_retries(completion_request(self.model, prompt, sampling_params))
+            return completion_output(str(idx), prompt, response)
+
+        return list(await asyncio.gather(*(complete(idx, prompt) for idx, prompt in enumerate(prompts))))
+
+    async def _post_with_retries(self, payload: Dict) -> Dict:
+        body = json.dumps(payload).encode()
+        for attempt in range(self.max_retries + 1):
+            try:
+                status, response = await asyncio.wait_for(self._post(body), self.timeout)
+                if status == 200:
+                    return json.loads(response)
+                if status not in RETRY_STATUSES:
+                    raise HTTPError(status, response)
+                error = HTTPError(status, response)
+            except (ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError, OSError) as e:
+                error = e
+            if attempt == self.max_retries:
+                raise error
+            self.retries += 1
+            await asyncio.sleep(self.rng.uniform(0, self.backoff * 2 ** attempt))
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        # Reuse an idle connection, unless the server closed it in the meantime
+        while self._idle:
+            reader, writer = self._idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        self.connections_opened += 1
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl or None)
+
+    async def _post(self, body: bytes) -> Tuple[int, bytes]:
+        reader, writer = await self._connect()
+        try:
+            headers = [f"POST {self.path} HTTP/1.1", f"Host: {self.host}:{self.port}",
+                       "Content-Type: application/json", f"Content-Length: {len(body)}", "Connection: keep-alive"]
+            if self.api_key:
+                headers.append(f"Authorization: Bearer {self.api_key}")
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode() + body)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError("server closed the connection")
+            status = int(status_line.split()[1])
+            response_headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                response_headers[name.strip().lower()] = value.strip()
+            if response_headers.get("transfer-encoding", "").lower() == "chunked":
+                response = b""
+                while True:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                    if size == 0:
+                        await reader.readline()
+                        break
+                    response += await reader.readexactly(size)
+                    await reader.readline()
+            else:
+                response = await reader.readexactly(int(response_headers.get("content-length", 0)))
+        except BaseException:
+            # Half-read responses leave the connection unusable
+            writer.close()
+            raise
+        if response_headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            self._idle.append((reader, writer))
+        return status, response
+
+    def close(self):
+        for _, writer in self._idle:
+            writer.close()
+        self._idle.clear()
+        self._loop.run_until_complete(asyncio.sleep(0))
+        self._loop.close()
@@ -0,0 +1,130 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from mock_llm import MockGuidedDecodingParams, MockLLM, MockSamplingParams
+
+
+def openai_response(model: str, output) -> dict:
+    """A mock `RequestOutput` as an OpenAI `/v1/completions` response."""
+    choices = []
+    for completion in output.outputs:
+        logprobs = None
+        if completion.logprobs is not None:
+            logprobs = {"tokens": [], "token_logprobs": [],
+                        "top_logprobs": [{lp.decoded_token: lp.logprob for lp in position.values()}
+                                         for position in completion.logprobs]}
+            for token_id, position in zip(completion.token_ids, completion.logprobs):
+                logprobs["tokens"].append(position[token_id].decoded_token)
+                logprobs["token_logprobs"].append(position[token_id].logprob)
+        choices.append({"index": completion.index, "text": completion.text, "logprobs": logprobs,
+                        "finish_reason": completion.finish_reason})
+    completion_tokens = sum(len(completion.token_ids) for completion in output.outputs)
+    return {"object": "text_completion", "model": model, "choices": choices,
+            "usage": {"prompt_tokens": len(output.prompt_token_ids), "completion_tokens": completion_tokens,
+                      "prompt_tokens_details": {"cached_tokens": output.num_cached_tokens}}}
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Local stand-in for an OpenAI-compatible completion server, for load-testing `HTTPLLM`
+    without a network or GPU. Answers come from `MockLLM`, or are replayed in turn from
+    `canned` texts. `delay` seconds are added to every request and a `failure_rate` share of
+    them fail with 503, to exercise the client's concurrency and retries.
+    """
+    daemon_threads = True
+
+    def __init__(self, port=0, seed=0, canned: Optional[List[str]] = None, delay=0.0, failure_rate=0.0):
+        super().__init__(("127.0.0.1", port), StubHandler)
+        self.llm = MockLLM(seed=seed)
+        self.canned = canned
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> "StubServer":
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients that time out hang up mid-response; that's expected under load tests
+        pass
+
+    def complete(self, request: dict) -> Optional[dict]:
+        """The response to one completion request, or None to fail it."""
+        with self.lock:
+            self.requests += 1
+            if self.rng.random() < self.failure_rate:
+                return None
+            if self.canned is not None:
+                text = self.canned[(self.requests - 1) % len(self.canned)]
+                return {"object": "text_completion", "model": request.get("model"),
+                        "choices": [{"index": 0, "text": text, "logprobs": None, "finish_reason": "stop"}]}
+            guided = MockGuidedDecodingParams(regex=request["guided_regex"]) if "guided_regex" in request else None
+            params = MockSamplingParams(temperature=request.get("temperature", 1.0), top_p=request.get("top_p", 1.0),
+                                        max_tokens=request.get("max_tokens", 16), n=request.get("n", 1),
+                                        logprobs=request.get("logprobs"), seed=request.get("seed"),
+                                        stop=request.get("stop"), guided_decoding=guided)
+            output = self.llm.generate([request["prompt"]], params)[0]
+        return openai_response(request.get("model"), output)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections, like a real inference server
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        response = self.server.complete(request)
+        status, body = (200, json.dumps(response).encode()) if response is not None else (503, b"overloaded")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve mock or canned completions on an OpenAI-compatible API.")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--canned', default=None, help="JSON list of completion texts to replay in turn")
+    parser.add_argument('--delay', type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="Share of requests answered with 503")
+    args = parser.parse_args()
+    canned = None
+    if args.canned:
+        with open(args.canned) as f:
+            canned = json.load(f)
+    server = StubServer(args.port, args.seed, canned, args.delay, args.failure_rate)
+    print(f"Serving on {server.url}/v1/completions")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
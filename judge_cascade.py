@@ -0,0 +1,247 @@
+import argparse
+import re
+import sqlite3
+import zlib
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+
+from property_updates import JudgeScoring, llm_judge, llm_judge_scores, parse_grades
+from stage_config import stage_profiles
+from surrogate import GRADES, _softmax
+
+WORD_RE = re.compile(r"\w+")
+
+
+def _hash(feature: str, num_features: int) -> int:
+    # Python's str hash is salted per process; saved weights need a stable one
+    return 1 + zlib.crc32(feature.encode()) % (num_features - 1)
+
+
+def text_features(question: str, reply: str, final_response: str, num_features: int) -> List[int]:
+    """
+    Hashed feature ids of one conversation: unigrams and bigrams of the reply and of the final
+    response, each in its own namespace, and the words both agents used. Id 0 is the bias.
+    """
+    reply_words = WORD_RE.findall(reply.lower())
+    final_words = WORD_RE.findall(final_response.lower())
+    features = ["bias"]
+    for namespace, words in (("r", reply_words), ("f", final_words)):
+        features += [f"{namespace}:{word}" for word in words]
+        features += [f"{namespace}:{a} {b}" for a, b in zip(words, words[1:])]
+    features += [f"both:{word}" for word in set(reply_words) & set(final_words)]
+    return [0] + [_hash(feature, num_features) for feature in features[1:]]
+
+
+def featurize(questions: Sequence[str], replies: Sequence[str], final_responses: Sequence[str],
+              num_features: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sparse rows of hashed n-gram features as (row, column, value) arrays. Values are log
+    counts, L2-normalised per row apart from the bias.
+    """
+    rows, cols, vals = [], [], []
+    for row, texts in enumerate(zip(questions, replies, final_responses)):
+        ids, counts = np.unique(text_features(*texts, num_features), return_counts=True)
+        values = np.log1p(counts).astype(np.float32)
+        text = ids != 0
+        norm = np.linalg.norm(values[text])
+        values[text] /= norm if norm else 1.0
+        values[~text] = 1.0
+        rows.append(np.full(len(ids), row, dtype=np.int64))
+        cols.append(ids)
+        vals.append(values)
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+
+
+class CascadeClassifier:
+    """
+    Cheap CPU judge: multinomial logistic regression over hashed n-gram features of the reply
+    and the final response, giving P(grade) for the grades -1, 0 and 1.
+    """
+
+    def __init__(self, weights: np.ndarray):
+        self.weights = np.asarray(weights, dtype=np.float32)
+
+    @property
+    def num_features(self) -> int:
+        return self.weights.shape[0]
+
+    def _logits(self, features, num_rows: int) -> np.ndarray:
+        rows, cols, vals = features
+        return np.stack([np.bincount(rows, weights=vals * self.weights[cols, grade], minlength=num_rows)
+                         for grade in range(len(GRADES))], axis=1)
+
+    def probabilities(self, questions, replies, final_responses) -> np.ndarray:
+        features = featurize(questions, replies, final_responses, self.num_features)
+        return _softmax(self._logits(features, len(replies)))
+
+    @classmethod
+    def fit(cls, questions, replies, final_responses, grades, num_features=1 << 16, l2=1e-4, lr=2.0,
+            steps=300) -> "CascadeClassifier":
+        """Fits the weights by gradient descent on the L2-regularised cross entropy."""
+        features = featurize(questions, replies, final_responses, num_features)
+        rows, cols, vals = features
+        targets = (np.asarray(grades)[:, None] == GRADES[None, :]).astype(np.float32)
+        model = cls(np.zeros((num_features, len(GRADES)), dtype=np.float32))
+        for _ in range(steps):
+            error = (_softmax(model._logits(features, len(targets))) - targets) / len(targets)
+            grad = np.stack([np.bincount(cols, weights=vals * error[rows, grade], minlength=num_features)
+                             for grade in range(len(GRADES))], axis=1)
+            model.weights -= lr * (grad + l2 * model.weights).astype(np.float32)
+        return model
+
+    def save(self, path: str):
+        np.savez_compressed(path, weights=self.weights, grades=GRADES)
+
+    @classmethod
+    def load(cls, path: str) -> "CascadeClassifier":
+        saved = np.load(path)
+        assert saved["grades"].tolist() == GRADES.tolist(), "Cascade weights were fitted on different grades"
+        return cls(saved["weights"])
+
+
+def evaluate(classifier: CascadeClassifier, questions, replies, final_responses, grades,
+             thresholds: Sequence[float]) -> List[dict]:
+    """
+    Accuracy of the classifier alone, and for each confidence threshold the share of pairs it
+    would judge locally and its accuracy on those.
+    """
+    probs = classifier.probabilities(questions, replies, final_responses)
+    correct = GRADES[probs.argmax(axis=1)] == np.asarray(grades)
+    results = []
+    for threshold in thresholds:
+        local = probs.max(axis=1) >= threshold
+        results.append({"threshold": threshold, "accuracy": float(correct.mean()) if len(correct) else 0.0,
+                        "local share": float(local.mean()) if len(local) else 0.0,
+                        "local accuracy": float(correct[local].mean()) if local.any() else 0.0})
+    return results
+
+
+class JudgeCascade:
+    """
+    Judges every pair with the classifier and escalates only the pairs it isn't confident
+    about (max P(grade) below `threshold`) to the LLM judge. Counts of locally judged and
+    escalated pairs add up until `reset`; `last_escalated` marks the pairs of the last call
+    that went to the LLM.
+    """
+
+    def __init__(self, classifier: CascadeClassifier, threshold=0.9):
+        self.classifier = classifier
+        self.threshold = threshold
+        self.local = 0
+        self.escalated = 0
+        self.last_escalated = np.zeros(0, dtype=bool)
+
+    def judge(self, llm, sampling_params, final_response: List[str], all_questions, all_replies,
+              scoring: Optional[JudgeScoring] = None, chain_prefixes: Optional[List[str]] = None,
+              count=True) -> torch.Tensor:
+        """
+        Agreement score of every pair, like `parse_grades(llm_judge(...))` or `llm_judge_scores`.
+        Without `count`, the pairs aren't added to the counts, e.g. for judgements that may not
+        be the final one.
+        """
+        probs = self.classifier.probabilities(all_questions, all_replies, final_response)
+        escalate = np.flatnonzero(probs.max(axis=1) < self.threshold) if len(probs) else np.zeros(0, dtype=np.int64)
+        if scoring is not None:
+            # The same movement rule as the escalated pairs get from the LLM judge
+            agreements = scoring.agreements_from_probabilities(probs)
+        else:
+            agreements = torch.from_numpy(GRADES[probs.argmax(axis=1)] if len(probs) else GRADES[:0])
+        self.last_escalated = np.zeros(len(probs), dtype=bool)
+        self.last_escalated[escalate] = True
+        if count:
+            self.record(self.last_escalated)
+        if len(escalate):
+            idx = escalate.tolist()
+            subset = ([final_response[i] for i in idx], [all_questions[i] for i in idx], [all_replies[i] for i in idx])
+            prefixes = [chain_prefixes[i] for i in idx] if chain_prefixes is not None else None
+            if scoring is not None:
+                llm_agreements = llm_judge_scores(llm, sampling_params, *subset, scoring, chain_prefixes=prefixes)
+            else:
+                llm_agreements = parse_grades(llm_judge(llm, sampling_params, *subset, chain_prefixes=prefixes),
+                                              strict=stage_profiles.strict("judge"))
+            agreements = agreements.to(llm_agreements.dtype)
+            agreements[torch.from_numpy(escalate)] = llm_agreements
+        return agreements
+
+    def record(self, escalated: np.ndarray):
+        """Counts judged pairs, `escalated` marking the ones the LLM judged."""
+        self.local += int((~escalated).sum())
+        self.escalated += int(escalated.sum())
+
+    def stats(self) -> dict:
+        return {"local": self.local, "escalated": self.escalated}
+
+    def reset(self):
+        self.local = 0
+        self.escalated = 0
+
+
+def load_conversations(db_paths: Sequence[str]) -> Tuple[List[str], List[str], List[str], np.ndarray]:
+    """Questions, replies, final responses and judge grades of the logged conversations."""
+    questions, replies, final_responses, grades = [], [], [], []
+    for db_path in db_paths:
+        with sqlite3.connect(db_path) as conn:
+            rows = conn.execute("SELECT question, reply, final_response, agreement_score FROM ConversationLog "
+                                "ORDER BY iteration_idx, rowid").fetchall()
+        for question, reply, final_response, agreement_score in rows:
+            # Failed parses and expected (fractional) agreements aren't grades
+            if agreement_score not in GRADES:
+                continue
+            questions.append(question)
+            replies.append(reply)
+            final_responses.append(final_response)
+            grades.append(int(agreement_score))
+    return questions, replies, final_responses, np.asarray(grades, dtype=np.int64)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train or evaluate the cascade judge on logged conversations. Train "
+                                                 "on runs without the cascade, whose grades all come from the LLM.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    train = subparsers.add_parser("train", help="Fit the classifier and report it on a held-out split")
+    train.add_argument('--db', nargs='+', required=True, help="Paths to simulations' logs.db")
+    train.add_argument('--out', required=True, help="Where to write the weights (.npz)")
+    train.add_argument('--num-features', type=int, default=1 << 16, help="Hashed feature dimensions")
+    train.add_argument('--l2', type=float, default=1e-4, help="L2 regularisation strength")
+    train.add_argument('--steps', type=int, default=300, help="Gradient descent steps")
+    train.add_argument('--holdout', type=float, default=0.2, help="Share of conversations held out for evaluation")
+    train.add_argument('--seed', type=int, default=0)
+    evaluate_parser = subparsers.add_parser("evaluate", help="Report a fitted classifier on logged conversations")
+    evaluate_parser.add_argument('--db', nargs='+', required=True, help="Paths to simulations' logs.db")
+    evaluate_parser.add_argument('--model', required=True, help="Weights written by `train`")
+    for command in (train, evaluate_parser):
+        command.add_argument('--thresholds', type=float, nargs='+', default=[0.6, 0.7, 0.8, 0.9, 0.95],
+                             help="Confidence thresholds to report the local share and accuracy for")
+    args = parser.parse_args()
+
+    questions, replies, final_responses, grades = load_conversations(args.db)
+    print(f"Loaded {len(grades)} judged conversations")
+    if args.command == "train":
+        order = np.random.default_rng(args.seed).permutation(len(grades))
+        num_holdout = int(len(grades) * args.holdout)
+        held_out, training = order[:num_holdout], order[num_holdout:]
+
+        def select(idx):
+            return [questions[i] for i in idx], [replies[i] for i in idx], [final_responses[i] for i in idx], \
+                grades[idx]
+
+        classifier = CascadeClassifier.fit(*select(training), num_features=args.num_features, l2=args.l2,
+                                           steps=args.steps)
+        classifier.save(args.out)
+        evaluation = select(held_out) if num_holdout else select(training)
+    else:
+        classifier = CascadeClassifier.load(args.model)
+        evaluation = questions, replies, final_responses, grades
+    for result in evaluate(classifier, *evaluation, args.thresholds):
+        print(f"threshold {result['threshold']:.2f}: judged locally {result['local share']:.1%} "
+              f"with accuracy {result['local accuracy']:.3f} (overall accuracy {result['accuracy']:.3f})")
+
+
+if __name__ == "__main__":
+    main()
+
+# `python judge_cascade.py train --db "simulations/<timestamp>/simulation_logs/logs.db" --out cascade.npz`
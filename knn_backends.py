@@ -0,0 +1,187 @@
+import numpy as np
+import torch
+
+# Upper bound on the number of (query, candidate) distances evaluated at once by the grid backend.
+# Keeps peak memory O(N*k) even when the uniform grid is unevenly populated.
+MAX_GRID_CANDIDATES = 1 << 22
+
+
+def _as_numpy(locs):
+    if isinstance(locs, torch.Tensor):
+        locs = locs.detach().cpu().numpy()
+    return np.ascontiguousarray(locs, dtype=np.float32)
+
+
+def _drop_self(indices, k, n):
+    """
+    Removes each row's own index from a (n, k+1) neighbor table and trims it to k columns.
+    Rows that don't contain themselves (duplicate locations) drop their farthest neighbor instead.
+    Missing neighbors are reported as -1.
+    """
+    indices = np.where((indices < 0) | (indices >= n), -1, indices)
+    is_self = indices == np.arange(n)[:, None]
+    # Stable sort moves the self column to the back and keeps the distance order of the rest
+    keep = np.argsort(is_self, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(indices, keep, axis=1)
+
+
+def grid_size(num_agents, k):
+    """
+    Number of cells per side so that each cell holds about k / 2 agents on average.
+    The k-th neighbor of a uniformly placed agent then usually lies within one cell width.
+    """
+    return max(1, int(np.sqrt(2 * num_agents / max(k, 1))))
+
+
+def bucket_points(pts, g):
+    """
+    Hashes points in [0, 1] x [0, 1] into a g x g uniform grid.
+
+    Returns:
+        cell_of: (N,) cell id of each point (row-major over x, then y)
+        order: (N,) point ids sorted by cell id
+        cell_start: (g*g + 1,) offsets into `order`, cell c holds order[cell_start[c]:cell_start[c + 1]]
+    """
+    cell_xy = np.clip((pts * g).astype(np.int64), 0, g - 1)
+    cell_of = cell_xy[:, 0] * g + cell_xy[:, 1]
+    order = np.argsort(cell_of, kind="stable")
+    cell_start = np.zeros(g * g + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cell_of, minlength=g * g), out=cell_start[1:])
+    return cell_of, order, cell_start
+
+
+def _block_ranges(pts, queries, g, cell_start, radius):
+    """
+    Candidates of each query: the points in the (2r+1) x (2r+1) block of cells around its cell.
+    A block column is a contiguous run of cell ids, so the candidates are (2r+1) slices of the
+    sorted point order, returned as their (Q, 2r+1) start offsets and lengths.
+    """
+    q_xy = np.clip((pts[queries] * g).astype(np.int64), 0, g - 1)
+    col = q_xy[:, :1] + np.arange(-radius, radius + 1)[None, :]
+    valid = (col >= 0) & (col < g)
+    col = np.clip(col, 0, g - 1)
+    lo = cell_start[col * g + np.maximum(q_xy[:, 1:] - radius, 0)]
+    hi = cell_start[col * g + np.minimum(q_xy[:, 1:] + radius, g - 1) + 1]
+    return lo, np.where(valid, hi - lo, 0)
+
+
+def _block_knn(pts, queries, k, order, lo, lengths):
+    """
+    Exact k nearest neighbors of `queries` among their block candidates.
+    The ragged candidate slices are laid out in a (Q, W) matrix padded with -1.
+    """
+    lo, lengths = lo.ravel(), lengths.ravel()
+    totals = lengths.reshape(len(queries), -1).sum(axis=1)
+    width = max(int(totals.max()), k)
+    flat = np.repeat(lo, lengths) + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    q_of = np.repeat(np.arange(len(queries)), totals)
+    column = np.arange(len(flat)) - np.repeat(np.cumsum(totals) - totals, totals)
+    cand = np.full((len(queries), width), -1, dtype=np.int64)
+    cand[q_of, column] = order[flat]
+
+    d2 = np.zeros(cand.shape, dtype=np.float32)
+    for dim in range(pts.shape[1]):
+        coord = pts[:, dim]
+        d2 += (coord[cand] - coord[queries][:, None]) ** 2
+    # Padding and the query itself are never neighbors
+    d2[(cand < 0) | (cand == queries[:, None])] = np.inf
+
+    nearest = np.argpartition(d2, k - 1, axis=1)[:, :k] if width > k else np.arange(width)[None, :].repeat(len(queries), 0)
+    nearest = np.take_along_axis(nearest, np.argsort(np.take_along_axis(d2, nearest, axis=1), axis=1), axis=1)
+    dists = np.sqrt(np.take_along_axis(d2, nearest, axis=1))
+    neighbors = np.where(np.isfinite(dists), np.take_along_axis(cand, nearest, axis=1), -1)
+    return neighbors, dists
+
+
+def grid_knn_rows(pts, rows, k, g, order, cell_start, radius=1):
+    """
+    k nearest neighbors of the points `rows` using an existing grid bucketing.
+
+    A block of radius r around a query contains every point within r / g of it, so a row is
+    final once its k-th neighbor lies inside that distance. Unfinished rows retry with a
+    doubled radius; a block covering the whole grid is always final.
+
+    Returns the (len(rows), k) neighbor table and the block radius each row needed.
+    """
+    neighbors = np.full((len(rows), k), -1, dtype=np.int64)
+    radii = np.full(len(rows), radius, dtype=np.int64)
+    pending = np.arange(len(rows))
+    while pending.size:
+        lo, lengths = _block_ranges(pts, rows[pending], g, cell_start, radius)
+        # Process queries with similar block sizes together, about MAX_GRID_CANDIDATES distances at a time
+        by_size = np.argsort(lengths.sum(axis=1), kind="stable")
+        pending, lo, lengths = pending[by_size], lo[by_size], lengths[by_size]
+        totals = np.maximum(lengths.sum(axis=1), k)
+
+        unfinished = []
+        start = 0
+        while start < len(pending):
+            end = min(len(pending), start + max(1, MAX_GRID_CANDIDATES // int(totals[start])))
+            while end - start > 1 and (end - start) * int(totals[end - 1]) > MAX_GRID_CANDIDATES:
+                end = start + (end - start) // 2
+            chunk = pending[start:end]
+            nbrs, dists = _block_knn(pts, rows[chunk], k, order, lo[start:end], lengths[start:end])
+            neighbors[chunk] = nbrs
+            radii[chunk] = radius
+            unfinished.append(chunk[dists[:, -1] > radius / g])
+            start = end
+        if radius >= g - 1:
+            break
+        pending = np.concatenate(unfinished)
+        radius *= 2
+    return neighbors, radii
+
+
+def knn_grid(locs, k):
+    """k nearest neighbors through a uniform grid / spatial hash over [0, 1] x [0, 1]."""
+    pts = _as_numpy(locs)
+    n = len(pts)
+    g = grid_size(n, k)
+    _, order, cell_start = bucket_points(pts, g)
+    neighbors, _ = grid_knn_rows(pts, np.arange(n), k, g, order, cell_start)
+    return torch.from_numpy(neighbors)
+
+
+def knn_kdtree(locs, k):
+    """k nearest neighbors through a scipy KD-tree."""
+    from scipy.spatial import cKDTree
+
+    pts = _as_numpy(locs)
+    n = len(pts)
+    _, indices = cKDTree(pts).query(pts, k=k + 1, workers=-1)
+    return torch.from_numpy(_drop_self(indices.reshape(n, k + 1).astype(np.int64), k, n))
+
+
+def knn_faiss(locs, k):
+    """k nearest neighbors of every agent with a single FAISS `index.search` call."""
+    import faiss
+
+    pts = _as_numpy(locs)
+    n, d = pts.shape
+    index = faiss.IndexFlatL2(d)
+    index.add(pts)
+    _, indices = index.search(pts, k + 1)
+    return torch.from_numpy(_drop_self(indices.astype(np.int64), k, n))
+
+
+def knn_brute(locs, k, batch_size=10000):
+    """Exact k nearest neighbors from row blocks of the distance matrix, never the whole matrix."""
+    n = locs.shape[0]
+    neighbors = torch.empty((n, min(k + 1, n)), dtype=torch.long)
+    for i in range(0, n, batch_size):
+        end = min(i + batch_size, n)
+        dists = torch.cdist(locs[i:end], locs, compute_mode="donot_use_mm_for_euclid_dist")
+        neighbors[i:end] = torch.topk(dists, neighbors.shape[1], dim=1, largest=False).indices.cpu()
+    if neighbors.shape[1] < k + 1:
+        neighbors = torch.cat([neighbors, torch.full((n, k + 1 - neighbors.shape[1]), -1)], dim=1)
+    return torch.from_numpy(_drop_self(neighbors.numpy(), k, n))
+
+
+# Every backend maps an (N, 2) location tensor and k to an (N, k) LongTensor of neighbor ids,
+# nearest first, padded with -1 when fewer than k other agents exist.
+KNN_BACKENDS = {
+    "brute": knn_brute,
+    "grid": knn_grid,
+    "kdtree": knn_kdtree,
+    "faiss": knn_faiss,
+}
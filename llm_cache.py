@@ -0,0 +1,141 @@
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional
+
+from llm_outputs import RequestOutput
+
+# Sampling parameters that change what gets generated
+SAMPLING_KEYS = ("n", "best_of", "temperature", "top_p", "top_k", "min_p", "presence_penalty", "frequency_penalty",
+                 "repetition_penalty", "seed", "stop", "stop_token_ids", "max_tokens", "min_tokens", "logprobs",
+                 "guided_decoding")
+# SQLite caps the number of bound parameters per statement
+LOOKUP_CHUNK = 900
+
+
+def sampling_key(sampling_params) -> Dict:
+    return {name: getattr(sampling_params, name, None) for name in SAMPLING_KEYS}
+
+
+class CachedLLM:
+    """
+    Content-addressed, on-disk cache around an LLM's `generate`.
+
+    Outputs are stored in SQLite under sha256(prompt, sampling parameters, model, seed). A
+    `generate` call looks all prompts up at once and only sends the misses to the wrapped LLM.
+    Greedy calls (temperature 0) are always cached, and each distinct prompt is sent once.
+    Sampled calls are only cached for the stages listed in `cache_stages`, where reusing a
+    sample across reruns is fine; there the k-th copy of a prompt within a call is its own
+    entry, so duplicates within a run still get a sample each.
+    The least recently used entries are evicted once the stored outputs exceed `max_bytes`.
+    """
+
+    def __init__(self, llm, path: str, model: str, seed=0, max_bytes=1 << 30, cache_stages: Iterable[str] = ()):
+        self.llm = llm
+        self.path = path
+        self.model = model
+        self.seed = seed
+        self.max_bytes = max_bytes
+        self.cache_stages = set(cache_stages)
+        self.hits = 0
+        self.misses = 0
+        with sqlite3.connect(self.path) as conn:
+            conn.execute("""
+            CREATE TABLE IF NOT EXISTS ResponseCache (
+                key TEXT PRIMARY KEY,
+                response TEXT,
+                size INT,
+                last_used REAL
+            );
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS ResponseCacheLastUsed ON ResponseCache (last_used)")
+            self.size = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ResponseCache").fetchone()[0]
+
+    def __getattr__(self, name):
+        # Everything but `generate` (tokenizer, engine, ...) comes from the wrapped LLM
+        return getattr(self.llm, name)
+
+    def key(self, prompt: str, sampling_params, copy_idx=0) -> str:
+        entry = {"prompt": prompt, "sampling": sampling_key(sampling_params), "model": self.model, "seed": self.seed}
+        if copy_idx:
+            entry["copy"] = copy_idx
+        payload = json.dumps(entry, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def is_cacheable(self, sampling_params, stage: Optional[str]) -> bool:
+        return getattr(sampling_params, "temperature", 1.0) == 0 or stage in self.cache_stages
+
+    def generate(self, prompts, sampling_params, stage: Optional[str] = None, **kwargs) -> list:
+        if isinstance(prompts, str):
+            return self.generate([prompts], sampling_params, stage=stage, **kwargs)
+        if not self.is_cacheable(sampling_params, stage):
+            return self.llm.generate(prompts, sampling_params, stage=stage, **kwargs)
+
+        if getattr(sampling_params, "temperature", 1.0) == 0:
+            keys = [self.key(prompt, sampling_params) for prompt in prompts]
+        else:
+            # Number the copies of each prompt, so they don't all share one sample
+            copies: Dict[str, int] = {}
+            keys = []
+            for prompt in prompts:
+                keys.append(self.key(prompt, sampling_params, copies.get(prompt, 0)))
+                copies[prompt] = copies.get(prompt, 0) + 1
+        cached = self._lookup(set(keys))
+        # Send every missing entry once; greedy duplicates share theirs
+        missing = {}
+        for key, prompt in zip(keys, prompts):
+            if key not in cached:
+                missing.setdefault(key, prompt)
+        num_missing = sum(key not in cached for key in keys)
+        self.hits += len(keys) - num_missing
+        self.misses += num_missing
+
+        if missing:
+            outputs = self.llm.generate(list(missing.values()), sampling_params, stage=stage, **kwargs)
+            fresh = {key: RequestOutput.from_output(output).to_dict() for key, output in zip(missing, outputs)}
+            self._store(fresh)
+            cached.update(fresh)
+        return [RequestOutput.from_dict(str(i), prompt, cached[key]) for i, (key, prompt) in enumerate(zip(keys, prompts))]
+
+    def _lookup(self, keys: set) -> Dict[str, dict]:
+        keys = list(keys)
+        found = {}
+        with sqlite3.connect(self.path) as conn:
+            for i in range(0, len(keys), LOOKUP_CHUNK):
+                chunk = keys[i: i + LOOKUP_CHUNK]
+                marks = ",".join("?" * len(chunk))
+                rows = conn.execute(f"SELECT key, response FROM ResponseCache WHERE key IN ({marks})", chunk)
+                found.update((key, json.loads(response)) for key, response in rows)
+            now = time.time()
+            conn.executemany("UPDATE ResponseCache SET last_used = ? WHERE key = ?", ((now, key) for key in found))
+        return found
+
+    def _store(self, responses: Dict[str, dict]):
+        now = time.time()
+        rows = [(key, text, len(text), now) for key, text in
+                ((key, json.dumps(response)) for key, response in responses.items())]
+        with sqlite3.connect(self.path) as conn:
+            # Only misses are stored, so no existing entry gets replaced
+            conn.executemany("INSERT OR REPLACE INTO ResponseCache (key, response, size, last_used) "
+                             "VALUES (?, ?, ?, ?)", rows)
+            self.size += sum(row[2] for row in rows)
+            if self.size > self.max_bytes:
+                self._evict(conn)
+
+    def _evict(self, conn):
+        """Drops the least recently used entries until the cache fits into `max_bytes` again."""
+        excess = self.size - self.max_bytes
+        evicted, freed = [], 0
+        for key, size in conn.execute("SELECT key, size FROM ResponseCache ORDER BY last_used, key"):
+            if freed >= excess:
+                break
+            evicted.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM ResponseCache WHERE key = ?", evicted)
+        self.size -= freed
+
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit rate": self.hits / total if total else 0.0,
+                "bytes": self.size}
@@ -0,0 +1,72 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+
+@dataclass
+class Logprob:
+    """Same fields as vLLM's `Logprob`."""
+    logprob: float
+    rank: Optional[int] = None
+    decoded_token: Optional[str] = None
+
+
+def logprobs_to_data(logprobs) -> Optional[List[list]]:
+    """Per-token {token_id: Logprob} dicts as JSON-friendly [[token_id, logprob, rank, decoded_token], ...] lists."""
+    if logprobs is None:
+        return None
+    return [[[int(token_id), lp.logprob, lp.rank, lp.decoded_token] for token_id, lp in position.items()]
+            for position in logprobs]
+
+
+def logprobs_from_data(data) -> Optional[List[Dict[int, Logprob]]]:
+    if data is None:
+        return None
+    return [{token_id: Logprob(logprob, rank, decoded) for token_id, logprob, rank, decoded in position}
+            for position in data]
+
+
+@dataclass
+class CompletionOutput:
+    """Same fields the simulation reads from vLLM's `CompletionOutput`."""
+    index: int
+    text: str
+    token_ids: List[int] = field(default_factory=list)
+    cumulative_logprob: Optional[float] = None
+    # One {token_id: logprob} dict per generated token when logprobs were requested
+    logprobs: Optional[List[Dict[int, Any]]] = None
+    finish_reason: Optional[str] = "stop"
+
+
+@dataclass
+class RequestOutput:
+    """Same fields the simulation reads from vLLM's `RequestOutput`."""
+    request_id: str
+    prompt: str
+    outputs: List[CompletionOutput]
+    prompt_token_ids: List[int] = field(default_factory=list)
+    finished: bool = True
+    num_cached_tokens: Optional[int] = None
+
+    def to_dict(self) -> dict:
+        return {"outputs": [{"text": o.text, "token_ids": list(o.token_ids), "cumulative_logprob": o.cumulative_logprob,
+                             "logprobs": logprobs_to_data(o.logprobs), "finish_reason": o.finish_reason}
+                            for o in self.outputs]}
+
+    @classmethod
+    def from_output(cls, output) -> "RequestOutput":
+        """Copies a vLLM `RequestOutput` (or this class) into plain data."""
+        return cls(request_id=str(output.request_id), prompt=output.prompt,
+                   outputs=[CompletionOutput(index=o.index, text=o.text, token_ids=list(o.token_ids),
+                                             cumulative_logprob=o.cumulative_logprob,
+                                             logprobs=logprobs_from_data(logprobs_to_data(o.logprobs)),
+                                             finish_reason=o.finish_reason)
+                            for o in output.outputs],
+                   prompt_token_ids=list(output.prompt_token_ids or []),
+                   num_cached_tokens=getattr(output, "num_cached_tokens", None))
+
+    @classmethod
+    def from_dict(cls, request_id: str, prompt: str, data: dict) -> "RequestOutput":
+        # Entries cached before logprobs were kept have no "logprobs" key
+        return cls(request_id=request_id, prompt=prompt,
+                   outputs=[CompletionOutput(index=i, **{**o, "logprobs": logprobs_from_data(o.get("logprobs"))})
+                            for i, o in enumerate(data["outputs"])])
@@ -0,0 +1,136 @@
+import multiprocessing as mp
+import os
+import queue
+from typing import Callable, Dict, Iterator, List, Optional
+
+from llm_outputs import RequestOutput
+from token_batching import estimate_lengths, shard_by_load
+
+
+def _serve(factory: Callable, requests, results, worker_idx: int, env: Dict[str, str]):
+    """Worker process: builds one replica and answers `generate` jobs until it gets None."""
+    os.environ.update(env)
+    llm = factory()
+    while True:
+        job = requests.get()
+        if job is None:
+            break
+        job_id, prompts, sampling_params, kwargs = job
+        try:
+            outputs = [RequestOutput.from_output(output) for output in llm.generate(prompts, sampling_params, **kwargs)]
+            results.put((worker_idx, job_id, outputs, None))
+        except Exception as e:
+            results.put((worker_idx, job_id, None, repr(e)))
+
+
+class BackendPool:
+    """
+    Data-parallel pool of LLM replicas, one per worker process.
+
+    `generate` splits the prompts into one contiguous shard per worker with about equal token
+    load and returns the outputs in prompt order, like a single LLM's `generate`. `stream`
+    yields them as soon as every earlier shard is done. A worker that dies is restarted and
+    its shard sent again, up to `max_restarts` times per call.
+
+    `factory` builds a replica in the worker and has to be picklable, e.g.
+    `functools.partial(MockLLM, seed=0)`. `worker_env(worker_idx)` gives environment variables
+    set in a worker before its replica is built, e.g. its CUDA_VISIBLE_DEVICES.
+    """
+
+    def __init__(self, factory: Callable, num_workers: int, max_restarts=3, poll_interval=1.0,
+                 worker_env: Optional[Callable[[int], Dict[str, str]]] = None):
+        self.factory = factory
+        # The replicas live in the workers; their class declares it
+        self.supports_guided_decoding = getattr(getattr(factory, "func", factory), "supports_guided_decoding", False)
+        self.worker_env = worker_env
+        self.max_restarts = max_restarts
+        self.poll_interval = poll_interval
+        # Fork would copy CUDA state and the parent's engine; every replica starts clean
+        self.ctx = mp.get_context("spawn")
+        self.results = self.ctx.Queue()
+        self.processes, self.requests = [], []
+        for worker_idx in range(num_workers):
+            self._start(worker_idx)
+        self.restarts = 0
+        self._job = 0
+
+    def _start(self, worker_idx: int):
+        requests = self.ctx.Queue()
+        env = self.worker_env(worker_idx) if self.worker_env is not None else {}
+        process = self.ctx.Process(target=_serve, args=(self.factory, requests, self.results, worker_idx, env),
+                                   daemon=True)
+        process.start()
+        if worker_idx < len(self.processes):
+            self.processes[worker_idx], self.requests[worker_idx] = process, requests
+        else:
+            self.processes.append(process)
+            self.requests.append(requests)
+
+    def __len__(self):
+        return len(self.processes)
+
+    def generate(self, prompts, sampling_params, **kwargs) -> List[RequestOutput]:
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        return list(self.stream(prompts, sampling_params, **kwargs))
+
+    def stream(self, prompts: List[str], sampling_params, **kwargs) -> Iterator[RequestOutput]:
+        """Outputs in prompt order, each shard's as soon as it and all shards before it are done."""
+        self._job += 1
+        job_id = self._job
+        shards = shard_by_load(estimate_lengths(prompts), len(self), getattr(sampling_params, "max_tokens", 0) or 0)
+        jobs = {}
+        for worker_idx, shard in enumerate(shards):
+            if len(shard):
+                jobs[worker_idx] = (job_id, [prompts[i] for i in shard.tolist()], sampling_params, kwargs)
+                self.requests[worker_idx].put(jobs[worker_idx])
+
+        pending = set(jobs)
+        done, restarts, next_shard = {}, 0, 0
+        while next_shard < len(shards):
+            if next_shard not in jobs or next_shard in done:
+                yield from done.pop(next_shard, [])
+                next_shard += 1
+                continue
+            try:
+                worker_idx, result_job, outputs, error = self.results.get(timeout=self.poll_interval)
+            except queue.Empty:
+                restarts += self._restart_dead(jobs, pending)
+                if restarts > self.max_restarts:
+                    raise RuntimeError(f"LLM replicas crashed {restarts} times in one call")
+                continue
+            if result_job != job_id or worker_idx not in pending:
+                # Left over from a call whose stream was abandoned, or a duplicate after a restart
+                continue
+            if error is not None:
+                raise RuntimeError(f"LLM replica {worker_idx} failed: {error}")
+            pending.discard(worker_idx)
+            done[worker_idx] = outputs
+
+    def _restart_dead(self, jobs, pending) -> int:
+        """Restarts dead workers and re-sends their shard if it was still in flight."""
+        restarted = 0
+        for worker_idx, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            print(f"LLM replica {worker_idx} exited with code {process.exitcode}, restarting it")
+            self._start(worker_idx)
+            self.restarts += 1
+            restarted += 1
+            if worker_idx in pending:
+                self.requests[worker_idx].put(jobs[worker_idx])
+        return restarted
+
+    def close(self):
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import re
+import time
+from collections import defaultdict
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, List, Optional
+
+from llm_outputs import RequestOutput
+from token_batching import estimate_lengths
+
+
+@dataclass
+class Route:
+    """
+    Where one stage's prompts go. `fallback` takes the whole call if `backend` raises;
+    `escalate` re-runs the outputs that don't follow the stage's format. `validate` is that
+    format as a regex, by default the guided-decoding regex of the call's sampling parameters.
+    """
+    backend: str
+    fallback: Optional[str] = None
+    escalate: Optional[str] = None
+    validate: Optional[str] = None
+
+
+def output_is_valid(output, sampling_params, validate: Optional[str] = None) -> bool:
+    """Whether an output's first completion matches `validate` or the call's guided-decoding regex."""
+    regex = validate or getattr(getattr(sampling_params, "guided_decoding", None), "regex", None)
+    if regex is None:
+        return True
+    completion = output.outputs[0]
+    text = completion.text.strip()
+    if completion.finish_reason == "length" and getattr(sampling_params, "max_tokens", None) == 1:
+        # Single-token scoring calls only need to start an answer, like the "-" of "-1"
+        return text != "" and any(answer.startswith(text) for answer in regex.split("|"))
+    return re.fullmatch(regex, text) is not None
+
+
+def config_digest(path: str) -> str:
+    """
+    Hash of what a router config sends where: its backends (without their costs), routes and
+    default. Outputs cached under one config must not be served under another.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    backends = {name: {key: value for key, value in spec.items() if key != "cost"}
+                for name, spec in config["backends"].items()}
+    payload = json.dumps({"backends": backends, "routes": config.get("routes", {}),
+                          "default": config.get("default", next(iter(backends)))}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class RouteStats:
+    """Calls, tokens, engine seconds and cost of one (stage, backend) route."""
+
+    def __init__(self):
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.seconds = 0.0
+        self.cost = 0.0
+        self.escalated = 0
+        self.fallbacks = 0
+
+    def report(self) -> Dict[str, float]:
+        tokens = self.prompt_tokens + self.output_tokens
+        return {"requests": self.requests, "tokens": tokens, "seconds": self.seconds,
+                "tokens per second": tokens / self.seconds if self.seconds else 0.0, "cost": self.cost,
+                "escalated": self.escalated, "fallbacks": self.fallbacks}
+
+
+class StageRouter:
+    """
+    Sends every stage's prompts to a named backend, so short structured stages (judge,
+    questionnaire) can run on a smaller model than the conversation. Has the same `generate`
+    as the backends; stages without a route go to `default`.
+
+    `costs` gives each backend's cost per engine second (e.g. its share of GPUs); the stats
+    are kept per route, i.e. per stage and the backend that actually served it.
+    """
+
+    def __init__(self, backends: Dict[str, object], routes: Dict[str, Route], default: str,
+                 costs: Optional[Dict[str, float]] = None):
+        for route in list(routes.values()) + [Route(default)]:
+            for name in (route.backend, route.fallback, route.escalate):
+                if name is not None and name not in backends:
+                    raise ValueError(f"route to unknown backend {name!r}")
+        self.backends = backends
+        self.routes = routes
+        self.default = default
+        self.costs = costs or {}
+        self.route_stats: Dict[str, RouteStats] = defaultdict(RouteStats)
+
+    @classmethod
+    def from_config(cls, path: str, build_backend: Callable[[dict], object]) -> "StageRouter":
+        """
+        Router from a JSON file like
+        {"backends": {"large": {"model": "...", "cost": 2.0}, "small": {"model": "...", "cost": 1.0}},
+         "routes": {"judge": {"backend": "small", "escalate": "large"}}, "default": "large"}.
+        `build_backend` builds a backend from its entry.
+        """
+        with open(path) as f:
+            config = json.load(f)
+        backends = {name: build_backend(spec) for name, spec in config["backends"].items()}
+        costs = {name: spec.get("cost", 1.0) for name, spec in config["backends"].items()}
+        routes = {stage: Route(**fields) for stage, fields in config.get("routes", {}).items()}
+        return cls(backends, routes, config.get("default", next(iter(backends))), costs)
+
+    @property
+    def supports_guided_decoding(self) -> bool:
+        # A stage can fall back or escalate to any of them
+        return all(getattr(backend, "supports_guided_decoding", False) for backend in self.backends.values())
+
+    def route(self, stage: Optional[str]) -> Route:
+        return self.routes.get(stage, Route(self.default))
+
+    def _generate(self, backend: str, stage: Optional[str], prompts: List[str], sampling_params, **kwargs) -> list:
+        llm = self.backends[backend]
+        # Mock backends model the time a real engine would take
+        simulated = getattr(llm, "simulated_seconds", None)
+        start = time.perf_counter()
+        outputs = [RequestOutput.from_output(output) for output in
+                   llm.generate(prompts, sampling_params, stage=stage, **kwargs)]
+        seconds = time.perf_counter() - start if simulated is None else llm.simulated_seconds - simulated
+        stats = self.route_stats[f"{stage} {backend}"]
+        stats.requests += len(prompts)
+        # Backends that don't return token ids are counted from an estimate
+        estimates = estimate_lengths(prompts)
+        stats.prompt_tokens += sum(len(output.prompt_token_ids) if output.prompt_token_ids else int(estimate)
+                                   for output, estimate in zip(outputs, estimates))
+        stats.output_tokens += sum(len(completion.token_ids or ()) for output in outputs
+                                   for completion in output.outputs)
+        stats.seconds += seconds
+        stats.cost += seconds * self.costs.get(backend, 1.0)
+        return outputs
+
+    def generate(self, prompts, sampling_params, stage: Optional[str] = None, **kwargs) -> List[RequestOutput]:
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        route = self.route(stage)
+        try:
+            outputs = self._generate(route.backend, stage, prompts, sampling_params, **kwargs)
+        except Exception as e:
+            if route.fallback is None:
+                raise
+            print(f"Backend {route.backend} failed on stage {stage} ({e!r}), falling back to {route.fallback}")
+            self.route_stats[f"{stage} {route.fallback}"].fallbacks += 1
+            outputs = self._generate(route.fallback, stage, prompts, sampling_params, **kwargs)
+        if route.escalate is not None:
+            invalid = [idx for idx, output in enumerate(outputs)
+                       if not output_is_valid(output, sampling_params, route.validate)]
+            if invalid:
+                self.route_stats[f"{stage} {route.escalate}"].escalated += len(invalid)
+                for idx, output in zip(invalid, self._generate(route.escalate, stage, [prompts[i] for i in invalid],
+                                                               sampling_params, **kwargs)):
+                    outputs[idx] = replace(output, request_id=outputs[idx].request_id)
+        return outputs
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """{"<stage> <backend>": {requests, tokens, seconds, tokens per second, cost, escalated, fallbacks}}"""
+        return {route: stats.report() for route, stats in self.route_stats.items()}
+
+    def reset_stats(self):
+        self.route_stats.clear()
+
+    def close(self):
+        for backend in self.backends.values():
+            if hasattr(backend, "close"):
+                backend.close()
@@ -2,7 +2,11 @@ from dataclasses import dataclass
 import random
 from typing import List, Literal, Generator, Tuple, Union
 
-from vllm import SamplingParams
+try:
+    from vllm import SamplingParams
+except ImportError:
+    # CPU-only setups run on the mock backend
+    from mock_llm import MockSamplingParams as SamplingParams
 
 @dataclass
 class StaticAgentProperty2:
@@ -70,7 +74,8 @@ class StaticAgentProperty2:
     ]
     _TOTAL_POP = sum(pop for _, pop in _STATES_DATA)
     _LOCATION_VALUES = [state for (state, _) in _STATES_DATA]
-    _LOCATION_WEIGHTS = [pop / _TOTAL_POP for (_, pop) in _STATES_DATA]
+    # Class-level names aren't visible inside a comprehension's body, so divide through a default argument
+    _LOCATION_WEIGHTS = (lambda total=_TOTAL_POP, data=_STATES_DATA: [pop / total for (_, pop) in data])()
 
     # --------------------------------------------------------------------
     # The rest of the distribution data follows from the real-world info:
@@ -4,31 +4,58 @@ import datetime
 from typing import List, Tuple, Any, Union
 
 import uuid
+import functools
 import torch
 import random
 import argparse
 from log_schemas import SimulationParameters, AgentLog, ConversationLog, MetricLog
-from assign_pairs import assign_pairs1
-
-from conversation import generate_conversation
-from generate_questionnaire_answer import generate_questionnaire_answer
-
-from property_updates import update_properties
+from assign_pairs import assign_pairs1, unpaired_fraction
+from spatial_index import SpatialIndex
+from social_graph import SocialGraph
+from coarsening import group_pairs, expand_questionnaire
+from activity import ActivityScheduler
+from convergence import ConvergenceMonitor
+from dataflow import get_engine, run_pipelined_stages
+from llm_cache import CachedLLM
+from llm_pool import BackendPool
+from llm_router import StageRouter, config_digest
+from http_llm import HTTPLLM
+from prompt_chaining import chain_stats
+from prompt_dedup import DedupLLM
+from prompt_layout import prefix_cache_stats
+from stage_config import stage_profiles
+
+from conversation import run_conversation, turn_stats
+from conversation_prompting import generate_initial_question_prompts
+from generate_questionnaire_answer import generate_questionnaire_answer, hard_answers, score_questionnaire_answers
+
+from property_updates import JudgeScoring, llm_judge, llm_judge_scores, parse_grades, move_agents
+from surrogate import SurrogateJudge, sample_questionnaire, influence
+from judge_cascade import CascadeClassifier, JudgeCascade
+from calculate_latent_vec_score import (expected_latent_scores, latent_scores_from_matrix,
+                                        questionnaire_res_to_latent_score)
 from starter_prompts import starter_prompts
 from generate_vizualizaitons import generate_visualization_for_subdir
 from dotenv import load_dotenv
 import numpy as np
 
-from vllm import SamplingParams
-from vllm_wrapper import BatchedLLM
+try:
+    from vllm import SamplingParams
+except ImportError:
+    # CPU-only setups run on the mock backend
+    from mock_llm import MockSamplingParams as SamplingParams
+from mock_llm import MockLLM
 
 from log_schemas import StaticAgentProperty2
+from population import ATTRIBUTE_NAMES, Population
 from qeustionnaire_questions import questionnaire_questions
 # TODO: actually use this
 
 from database_manager import SimLogger
 
 QUESTIONNAIRE_QUESTIONs = questionnaire_questions
+# Context length of the vllm engine; multi-turn conversations end before outgrowing it
+MAX_MODEL_LEN = 8000
 
 logger: SimLogger = None
 
@@ -46,10 +73,125 @@ def parse_args():
     parser.add_argument('--step-sz', type=float, required=True, help="Step size for agent movement")
     parser.add_argument('--num-iterations', type=int, required=True, help="Number of iterations for the simulation")
     parser.add_argument('--topk', type=int, required=True, help="Top-k nearest neighbors for pairing")
+    parser.add_argument('--pairing-backend', default="dense", choices=["dense", "grid", "kdtree", "faiss"],
+                        help="Neighbor search used for pairing. `dense` builds the full N*N distance matrix.")
+    parser.add_argument('--matching', default="greedy", choices=["greedy", "parallel"],
+                        help="`greedy` pairs agents one at a time, `parallel` matches all agents in vectorised rounds")
+    parser.add_argument('--match-resolve', default="mutual", choices=["mutual", "lowest_id"],
+                        help="How `parallel` matching settles conflicting proposals")
+    parser.add_argument('--incremental-index', action='store_true',
+                        help="Keep a grid neighbor index across iterations and only update the agents that moved")
+    parser.add_argument('--topology', default="spatial", choices=["spatial", "graph"],
+                        help="Pair nearest neighbors in 2-D space, or neighbors on a sparse social graph")
+    parser.add_argument('--graph-edges', default=None, help="Edge list (`src dst` per line) for --topology=graph")
+    parser.add_argument('--graph-model', default="small-world", choices=["small-world", "scale-free"],
+                        help="Random graph generated when no --graph-edges is given")
+    parser.add_argument('--graph-degree', type=int, default=10, help="Average number of ties per agent")
+    parser.add_argument('--graph-rewire-prob', type=float, default=0.1, help="Rewiring probability of small-world ties")
+    parser.add_argument('--surrogate', action='store_true',
+                        help="Replace the conversation, questionnaire and judge LLM stages with the surrogate model")
+    parser.add_argument('--surrogate-coeffs', default=None,
+                        help="Surrogate judge coefficients fitted with `surrogate.py`; hand-set defaults otherwise")
+    parser.add_argument('--surrogate-adopt-rate', type=float, default=0.1,
+                        help="Chance that an agent adopts each differing answer of a partner it agreed with")
+    parser.add_argument('--coarsen', action='store_true',
+                        help="Run the LLM once per group of pairs sharing personas, question and spatial cell")
+    parser.add_argument('--coarsen-cells', type=int, default=32, help="Grid cells per side used to group pairs")
+    parser.add_argument('--max-group-size', type=int, default=16, help="Most pairs sharing one LLM conversation")
+    parser.add_argument('--coarsen-attributes', nargs='+', default=list(ATTRIBUTE_NAMES), choices=ATTRIBUTE_NAMES,
+                        help="Persona attributes agents must share to be grouped (all of them by default)")
+    parser.add_argument('--activity-rate', type=float, default=1.0,
+                        help="Expected conversations per agent and iteration; agents are left out of the others")
+    parser.add_argument('--activity-mode', default="bernoulli", choices=["bernoulli", "poisson"],
+                        help="Independent draws every iteration, or exponential waiting times between conversations")
+    parser.add_argument('--activity-weights', default=None,
+                        help="JSON of per-attribute-value rate multipliers, e.g. {\"urbanicity\": {\"Urban\": 1.5}}")
+    parser.add_argument('--early-stop', action='store_true', help="Stop the simulation once it has converged")
+    parser.add_argument('--convergence-window', type=int, default=10,
+                        help="Number of iterations the convergence tests must hold for")
+    parser.add_argument('--agreement-tol', type=float, default=0.01,
+                        help="Largest change of the mean agreement score within the window")
+    parser.add_argument('--displacement-tol', type=float, default=1e-3,
+                        help="Largest mean agent displacement per iteration within the window")
+    parser.add_argument('--drift-tol', type=float, default=0.05,
+                        help="Largest fraction of changed nearest neighbors per iteration within the window")
+    parser.add_argument('--rewire-tol', type=float, default=0.01,
+                        help="Largest fraction of rewired social graph ties per iteration within the window")
+    parser.add_argument('--token-budget', type=int, default=None,
+                        help="Prompt + generated tokens per LLM submission; by default a whole stage is submitted at once")
+    parser.add_argument('--autotune-batching', action='store_true',
+                        help="Time a few token budgets on the first conversation prompts and keep the fastest")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Submit each pair's next LLM stage as soon as its previous one finishes, instead of "
+                             "waiting for the whole stage")
+    parser.add_argument('--cache-path', default=None, help="SQLite file caching LLM outputs across runs")
+    parser.add_argument('--cache-stages', nargs='*', default=[],
+                        choices=["initial_questionnaire", "conversation", "reply", "questionnaire", "judge"],
+                        help="Stages whose sampled (temperature > 0) outputs may be reused from the cache by later "
+                             "runs; none by default")
+    parser.add_argument('--cache-max-mb', type=float, default=1024, help="Cache size before evicting old outputs")
+    parser.add_argument('--backend', default="vllm", choices=["vllm", "mock", "http"],
+                        help="`mock` answers every stage with deterministic fake outputs on CPU, for profiling; "
+                             "`http` sends the prompts to the OpenAI-compatible server at --server-url")
+    parser.add_argument('--server-url', default="http://127.0.0.1:8000", help="Inference server for --backend=http")
+    parser.add_argument('--http-concurrency', type=int, default=64, help="Requests in flight at once with --backend=http")
+    parser.add_argument('--request-timeout', type=float, default=120.0, help="Seconds per request with --backend=http")
+    parser.add_argument('--num-replicas', type=int, default=1,
+                        help="LLM replicas, each in its own worker process (and on its own GPU with vllm); "
+                             "every stage's prompts are sharded across them by token load")
+    parser.add_argument('--router-config', default=None,
+                        help="JSON of named backends and the backend serving each stage (conversation, reply, judge, "
+                             "questionnaire, initial_questionnaire), with fallback and escalation; see llm_router.py")
+    parser.add_argument('--dedup-prompts', action='store_true',
+                        help="Send identical prompts of a stage once, with one sample per copy")
+    parser.add_argument('--stage-config', default=None,
+                        help="JSON overriding the per-stage decoding profiles, e.g. {\"judge\": {\"max_tokens\": 3}}")
+    parser.add_argument('--no-stage-profiles', action='store_true',
+                        help="Decode every stage with the shared sampling parameters and parse outputs leniently")
+    parser.add_argument('--judge-mode', default="sample", choices=["sample", "logprob"],
+                        help="`logprob` scores the judge prompt in one prefill pass from the grade token logprobs")
+    parser.add_argument('--movement-rule', default="hard", choices=["hard", "threshold", "expected"],
+                        help="With --judge-mode=logprob: move by the most likely grade, by the sign of the expected "
+                             "agreement past --movement-threshold, or by the expected agreement itself")
+    parser.add_argument('--movement-threshold', type=float, default=0.5,
+                        help="Expected agreement needed to move under --movement-rule=threshold")
+    parser.add_argument('--questionnaire-mode', default="generate", choices=["generate", "logprob"],
+                        help="`logprob` scores every questionnaire item from one token's logprobs over a shared "
+                             "persona + conversation prefix, and scores the latent vectors in expectation")
+    parser.add_argument('--turns', type=int, default=1,
+                        help="Rounds of both agents speaking; each turn extends the agents' previous prompts, so the "
+                             "prefix cache covers everything already said")
+    parser.add_argument('--stop-phrases', nargs='*', default=[],
+                        help="End a pair's conversation early once a message contains one of these")
+    parser.add_argument('--stop-on-agreement', action='store_true',
+                        help="Judge every round, with the same judge as the final judgement, and end the "
+                             "conversations of pairs that already agree")
+    parser.add_argument('--chain-prompts', action='store_true',
+                        help="Build each agent's questionnaire prompt as a continuation of its conversation prompt "
+                             "and reply, so the engine reuses their KV cache and only prefills the new turn")
+    parser.add_argument('--chain-judge', action='store_true',
+                        help="Chain the judge prompt onto the second agent's conversation as well; the judge then "
+                             "reads it under that agent's system prompt and without few-shot examples")
+    parser.add_argument('--judge-cascade', default=None,
+                        help="Classifier weights fitted with `judge_cascade.py train`; it judges every pair on CPU "
+                             "and only the pairs below --cascade-threshold go to the LLM judge")
+    parser.add_argument('--cascade-threshold', type=float, default=0.9,
+                        help="Confidence (max grade probability) the cascade classifier needs to judge a pair itself")
+    parser.add_argument('--seed', type=int, default=None, help="Seed for sampling the agent personas")
     parser.add_argument('--simulation-timestamp', default=str(datetime.datetime.now()), help="Simulation timestamp")
     parser.add_argument('--gif', action='store_true', help="Generate a gif after running the simulation.")
     parser.add_argument('--testing', action='store_true', help="Running a test without logging. ")
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.no_stage_profiles and "logprob" in (args.judge_mode, args.questionnaire_mode):
+        # The scoring modes rely on their profiles for max_tokens=1 and the logprobs
+        parser.error("--judge-mode=logprob and --questionnaire-mode=logprob need the stage profiles")
+    if args.turns < 1:
+        parser.error("--turns must be at least 1")
+    if args.pipeline and args.turns > 1:
+        parser.error("--pipeline runs single-turn conversations")
+    if args.pipeline and args.judge_cascade:
+        parser.error("--judge-cascade runs the judge after the other stages, not pipelined")
+    return args
 
 
 def log_simulation_setup(num_agents, step_sz, num_iterations, topk, model, sampling_params, scenario, starter_prompts,
@@ -66,8 +208,7 @@ def log_simulation_setup(num_agents, step_sz, num_iterations, topk, model, sampl
     save_json(sim_params_dict, setup_log_path)
 
 
-def log_simulation_init_conditions(questaionnaire_questions, static_agent_properties_lst: List[StaticAgentProperty2],
-                                   output_dir):
+def log_simulation_init_conditions(questaionnaire_questions, population: Population, output_dir):
     # TODO: Log static agent properties and other questionnaire questions. Worry about this later.
     # Log questionnaire questions
     setup_log_path = os.path.join(output_dir, "questionnaire_questions.txt")
@@ -75,47 +216,44 @@ def log_simulation_init_conditions(questaionnaire_questions, static_agent_proper
         f.write("\n".join(questaionnaire_questions))
 
     # Log static agent properties
-    for agent_id, static_agent_property in enumerate(static_agent_properties_lst):
-        logger.insert_agent_properties(agent_id=agent_id, age=static_agent_property.age,
-                                       gender=static_agent_property.gender,
-                                       location=static_agent_property.location,
-                                       urbanicity=static_agent_property.urbanicity,
-                                       ethnicity=static_agent_property.ethnicity,
-                                       education=static_agent_property.education)
+    logger.insert_agent_properties_many(population.records())
     return
 
 
 def log_agents(iter_idx, agent_locs: List[Tuple[int, int]], questionnaire_r_lst: List[str], log_dir,
-               latent_attributes: List[List[Union[int, float]]]):
+               latent_attributes: List[List[Union[int, float]]], verbose=True):
     # Receives a list of agents, their properties (locations, boolean values)
-
+    rows = []
     for agent_id, (location, questionnaire_r, latent_attribute) in enumerate(zip(agent_locs, questionnaire_r_lst, latent_attributes)):
-        AL = AgentLog(agent_id, iter_idx, location,
-                      questionnaire_r, latent_attribute)
-        print(f"At iteration {AL.iteration_idx}, agent {AL.id} is at position {AL.position}")
-        # database log
-        logger.insert_agent_log(agent_id, iter_idx, location,
-                             questionnaire_r, latent_attribute)
+        if verbose:
+            AL = AgentLog(agent_id, iter_idx, location,
+                          questionnaire_r, latent_attribute)
+            print(f"At iteration {AL.iteration_idx}, agent {AL.id} is at position {AL.position}")
+        rows.append((agent_id, iter_idx, location, questionnaire_r, latent_attribute))
+    # database log, one transaction per iteration
+    logger.insert_agent_logs_many(rows)
 
 
 def log_conversations(iter_idx, curr_pairs, curr_questions, curr_replies, final_responses: List[str], curr_agreements,
-                      log_dir):
+                      log_dir, verbose=True):
     # Log the list of pairs and questions
     # Log the replies and final responses
+    rows = []
     for conv_pair, question, reply, final_response, agreement_score in zip(curr_pairs, curr_questions, curr_replies,
                                                                            final_responses,
                                                                            curr_agreements):
         conv_id = uuid.uuid4()
         CL = ConversationLog(id=str(conv_id), conv_pair=conv_pair, iteration_idx=iter_idx, question=question,
                              reply=reply, final_response=final_response, agreement_score=agreement_score)
-        print(
-            f"At iteration {CL.iteration_idx}, the conversation between {CL.conv_pair} was about '{CL.question}' and the reply was {CL.reply}. "
-            f"\nThe final response was {CL.final_response} with an agreement score of {CL.agreement_score}")
+        if verbose:
+            print(
+                f"At iteration {CL.iteration_idx}, the conversation between {CL.conv_pair} was about '{CL.question}' and the reply was {CL.reply}. "
+                f"\nThe final response was {CL.final_response} with an agreement score of {CL.agreement_score}")
 
-        # database log
-        logger.insert_conversation_log(CL.id, CL.conv_pair, CL.iteration_idx, CL.question, CL.reply,
-                                           CL.final_response,
-                                           CL.agreement_score)
+        rows.append((CL.id, CL.conv_pair, CL.iteration_idx, CL.question, CL.reply, CL.final_response,
+                     CL.agreement_score))
+    # database log, one transaction per iteration
+    logger.insert_conversation_logs_many(rows)
 
 
 def log_metrics(iter_idx, metric_names, metrics, log_dir):
@@ -126,9 +264,208 @@ def log_metrics(iter_idx, metric_names, metrics, log_dir):
         logger.insert_metric_log(ML.iteration_idx, ML.metric_name, ML.metric_scores)
 
 
+def build_social_graph(args, num_agents) -> SocialGraph:
+    if args.graph_edges:
+        return SocialGraph.from_edge_list(args.graph_edges, num_agents, seed=args.seed)
+    if args.graph_model == "scale-free":
+        return SocialGraph.scale_free(num_agents, args.graph_degree, seed=args.seed)
+    return SocialGraph.small_world(num_agents, args.graph_degree, args.graph_rewire_prob, seed=args.seed)
+
+
+def build_activity_scheduler(args, population: Population) -> Union[ActivityScheduler, None]:
+    if args.activity_weights:
+        return ActivityScheduler.from_json(args.activity_weights, population, args.activity_rate,
+                                           mode=args.activity_mode, seed=args.seed)
+    if args.activity_rate < 1 or args.activity_mode == "poisson":
+        return ActivityScheduler(np.full(len(population), args.activity_rate), mode=args.activity_mode,
+                                 seed=args.seed)
+    # Everybody converses every iteration
+    return None
+
+
+def pair_agents(agents_loc, topk, args, neighbor_index=None, social_graph=None, active=None) -> List[Tuple[int, int]]:
+    # On a social graph, partners are sampled among the ties instead of the nearest neighbors
+    if social_graph is not None:
+        return social_graph.sample_pairs(topk, resolve=args.match_resolve, active=active)
+    if active is not None:
+        # The neighbor index covers all agents, so pair the active ones on their own and map back to agent ids
+        local_pairs = assign_pairs1(agents_loc[active], topk, backend=args.pairing_backend, matching=args.matching,
+                                    resolve=args.match_resolve)
+        agent_ids = active.tolist()
+        return [(agent_ids[a], agent_ids[b]) for a, b in local_pairs]
+    return assign_pairs1(agents_loc, topk, backend=args.pairing_backend, matching=args.matching,
+                         resolve=args.match_resolve, index=neighbor_index)
+
+
+def replica_devices(worker_idx, first_gpu=0):
+    return {"CUDA_VISIBLE_DEVICES": str(first_gpu + worker_idx)}
+
+
+def build_backend(args, model, backend=None, server_url=None, num_replicas=None, first_gpu=0, engine_args=None):
+    """
+    One LLM backend: `backend` (--backend by default) serving `model`, in `num_replicas`
+    worker processes if more than one. `engine_args` are passed on to vllm's engine.
+    """
+    backend = backend or args.backend
+    num_replicas = num_replicas or args.num_replicas
+    if backend == "mock":
+        llm_factory = functools.partial(MockLLM, seed=args.seed or 0)
+    elif backend == "http":
+        llm_factory = functools.partial(HTTPLLM, server_url or args.server_url, model,
+                                        concurrency=args.http_concurrency, timeout=args.request_timeout,
+                                        api_key=os.getenv("OPENAI_API_KEY"))
+    else:
+        # Only import vllm's engine when it's actually used
+        from vllm_wrapper import BatchedLLM
+        llm_factory = functools.partial(BatchedLLM, model=model, max_model_len=MAX_MODEL_LEN, enable_prefix_caching=True,
+                                        token_budget=args.token_budget, **(engine_args or {}))
+    if num_replicas > 1:
+        # One GPU per vllm replica
+        worker_env = functools.partial(replica_devices, first_gpu=first_gpu) if backend == "vllm" else None
+        return BackendPool(llm_factory, num_replicas, worker_env=worker_env)
+    return llm_factory()
+
+
+def build_judge_scoring(args):
+    if args.judge_mode == "logprob":
+        return JudgeScoring(rule=args.movement_rule, threshold=args.movement_threshold)
+    return None
+
+
+def score_latent(questionnaire_responses, questionnaire_scoring=False):
+    """
+    Latent vector of every agent and the 0/1 answers to log. Per-item probabilities are scored
+    in expectation, with P = 0.5 for agents without answers.
+    """
+    if not questionnaire_scoring:
+        return questionnaire_res_to_latent_score(QUESTIONNAIRE_QUESTIONs, questionnaire_responses), \
+            questionnaire_responses
+    no_answers = [0.5] * len(QUESTIONNAIRE_QUESTIONs)
+    probabilities = np.asarray([row if row != "" else no_answers for row in questionnaire_responses])
+    return expected_latent_scores(QUESTIONNAIRE_QUESTIONs, probabilities), hard_answers(questionnaire_responses)
+
+
+def judge_agreements(llm, sampling_params, final_responses, all_questions, all_replies, judge_scoring=None,
+                     judge_cascade=None, chain_prefixes=None, count_cascade=True) -> torch.Tensor:
+    """
+    Agreement score of every pair from the configured judge: cascade, logprob scoring or sampled
+    grades. Without `count_cascade`, the pairs are left out of the cascade's counts.
+    """
+    if judge_cascade is not None:
+        return judge_cascade.judge(llm, sampling_params, final_responses, all_questions, all_replies,
+                                   scoring=judge_scoring, chain_prefixes=chain_prefixes, count=count_cascade)
+    if judge_scoring is not None:
+        return llm_judge_scores(llm, sampling_params, final_responses, all_questions, all_replies, judge_scoring,
+                                chain_prefixes=chain_prefixes)
+    return parse_grades(llm_judge(llm, sampling_params, final_responses, all_questions, all_replies,
+                                  chain_prefixes=chain_prefixes), strict=stage_profiles.strict("judge"))
+
+
+def run_llm_stages(llm, sampling_params, all_pairs, all_questions, agent_properties_lst, pipeline=False,
+                   judge_scoring=None, questionnaire_scoring=False, chain=False, chain_judge=False, turns=1,
+                   stop_phrases=(), stop_on_agreement=False, judge_cascade=None):
+    """
+    Conversation, questionnaire and judge for every pair. With `questionnaire_scoring`, the
+    questionnaire responses are per-item P(answer = 1) instead of 0/1 answers. `chain` and
+    `chain_judge` build the questionnaire and judge prompts as continuations of the conversations.
+    Conversations run up to `turns` rounds; the replies and final responses are their last exchange.
+    With a `judge_cascade`, the LLM only judges the pairs its classifier isn't confident about.
+    """
+    engine = get_engine(llm) if pipeline else None
+    if engine is not None:
+        return run_pipelined_stages(engine, sampling_params, all_pairs, all_questions, agent_properties_lst,
+                                    QUESTIONNAIRE_QUESTIONs, judge_scoring=judge_scoring,
+                                    questionnaire_scoring=questionnaire_scoring, chain=chain,
+                                    chain_judge=chain_judge)
+    # Without a step-wise engine, run the stages one after another
+    stop_pairs = None
+    # Pair index -> (reply, final response, agreement, escalated by the cascade) of the last exchange
+    # judged during the conversation
+    judged = {}
+    if stop_on_agreement:
+        def stop_pairs(pair_idxs, replies, final_responses):
+            # Pairs the judge already finds in agreement have nothing left to settle
+            agreements = judge_agreements(llm, sampling_params, final_responses, [all_questions[i] for i in pair_idxs],
+                                          replies, judge_scoring=judge_scoring, judge_cascade=judge_cascade,
+                                          count_cascade=False)
+            escalated = judge_cascade.last_escalated if judge_cascade is not None else np.zeros(len(pair_idxs), bool)
+            for position, idx in enumerate(pair_idxs):
+                judged[idx] = (replies[position], final_responses[position], agreements[position],
+                               escalated[position])
+            # Expected agreements count as agreeing from the movement threshold on
+            threshold = judge_scoring.threshold if agreements.is_floating_point() else 1
+            return (agreements >= threshold).tolist()
+    # Start a conversation of up to `turns` rounds between the two agents
+    conversations = run_conversation(llm, sampling_params, all_pairs, all_questions, agent_properties_lst, turns=turns,
+                                     stop_phrases=stop_phrases, stop_pairs=stop_pairs, max_model_len=MAX_MODEL_LEN,
+                                     keep_token_ids=chain or chain_judge)
+    # Chained prompts are checked against the tokens the engine actually holds
+    chain_stats.add_sequences(conversations.sequences, conversations.sequence_ids)
+    all_replies, final_responses = conversations.replies, conversations.final_responses
+
+    # Get the questionnaire response
+    if questionnaire_scoring:
+        questionnaire_responses = score_questionnaire_answers(llm, sampling_params, all_pairs, agent_properties_lst,
+                                                              all_questions, all_replies, final_responses,
+                                                              QUESTIONNAIRE_QUESTIONs, chain=chain,
+                                                              sequences=conversations.sequences)
+    else:
+        questionnaire_responses, _ = generate_questionnaire_answer(llm, sampling_params, all_pairs,
+                                                                   agent_properties_lst,
+                                                                   all_questions, all_replies, final_responses,
+                                                                   QUESTIONNAIRE_QUESTIONs, chain=chain,
+                                                                   sequences=conversations.sequences)
+    # agreement score using LLM judge, continuing the second agent's sequence when chained
+    chain_prefixes = [sequences[1] for sequences in conversations.sequences] if chain_judge else None
+    # Pairs whose conversation ended right after a stop check keep the judgement of that exchange
+    reused = [idx for idx, (reply, final_response, _, _) in judged.items()
+              if reply == all_replies[idx] and final_response == final_responses[idx]]
+    if not reused:
+        cur_agreements = judge_agreements(llm, sampling_params, final_responses, all_questions, all_replies,
+                                          judge_scoring=judge_scoring, judge_cascade=judge_cascade,
+                                          chain_prefixes=chain_prefixes)
+    else:
+        reused_agreements = torch.stack([judged[idx][2] for idx in reused])
+        rest = sorted(set(range(len(all_pairs))) - set(reused))
+        rest_agreements = judge_agreements(
+            llm, sampling_params, [final_responses[i] for i in rest], [all_questions[i] for i in rest],
+            [all_replies[i] for i in rest], judge_scoring=judge_scoring, judge_cascade=judge_cascade,
+            chain_prefixes=[chain_prefixes[i] for i in rest] if chain_prefixes is not None else None
+        ) if rest else reused_agreements[:0]
+        cur_agreements = torch.zeros(len(all_pairs),
+                                     dtype=torch.promote_types(reused_agreements.dtype, rest_agreements.dtype))
+        cur_agreements[reused] = reused_agreements.to(cur_agreements.dtype)
+        cur_agreements[rest] = rest_agreements.to(cur_agreements.dtype)
+        if judge_cascade is not None:
+            judge_cascade.record(np.asarray([judged[idx][3] for idx in reused], dtype=bool))
+    return all_replies, final_responses, questionnaire_responses, cur_agreements
+
+
+def run_coarsened_llm_stages(llm, sampling_params, all_pairs, all_questions, agent_properties_lst, agents_loc, args,
+                             judge_cascade=None):
+    """`run_llm_stages` on one representative pair per group, with the results fanned out to every pair."""
+    groups = group_pairs(all_pairs, all_questions, agent_properties_lst, agents_loc,
+                         cells_per_side=args.coarsen_cells, max_group_size=args.max_group_size,
+                         attributes=tuple(args.coarsen_attributes))
+    print(f"Coarsening: {len(all_pairs)} pairs share {len(groups)} LLM conversations")
+    rep_pairs = groups.select(all_pairs)
+    rep_replies, rep_final_responses, rep_answers, rep_agreements = run_llm_stages(
+        llm, sampling_params, rep_pairs, groups.select(all_questions), agent_properties_lst, pipeline=args.pipeline,
+        judge_scoring=build_judge_scoring(args), questionnaire_scoring=args.questionnaire_mode == "logprob",
+        chain=args.chain_prompts, chain_judge=args.chain_judge, turns=args.turns, stop_phrases=args.stop_phrases,
+        stop_on_agreement=args.stop_on_agreement, judge_cascade=judge_cascade)
+    questionnaire_responses = expand_questionnaire(groups, all_pairs, rep_pairs, rep_answers,
+                                                   len(agent_properties_lst))
+    return (groups.expand(rep_replies), groups.expand(rep_final_responses), questionnaire_responses,
+            groups.expand_tensor(rep_agreements))
+
+
 def main():
     # Parse CLI args
     args = parse_args()
+    stage_profiles.enabled = not args.no_stage_profiles
+    if args.stage_config:
+        stage_profiles.load(args.stage_config)
     num_agents = args.num_agents
     step_sz = args.step_sz
     num_iterations = args.num_iterations
@@ -149,17 +486,46 @@ def main():
     # Create LLM backbone
     MODEL = "meta-llama/Llama-3.1-8B-Instruct"
     SENARIO = "different demographics political debate"
-    llm = BatchedLLM(model=MODEL, max_model_len=8000, enable_prefix_caching=True)
+    # The surrogate mode runs on CPU without the LLM
+    router = None
+    if args.surrogate:
+        llm = None
+    elif args.router_config:
+        def build_route_backend(spec):
+            spec = {name: value for name, value in spec.items() if name != "cost"}
+            return build_backend(args, spec.pop("model", MODEL), **spec)
+        llm = router = StageRouter.from_config(args.router_config, build_route_backend)
+    else:
+        llm = build_backend(args, MODEL)
+    backend = llm
+    if backend is not None:
+        # Only a backend that enforces the stage regexes guarantees parsable outputs
+        stage_profiles.guided_decoding = getattr(backend, "supports_guided_decoding", False)
+    dedup = None
+    if llm is not None and args.dedup_prompts:
+        # Under the cache, which passes every copy of a sampled prompt down, so only the misses get deduplicated
+        llm = dedup = DedupLLM(llm)
+    if llm is not None and args.cache_path:
+        # Routed outputs depend on which model served each stage
+        cache_model = MODEL if router is None else f"{MODEL} routed by {config_digest(args.router_config)}"
+        llm = CachedLLM(llm, args.cache_path, cache_model, seed=args.seed or 0, max_bytes=int(args.cache_max_mb * 2 ** 20),
+                        cache_stages=args.cache_stages)
     sampling_params = SamplingParams(temperature=0.5, top_p=0.9, max_tokens=256, )
 
     log_simulation_setup(num_agents, step_sz, num_iterations, topk, MODEL, sampling_params, SENARIO, starter_prompts,
                          top_level_dir)
 
     # Initialize agents
-    comb_generator = StaticAgentProperty2.random_agent_generator()
     agents_loc = torch.rand(num_agents, 2)
-    agent_properties_lst = [next(comb_generator) for _ in range(num_agents)]
+    neighbor_index = SpatialIndex(agents_loc, 4 * topk) if args.incremental_index else None
+    social_graph = build_social_graph(args, num_agents) if args.topology == "graph" else None
+    # Indexable like a list of StaticAgentProperty2, stored column-wise
+    agent_properties_lst = Population.sample(num_agents, seed=args.seed)
     log_simulation_init_conditions(QUESTIONNAIRE_QUESTIONs, agent_properties_lst, top_level_dir)
+    activity_scheduler = build_activity_scheduler(args, agent_properties_lst)
+    convergence_monitor = ConvergenceMonitor(window=args.convergence_window, agreement_tol=args.agreement_tol,
+                                             displacement_tol=args.displacement_tol, drift_tol=args.drift_tol,
+                                             rewire_tol=args.rewire_tol, seed=args.seed) if args.early_stop else None
 
     # torch.save(agent_properties_lst, os.path.join(top_level_dir, "bool.pt"))
     all_locations = []
@@ -170,69 +536,181 @@ def main():
     final_responses = []  # The response from the other agent
 
     agreement_metric = []
-    metrics = [agreement_metric]
-
-    # Collect questionnaire response before simulation starts
-    all_pairs = assign_pairs1(agents_loc, topk)
-    questionnaire_responses, latent_vec = generate_questionnaire_answer(llm, sampling_params, all_pairs,
-                                                                        agent_properties_lst,
-                                                                        ["" for _ in range(len(all_pairs))],
-                                                                        # No starter questions
-                                                                        ["" for _ in range(len(all_pairs))],
-                                                                        # No replies
-                                                                        ["" for _ in range(len(all_pairs))],
-                                                                        # No final response
-                                                                        QUESTIONNAIRE_QUESTIONs)
-
-    log_agents(-1, agents_loc.tolist(), questionnaire_responses,
+    unpaired_metric = []  # More pairs per iteration means more conversations per LLM batch
+    active_metric = []
+    metrics = [agreement_metric, unpaired_metric, active_metric]
+
+    questionnaire_scoring = args.questionnaire_mode == "logprob"
+    judge_cascade = JudgeCascade(CascadeClassifier.load(args.judge_cascade), args.cascade_threshold) \
+        if args.judge_cascade and not args.surrogate else None
+    if args.surrogate:
+        surrogate_rng = np.random.default_rng(args.seed)
+        surrogate_judge = SurrogateJudge.load(args.surrogate_coeffs, seed=args.seed) if args.surrogate_coeffs \
+            else SurrogateJudge(seed=args.seed)
+        # Surrogate questionnaire answers, one row per agent
+        answers = sample_questionnaire(num_agents, len(QUESTIONNAIRE_QUESTIONs), surrogate_rng)
+        latent_vec = latent_scores_from_matrix(QUESTIONNAIRE_QUESTIONs, answers)
+        questionnaire_responses = logged_responses = answers.tolist()
+    else:
+        # Collect questionnaire response before simulation starts
+        all_pairs = pair_agents(agents_loc, topk, args, neighbor_index, social_graph)
+        if args.autotune_batching and hasattr(llm, "autotune"):
+            # Each candidate budget is timed on its own quarter of these
+            sample_pairs = all_pairs[:8192]
+            llm.autotune(generate_initial_question_prompts(sample_pairs, [random.choice(starter_prompts) for _ in
+                                                                          sample_pairs], agent_properties_lst),
+                         sampling_params)
+        no_text = ["" for _ in range(len(all_pairs))]  # No starter questions, replies or final responses
+        if questionnaire_scoring:
+            questionnaire_responses = score_questionnaire_answers(llm, sampling_params, all_pairs,
+                                                                  agent_properties_lst, no_text, no_text, no_text,
+                                                                  QUESTIONNAIRE_QUESTIONs,
+                                                                  stage="initial_questionnaire")
+        else:
+            questionnaire_responses, _ = generate_questionnaire_answer(llm, sampling_params, all_pairs,
+                                                                       agent_properties_lst, no_text, no_text, no_text,
+                                                                       QUESTIONNAIRE_QUESTIONs,
+                                                                       stage="initial_questionnaire")
+        # `generate_questionnaire_answer` scores the answers in prompt order, score them per agent instead
+        latent_vec, logged_responses = score_latent(questionnaire_responses, questionnaire_scoring)
+
+    log_agents(-1, agents_loc.tolist(), logged_responses,
                log_dir,
-               latent_vec)
+               np.asarray(latent_vec).tolist(), verbose=not args.surrogate)
 
     for iter_idx in range(num_iterations):
         # Feed it just the questionnaire with no previous history
 
-        cur_agreements = []
         if iter_idx % 10 == 0:
             print(f"Iteration: {iter_idx}")
 
-        # Pair agents and run conversations
-        all_pairs = assign_pairs1(agents_loc, topk)
+        # Pair the agents active in this iteration and run conversations
+        active = activity_scheduler.active(iter_idx) if activity_scheduler is not None else None
+        all_pairs = pair_agents(agents_loc, topk, args, neighbor_index, social_graph, active)
 
         # set up questions
         all_questions = [random.choice(starter_prompts) for _ in range(len(all_pairs))]
 
-        # Start a 1 round conversation between the two agent: len(conversation)
-        all_replies, final_responses = generate_conversation(llm, sampling_params, all_pairs, all_questions,
-                                                             agent_properties_lst)
-
-        # Get the questionnaire response
-        questionnaire_responses, latent_vec = generate_questionnaire_answer(llm, sampling_params, all_pairs,
-                                                                            agent_properties_lst,
-                                                                            all_questions, all_replies, final_responses,
-                                                                            QUESTIONNAIRE_QUESTIONs)
-
-        # update agent properties: positions, agreement score using LLM judge
-        agents_loc = update_properties(llm, sampling_params, final_responses, all_questions, all_replies, all_pairs,
-                                       agent_properties_lst, agents_loc, step_sz, cur_agreements)
+        prev_loc = agents_loc.clone()
+        prev_responses = questionnaire_responses
+        if args.surrogate:
+            # Grades come straight from the latent vectors and demographics, with no conversation text
+            all_replies = ["" for _ in range(len(all_pairs))]
+            final_responses = ["" for _ in range(len(all_pairs))]
+            cur_agreements = surrogate_judge.judge(all_pairs, latent_vec, agent_properties_lst)
+            answers = influence(answers, all_pairs, cur_agreements, args.surrogate_adopt_rate, surrogate_rng)
+            latent_vec = latent_scores_from_matrix(QUESTIONNAIRE_QUESTIONs, answers)
+            questionnaire_responses = answers.tolist()
+        elif args.coarsen:
+            all_replies, final_responses, questionnaire_responses, cur_agreements = \
+                run_coarsened_llm_stages(llm, sampling_params, all_pairs, all_questions, agent_properties_lst,
+                                         agents_loc, args, judge_cascade=judge_cascade)
+        else:
+            all_replies, final_responses, questionnaire_responses, cur_agreements = \
+                run_llm_stages(llm, sampling_params, all_pairs, all_questions, agent_properties_lst,
+                               pipeline=args.pipeline, judge_scoring=build_judge_scoring(args),
+                               questionnaire_scoring=questionnaire_scoring, chain=args.chain_prompts,
+                               chain_judge=args.chain_judge, turns=args.turns, stop_phrases=args.stop_phrases,
+                               stop_on_agreement=args.stop_on_agreement, judge_cascade=judge_cascade)
+        if not args.surrogate:
+            # Agents that didn't converse keep their previous answers, and the latent vectors are scored per agent
+            questionnaire_responses = [response if response != "" else prev_response
+                                       for response, prev_response in zip(questionnaire_responses, prev_responses)]
+            latent_vec, logged_responses = score_latent(questionnaire_responses, questionnaire_scoring)
+        else:
+            logged_responses = questionnaire_responses
+
+        if isinstance(llm, CachedLLM):
+            print(f"LLM cache: {llm.stats()}")
+        if dedup is not None:
+            print(f"Prompt dedup: {dedup.stats()}")
+        if router is not None:
+            # Throughput and cost of every (stage, backend) route
+            for route, stats in router.stats().items():
+                print(f"Route {route}: {stats}")
+                log_metrics(iter_idx, [f"route {route} tokens per second", f"route {route} cost",
+                                       f"route {route} escalated"],
+                            [stats["tokens per second"], stats["cost"], stats["escalated"]], log_dir)
+            router.reset_stats()
+        # Share of prompt tokens the engine served from its prefix cache, per stage
+        prefix_hit_rates = prefix_cache_stats.report()
+        if prefix_hit_rates:
+            log_metrics(iter_idx, [f"prefix cache hit rate {stage}" for stage in prefix_hit_rates],
+                        list(prefix_hit_rates.values()), log_dir)
+        prefix_cache_stats.reset()
+        # Prompt tokens of chained prompts shared with the conversation sequences, per stage
+        for stage, stats in chain_stats.report().items():
+            log_metrics(iter_idx, [f"prefill tokens saved {stage}", f"chain prefix mismatches {stage}"],
+                        [stats["prefill tokens saved"], stats["prefix mismatches"]], log_dir)
+        chain_stats.reset()
+        # Conversation length and what each turn cost the engine
+        turn_report = turn_stats.report()
+        if turn_report:
+            log_metrics(iter_idx, [f"conversation {name}" for name in turn_report], list(turn_report.values()),
+                        log_dir)
+        turn_stats.reset()
+        if judge_cascade is not None:
+            # Pairs the classifier judged on CPU versus the ones escalated to the LLM judge
+            cascade_stats = judge_cascade.stats()
+            print(f"Judge cascade: {cascade_stats}")
+            log_metrics(iter_idx, ["judge cascade local", "judge cascade escalated"],
+                        [cascade_stats["local"], cascade_stats["escalated"]], log_dir)
+            judge_cascade.reset()
+
+        # update agent properties: positions or ties
+        if social_graph is not None:
+            # Agreement strengthens the tie between the pair, disagreement weakens and eventually rewires it
+            rewired = social_graph.reinforce(all_pairs, cur_agreements, strength=step_sz)
+            log_metrics(iter_idx, ["rewired ties"], [rewired], log_dir)
+        else:
+            agents_loc = move_agents(agents_loc, all_pairs, cur_agreements, step_sz)
+        if neighbor_index is not None:
+            moved_ids = torch.nonzero((agents_loc != prev_loc).any(dim=1)).squeeze(1)
+            neighbor_index.update(moved_ids, agents_loc)
 
         # Log Agents
         log_agents(iter_idx, agents_loc.tolist(),
-                   questionnaire_responses, log_dir, latent_vec)
+                   logged_responses, log_dir, np.asarray(latent_vec).tolist(), verbose=not args.surrogate)
         # Log conversations
-        log_conversations(iter_idx, all_pairs, all_questions, all_replies, final_responses, cur_agreements, log_dir)
+        log_conversations(iter_idx, all_pairs, all_questions, all_replies, final_responses, cur_agreements.tolist(),
+                          log_dir, verbose=not args.surrogate)
 
         # Logging to visualize
         all_locations.append(agents_loc.detach().clone().unsqueeze(0))
-        all_agreements.append(torch.tensor(cur_agreements))
-        agreement_metric.append(np.average(cur_agreements))
+        all_agreements.append(cur_agreements)
+        agreement_metric.append(cur_agreements.float().mean().item())
+        unpaired_metric.append(unpaired_fraction(all_pairs, num_agents))
+        active_metric.append(1.0 if active is None else len(active) / num_agents)
         # Log Metrics
-        log_metrics(iter_idx, ["agreement score"], metrics, log_dir)
+        log_metrics(iter_idx, ["agreement score", "unpaired fraction", "active fraction"], metrics, log_dir)
 
-        torch.save(torch.stack(all_agreements), os.path.join(top_level_dir, "all_agree.pt"))
+        # The number of pairs can change between iterations, so keep one tensor per iteration
+        torch.save(all_agreements, os.path.join(top_level_dir, "all_agree.pt"))
         torch.save(torch.cat(all_locations), os.path.join(top_level_dir, "all_locs.pt"))
         torch.save(torch.tensor(metrics), os.path.join(top_level_dir, "metrics.pt"))
 
+        if convergence_monitor is not None:
+            # Agents on a social graph don't move; the ties settle instead
+            rewired_share = rewired / max(social_graph.num_edges, 1) if social_graph is not None else None
+            converged = convergence_monitor.update(agents_loc, prev_loc, agreement_metric[-1], rewired=rewired_share)
+            log_metrics(iter_idx, ["mean displacement", "neighbor drift"],
+                        [convergence_monitor.last_displacement, convergence_monitor.last_drift], log_dir)
+            if converged is not None:
+                # Skip the remaining iterations and their LLM calls
+                print(f"Converged at iteration {iter_idx}: {converged}")
+                log_metrics(iter_idx, ["converged"], [converged], log_dir)
+                break
+
     print(f"Simulation finished and logged to {top_level_dir}")
+    if hasattr(backend, "close"):
+        backend.close()
+    mocks = router.backends if router is not None else {args.backend: llm}
+    for name, mock in mocks.items():
+        if hasattr(mock, "simulated_seconds"):
+            # Mock backend (possibly behind the cache): what the run would have cost on a real engine
+            print(f"Simulated LLM time of {name}: {mock.simulated_seconds:.1f}s")
+            for stage, stats in mock.stage_stats.items():
+                print(f"  {stage}: {stats}")
     if args.gif:
         print(f"Generating the gif at {top_level_dir}")
         generate_visualization_for_subdir(top_level_dir)
@@ -244,8 +722,9 @@ if __name__ == "__main__":
     main()
 
 """
-python3 ./main.py --num-agents=500000 --step-sz=.05 --num-iterations=1 --topk=3
+python3 ./main.py --num-agents=500000 --step-sz=.05 --num-iterations=1 --topk=3 --pairing-backend=kdtree
 python3 ./main.py --num-agents=2 --step-sz=.05 --num-iterations=10 --topk=5 --gif --testing
 python3 ./main.py --num-agents=10 --step-sz=.05 --num-iterations=1 --topk=5 --testing
+python3 ./main.py --num-agents=1000000 --step-sz=.05 --num-iterations=100 --topk=3 --pairing-backend=grid --surrogate --testing
 
 """
@@ -0,0 +1,296 @@
+import hashlib
+import math
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from llm_outputs import CompletionOutput, Logprob, RequestOutput
+
+# Markers of the prompt builders, used when the caller doesn't pass `stage=`
+JUDGE_MARKER = "score how much the agents agree"
+QUESTIONNAIRE_MARKER = "Answer the questionnaire"
+USER_HEADER = "<|start_header_id|>user<|end_header_id|>"
+
+OPINIONS = [
+    "I think the government should focus on lowering costs for working families.",
+    "Honestly, I believe local communities know best how to solve their own problems.",
+    "We need stronger protections for the environment, even if it costs more up front.",
+    "Lower taxes and fewer regulations are what keep small businesses alive.",
+    "Healthcare should be affordable for everyone, and right now it is not.",
+    "I am worried about the national debt and what it means for my grandchildren.",
+    "Public schools need more funding and more respect for teachers.",
+    "Our borders should be secure, but the immigration process must be fair.",
+    "I agree with some of that, but I see it differently on the details.",
+    "That is a fair point, though I would put the priority elsewhere.",
+]
+
+
+@dataclass
+class MockSamplingParams:
+    """Stand-in for vLLM's `SamplingParams` with the fields the simulation uses."""
+    temperature: float = 1.0
+    top_p: float = 1.0
+    max_tokens: Optional[int] = 16
+    n: int = 1
+    logprobs: Optional[int] = None
+    seed: Optional[int] = None
+    stop: Optional[List[str]] = None
+    guided_decoding: Optional[object] = None
+
+
+@dataclass
+class MockGuidedDecodingParams:
+    """Stand-in for vLLM's `GuidedDecodingParams`. The mock's outputs already follow the stage formats."""
+    regex: Optional[str] = None
+    choice: Optional[List[str]] = None
+
+
+class MockTokenizer:
+    """Splits text into words, punctuation and whitespace runs; ids are assigned on first sight."""
+    TOKEN_RE = re.compile(r"\s+|\w+|[^\w\s]")
+
+    def __init__(self):
+        self.vocab: Dict[str, int] = {}
+        self.tokens: List[str] = []
+
+    def tokenize(self, text: str) -> List[str]:
+        return self.TOKEN_RE.findall(text)
+
+    def token_id(self, token: str) -> int:
+        if token not in self.vocab:
+            self.vocab[token] = len(self.tokens)
+            self.tokens.append(token)
+        return self.vocab[token]
+
+    def encode(self, text: str, add_special_tokens=False) -> List[int]:
+        return [self.token_id(token) for token in self.tokenize(text)]
+
+    def decode(self, token_ids: List[int]) -> str:
+        return "".join(self.tokens[i] for i in token_ids)
+
+    def __call__(self, texts, add_special_tokens=False):
+        if isinstance(texts, str):
+            return {"input_ids": self.encode(texts)}
+        return {"input_ids": [self.encode(text) for text in texts]}
+
+
+def detect_stage(prompt: str) -> str:
+    if JUDGE_MARKER in prompt:
+        return "judge"
+    if QUESTIONNAIRE_MARKER in prompt:
+        return "questionnaire"
+    return "conversation"
+
+
+def count_questionnaire_items(prompt: str) -> int:
+    """Number of numbered questions in the questionnaire block (or else the user turn) of a prompt."""
+    block = re.search(r"=== Questionnaire ===\n(.*?)=== End of Questionnaire ===", prompt, flags=re.DOTALL)
+    section = block.group(1) if block else prompt.rsplit(USER_HEADER, 1)[-1]
+    return len(re.findall(r"^\s*\d+\.\s", section, flags=re.MULTILINE))
+
+
+@dataclass
+class LatencyModel:
+    """
+    Rough cost of one engine submission: a fixed overhead, prefill of the uncached prompt
+    tokens, and one decode step per token of the longest output, each step costing more with
+    more sequences in flight.
+    """
+    batch_overhead_s: float = 0.05
+    prefill_tokens_per_s: float = 20000.0
+    decode_step_s: float = 0.015
+    decode_step_per_seq_s: float = 2e-5
+
+    def seconds(self, uncached_prompt_tokens: int, output_lengths: List[int]) -> float:
+        if not output_lengths:
+            return 0.0
+        steps = max(output_lengths)
+        return (self.batch_overhead_s + uncached_prompt_tokens / self.prefill_tokens_per_s
+                + steps * (self.decode_step_s + self.decode_step_per_seq_s * len(output_lengths)))
+
+
+@dataclass
+class StageStats:
+    requests: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    seconds: float = 0.0
+
+
+class MockLLM:
+    """
+    Deterministic CPU stand-in for `BatchedLLM`, implementing the `BackBoneLLM` protocol.
+
+    Outputs are well formed for each stage (judge grades, binary questionnaire lists, short
+    replies) and drawn from an RNG seeded by the prompt, so the same prompt always gets the
+    same answer. Outputs are shaped like vLLM's `RequestOutput`, with token ids, `n` samples,
+    per-token logprobs when asked for, and `num_cached_tokens` from a modelled prefix cache.
+    The time a real engine would need is added to `simulated_seconds` (and slept if `sleep`).
+    """
+    # Outputs of constrained stages always match their regex
+    supports_guided_decoding = True
+
+    def __init__(self, seed=0, latency: Optional[LatencyModel] = None, sleep=False, block_size=16,
+                 max_cached_blocks=1 << 20):
+        self.seed = seed
+        self.latency = latency or LatencyModel()
+        self.sleep = sleep
+        self.block_size = block_size
+        self.max_cached_blocks = max_cached_blocks
+        self.tokenizer = MockTokenizer()
+        self.cached_blocks = set()
+        self.simulated_seconds = 0.0
+        self.stage_stats: Dict[str, StageStats] = {}
+        self.llm_engine = MockEngine(self)
+
+    def get_tokenizer(self) -> MockTokenizer:
+        return self.tokenizer
+
+    def _rng(self, prompt: str, sample_idx: int, sampling_params) -> np.random.Generator:
+        key = f"{self.seed}\0{getattr(sampling_params, 'seed', None)}\0{sample_idx}\0{prompt}"
+        return np.random.default_rng(int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "little"))
+
+    def _cached_prefix(self, token_ids: List[int]) -> int:
+        """Tokens served from the modelled prefix cache; caches the prompt's full blocks."""
+        cached, still_cached, block_hash = 0, True, 0
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            block_hash = hash((block_hash, tuple(token_ids[start: start + self.block_size])))
+            if still_cached and block_hash in self.cached_blocks:
+                cached += self.block_size
+            else:
+                still_cached = False
+                self.cached_blocks.add(block_hash)
+        if len(self.cached_blocks) > self.max_cached_blocks:
+            self.cached_blocks.clear()
+        return cached
+
+    def _sample_tokens(self, stage: str, prompt: str, rng: np.random.Generator, greedy: bool
+                       ) -> List[Tuple[str, Dict[str, float]]]:
+        """Generated tokens, each with the logprobs of its alternatives."""
+        if stage == "judge":
+            probs = rng.dirichlet([1.0, 1.0, 1.0])
+            grade = int(np.argmax(probs)) if greedy else int(rng.choice(3, p=probs))
+            first = {"-": math.log(probs[0]), "0": math.log(probs[1]), "1": math.log(probs[2])}
+            return [("-", first), ("1", {"1": 0.0})] if grade == 0 else [(str(grade - 1), first)]
+        if stage == "questionnaire":
+            tokens = []
+            for item in range(count_questionnaire_items(prompt)):
+                p_one = float(np.clip(rng.beta(2.0, 2.0), 1e-6, 1 - 1e-6))
+                bit = int(p_one > 0.5) if greedy else int(rng.random() < p_one)
+                if item:
+                    tokens += [(",", {",": 0.0}), (" ", {" ": 0.0})]
+                tokens.append((str(bit), {"1": math.log(p_one), "0": math.log(1 - p_one)}))
+            return tokens
+        text = " ".join(OPINIONS[i] for i in rng.choice(len(OPINIONS), size=rng.integers(1, 3), replace=False))
+        return [(token, {token: math.log(0.8)}) for token in self.tokenizer.tokenize(text)]
+
+    def _complete(self, prompt: str, sampling_params, request_id: str) -> RequestOutput:
+        # What to answer comes from the prompt itself; `stage=` names can be finer ("reply", "initial_questionnaire")
+        kind = detect_stage(prompt)
+        prompt_ids = self.tokenizer.encode(prompt)
+        greedy = getattr(sampling_params, "temperature", 1.0) == 0
+        max_tokens = getattr(sampling_params, "max_tokens", None)
+        num_logprobs = getattr(sampling_params, "logprobs", None)
+
+        outputs = []
+        for sample_idx in range(getattr(sampling_params, "n", 1) or 1):
+            tokens = self._sample_tokens(kind, prompt, self._rng(prompt, sample_idx, sampling_params), greedy)
+            finish_reason = "stop"
+            if max_tokens is not None and len(tokens) > max_tokens:
+                tokens, finish_reason = tokens[:max_tokens], "length"
+            token_ids = [self.tokenizer.token_id(token) for token, _ in tokens]
+            logprobs = None
+            if num_logprobs is not None:
+                logprobs = []
+                for token, alternatives in tokens:
+                    ranked = sorted(alternatives.items(), key=lambda item: -item[1])[:max(num_logprobs, 1)]
+                    if token not in dict(ranked):
+                        ranked.append((token, alternatives[token]))
+                    logprobs.append({self.tokenizer.token_id(alt): Logprob(lp, rank + 1, alt)
+                                     for rank, (alt, lp) in enumerate(ranked)})
+            outputs.append(CompletionOutput(index=sample_idx, text="".join(token for token, _ in tokens),
+                                            token_ids=token_ids,
+                                            cumulative_logprob=sum(alts[token] for token, alts in tokens),
+                                            logprobs=logprobs, finish_reason=finish_reason))
+        cached = self._cached_prefix(prompt_ids)
+        for output in outputs:
+            # Like vLLM, the full blocks of generated tokens stay cached too, for prompts continuing them
+            self._cached_prefix(prompt_ids + output.token_ids)
+        return RequestOutput(request_id=request_id, prompt=prompt, outputs=outputs, prompt_token_ids=prompt_ids,
+                             num_cached_tokens=cached)
+
+    def _account(self, stage: str, outputs: List[RequestOutput]) -> float:
+        prompt_tokens = sum(len(output.prompt_token_ids) for output in outputs)
+        cached_tokens = sum(output.num_cached_tokens for output in outputs)
+        output_lengths = [len(o.token_ids) for output in outputs for o in output.outputs]
+        seconds = self.latency.seconds(prompt_tokens - cached_tokens, output_lengths)
+        stats = self.stage_stats.setdefault(stage, StageStats())
+        stats.requests += len(outputs)
+        stats.prompt_tokens += prompt_tokens
+        stats.cached_tokens += cached_tokens
+        stats.output_tokens += sum(output_lengths)
+        stats.seconds += seconds
+        self.simulated_seconds += seconds
+        if self.sleep:
+            time.sleep(seconds)
+        return seconds
+
+    def generate(self, prompts, sampling_params, stage: Optional[str] = None, **kwargs) -> List[RequestOutput]:
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        outputs = [self._complete(prompt, sampling_params, str(i)) for i, prompt in enumerate(prompts)]
+        self._account(stage or (detect_stage(prompts[0]) if prompts else "conversation"), outputs)
+        return outputs
+
+
+class MockEngine:
+    """
+    Step-wise interface of vLLM's `LLMEngine` on top of `MockLLM`. Every step decodes
+    `tokens_per_step` tokens of up to `max_num_seqs` running requests and returns their outputs,
+    finished or not, so short requests leave the batch before long ones.
+    """
+
+    def __init__(self, llm: MockLLM, max_num_seqs=256, tokens_per_step=8):
+        self.llm = llm
+        self.max_num_seqs = max_num_seqs
+        self.tokens_per_step = tokens_per_step
+        self.waiting: List[Tuple[str, str, object]] = []
+        self.running: List[List] = []  # [request_id, output, decoded tokens]
+
+    def get_tokenizer(self) -> MockTokenizer:
+        return self.llm.tokenizer
+
+    def add_request(self, request_id: str, prompt: str, params) -> None:
+        self.waiting.append((request_id, prompt, params))
+
+    def has_unfinished_requests(self) -> bool:
+        return bool(self.waiting or self.running)
+
+    def step(self) -> List[RequestOutput]:
+        admitted = []
+        while self.waiting and len(self.running) < self.max_num_seqs:
+            request_id, prompt, params = self.waiting.pop(0)
+            output = self.llm._complete(prompt, params, request_id)
+            output.finished = False
+            self.running.append([request_id, output, 0])
+            admitted.append(output)
+        by_stage: Dict[str, List[RequestOutput]] = {}
+        for output in admitted:
+            by_stage.setdefault(detect_stage(output.prompt), []).append(output)
+        for stage, outputs in by_stage.items():
+            self.llm._account(stage, outputs)
+
+        step_outputs, still_running = [], []
+        for entry in self.running:
+            entry[2] += self.tokens_per_step
+            output = entry[1]
+            output.finished = entry[2] >= max(len(o.token_ids) for o in output.outputs)
+            step_outputs.append(output)
+            if not output.finished:
+                still_running.append(entry)
+        self.running = still_running
+        return step_outputs
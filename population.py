@@ -0,0 +1,94 @@
+from typing import Dict, Iterator, Optional, Tuple
+
+import numpy as np
+
+from log_schemas import StaticAgentProperty2
+
+# Same order as the AgentProperties table and `StaticAgentProperty2` fields
+ATTRIBUTE_NAMES = ("age", "gender", "location", "urbanicity", "ethnicity", "education")
+
+
+class AgentView:
+    """
+    Lightweight indexed handle on one agent of a `Population`. Exposes the same attributes and
+    `get_sys_prompt` as `StaticAgentProperty2`, so prompt builders work unchanged.
+    """
+    __slots__ = ("population", "agent_id")
+
+    def __init__(self, population: "Population", agent_id: int):
+        self.population = population
+        self.agent_id = agent_id
+
+    def __getattr__(self, name):
+        if name in ATTRIBUTE_NAMES:
+            return self.population.value(name, self.agent_id)
+        raise AttributeError(name)
+
+    def get_sys_prompt(self):
+        return self.population.get_sys_prompt(self.agent_id)
+
+
+class Population:
+    """
+    Struct-of-arrays store of the static agent properties.
+
+    Every attribute of `StaticAgentProperty2.ATTRIBUTES` is kept as a small-int code array
+    into that attribute's list of values, so half a million agents take a few MB and are
+    sampled in bulk instead of one dataclass at a time.
+    """
+
+    def __init__(self, codes: Dict[str, np.ndarray]):
+        self.codes = codes
+        self.vocab = {name: StaticAgentProperty2.ATTRIBUTES[name]["values"] for name in ATTRIBUTE_NAMES}
+        # System prompts only depend on the persona, so format each combination once
+        self._sys_prompts: Dict[int, str] = {}
+
+    @classmethod
+    def sample(cls, num_agents: int, seed: Optional[int] = None) -> "Population":
+        """
+        Draws every attribute independently from the real-world distributions in
+        `StaticAgentProperty2.ATTRIBUTES`, like `random_combination_gen` does.
+        """
+        rng = np.random.default_rng(seed)
+        codes = {}
+        for name in ATTRIBUTE_NAMES:
+            spec = StaticAgentProperty2.ATTRIBUTES[name]
+            weights = np.asarray(spec["weights"], dtype=np.float64)
+            codes[name] = rng.choice(len(spec["values"]), size=num_agents, p=weights / weights.sum()).astype(np.uint8)
+        return cls(codes)
+
+    def __len__(self):
+        return len(self.codes[ATTRIBUTE_NAMES[0]])
+
+    def __getitem__(self, agent_id) -> AgentView:
+        return AgentView(self, int(agent_id))
+
+    def __iter__(self) -> Iterator[AgentView]:
+        return (AgentView(self, agent_id) for agent_id in range(len(self)))
+
+    def value(self, name: str, agent_id: int):
+        return self.vocab[name][self.codes[name][agent_id]]
+
+    def persona_keys(self, attributes: Tuple[str, ...] = ATTRIBUTE_NAMES) -> np.ndarray:
+        """One int64 per agent that is equal for agents sharing the given attributes (the whole persona by default)."""
+        keys = np.zeros(len(self), dtype=np.int64)
+        for name in attributes:
+            keys = keys * len(self.vocab[name]) + self.codes[name]
+        return keys
+
+    def get_sys_prompt(self, agent_id: int) -> str:
+        key = 0
+        for name in ATTRIBUTE_NAMES:
+            key = key * len(self.vocab[name]) + int(self.codes[name][agent_id])
+        if key not in self._sys_prompts:
+            self._sys_prompts[key] = StaticAgentProperty2.SYSTEM_PROMPT_TEMPLATE.format(
+                **{name: self.value(name, agent_id) for name in ATTRIBUTE_NAMES})
+        return self._sys_prompts[key]
+
+    def records(self) -> Iterator[Tuple[int, int, str, str, str, str, str]]:
+        """
+        (agent_id, age, gender, location, urbanicity, ethnicity, education) rows for the
+        AgentProperties table, decoded a column at a time.
+        """
+        columns = [np.asarray(self.vocab[name], dtype=object)[self.codes[name]].tolist() for name in ATTRIBUTE_NAMES]
+        return zip(range(len(self)), *columns)
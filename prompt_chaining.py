@@ -0,0 +1,101 @@
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+USER_TURN = "<|eot_id|><|start_header_id|>user<|end_header_id|>\n"
+ASSISTANT_TURN = "<|eot_id|><|start_header_id|>assistant<|end_header_id|>"
+
+
+def continue_prompt(prefix: str, user_text: str) -> str:
+    """
+    `prefix` (an earlier prompt plus what was generated for it) followed by a new user turn
+    and the assistant header. The prefix is kept verbatim, so an engine with prefix caching
+    only has to prefill the new turn.
+    """
+    return prefix + USER_TURN + user_text + ASSISTANT_TURN
+
+
+def engine_sequence_ids(output) -> Optional[np.ndarray]:
+    """
+    The token ids the engine holds for a request: its prompt ids followed by the first
+    completion's ids, or None for backends that return no ids.
+    """
+    completion_ids = output.outputs[0].token_ids
+    if not output.prompt_token_ids or completion_ids is None:
+        return None
+    return np.concatenate([np.asarray(output.prompt_token_ids, dtype=np.int64),
+                           np.asarray(completion_ids, dtype=np.int64)])
+
+
+def shared_prefix_lengths(prefix_ids: List[List[int]], prompt_ids: List[List[int]]) -> np.ndarray:
+    """
+    Number of leading token ids of each prompt that equal those of its prefix. Text that
+    starts with the prefix can still tokenize differently across the seam; this catches that.
+    """
+    lengths = np.zeros(len(prompt_ids), dtype=np.int64)
+    for idx, (prefix, prompt) in enumerate(zip(prefix_ids, prompt_ids)):
+        size = min(len(prefix), len(prompt))
+        differs = np.flatnonzero(np.asarray(prefix[:size]) != np.asarray(prompt[:size]))
+        lengths[idx] = differs[0] if len(differs) else size
+    return lengths
+
+
+class ChainStats:
+    """
+    Prefill tokens saved by prompt chaining, per stage: the prompt tokens shared with the
+    conversation sequence whose KV cache the engine already holds.
+
+    The sequences' ids are the ones the engine produced (`add_sequences`), since re-tokenizing
+    their text can differ from what was generated. Sequences without them are re-tokenized.
+    """
+
+    def __init__(self):
+        self.prompts: Dict[str, int] = defaultdict(int)
+        self.saved_tokens: Dict[str, int] = defaultdict(int)
+        self.mismatches: Dict[str, int] = defaultdict(int)
+        self.engine_ids: Dict[str, np.ndarray] = {}
+
+    def add_sequences(self, sequences: List[List[str]], sequence_ids: List[List[Optional[np.ndarray]]]):
+        """Engine token ids of conversation sequences (e.g. `Conversations.sequence_ids`) for `check`."""
+        for texts, ids in zip(sequences, sequence_ids):
+            for text, text_ids in zip(texts, ids):
+                if text_ids is not None:
+                    self.engine_ids[text] = text_ids
+
+    def check(self, llm, stage: Optional[str], prefixes: List[str], prompts: List[str]):
+        """Token-level check that `prompts` extend `prefixes`, recorded under `stage`."""
+        try:
+            tokenizer = llm.get_tokenizer()
+        except AttributeError:
+            # Remote servers and replica pools don't expose their tokenizer
+            return
+        prefix_ids = [self.engine_ids.get(prefix) for prefix in prefixes]
+        missing = [idx for idx, ids in enumerate(prefix_ids) if ids is None]
+        if missing:
+            retokenized = tokenizer([prefixes[idx] for idx in missing], add_special_tokens=False)["input_ids"]
+            for idx, ids in zip(missing, retokenized):
+                prefix_ids[idx] = ids
+        shared = shared_prefix_lengths(prefix_ids, tokenizer(prompts, add_special_tokens=False)["input_ids"])
+        prefix_lengths = np.asarray([len(ids) for ids in prefix_ids])
+        mismatched = int((shared < prefix_lengths).sum())
+        if mismatched:
+            print(f"{mismatched} of {len(prompts)} chained {stage} prompts diverge from their conversation tokens")
+        self.prompts[stage] += len(prompts)
+        self.saved_tokens[stage] += int(shared.sum())
+        self.mismatches[stage] += mismatched
+
+    def report(self) -> Dict[str, Dict[str, int]]:
+        """{stage: {"prompts", "prefill tokens saved", "prefix mismatches"}}"""
+        return {stage: {"prompts": count, "prefill tokens saved": self.saved_tokens[stage],
+                        "prefix mismatches": self.mismatches[stage]}
+                for stage, count in self.prompts.items()}
+
+    def reset(self):
+        self.prompts.clear()
+        self.saved_tokens.clear()
+        self.mismatches.clear()
+        self.engine_ids.clear()
+
+
+chain_stats = ChainStats()
@@ -0,0 +1,73 @@
+import copy
+import dataclasses
+from typing import Dict, List, Optional
+
+from llm_outputs import RequestOutput
+
+
+def with_n(sampling_params, n: int):
+    """A copy of `sampling_params` drawing `n` samples per prompt."""
+    if dataclasses.is_dataclass(sampling_params):
+        return dataclasses.replace(sampling_params, n=n)
+    params = copy.deepcopy(sampling_params)
+    params.n = n
+    if getattr(params, "best_of", None) is not None and params.best_of < n:
+        params.best_of = n
+    return params
+
+
+class DedupLLM:
+    """
+    Sends every distinct prompt of a `generate` call once and fans the outputs back out.
+
+    A prompt appearing k times is sent with n = k * (the requested n): one prefill, k times
+    the samples, each duplicate getting its own. Sampling is independent per sample, so this
+    is statistically the same as sending the prompt k times. Deterministic calls (temperature
+    0 or a fixed seed) would give every copy the same output anyway; their prompts are sent
+    once with the requested n and the output is copied.
+    """
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.prompts_in = 0
+        self.prompts_sent = 0
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def generate(self, prompts, sampling_params, stage: Optional[str] = None, **kwargs) -> List[RequestOutput]:
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        positions: Dict[str, List[int]] = {}
+        for idx, prompt in enumerate(prompts):
+            positions.setdefault(prompt, []).append(idx)
+        self.prompts_in += len(prompts)
+        self.prompts_sent += len(positions)
+
+        n = getattr(sampling_params, "n", 1) or 1
+        deterministic = getattr(sampling_params, "temperature", 1.0) == 0 or \
+            getattr(sampling_params, "seed", None) is not None
+        # One submission per number of copies, since a call takes a single `n`
+        by_copies: Dict[int, List[str]] = {}
+        for prompt, idxs in positions.items():
+            by_copies.setdefault(1 if deterministic else len(idxs), []).append(prompt)
+
+        results: List[Optional[RequestOutput]] = [None] * len(prompts)
+        for copies, unique in by_copies.items():
+            params = sampling_params if copies == 1 else with_n(sampling_params, copies * n)
+            for prompt, output in zip(unique, self.llm.generate(unique, params, stage=stage, **kwargs)):
+                output = RequestOutput.from_output(output)
+                for copy_idx, idx in enumerate(positions[prompt]):
+                    samples = output.outputs if deterministic else output.outputs[copy_idx * n: (copy_idx + 1) * n]
+                    results[idx] = RequestOutput(
+                        request_id=str(idx), prompt=prompt,
+                        outputs=[dataclasses.replace(sample, index=i) for i, sample in enumerate(samples)],
+                        prompt_token_ids=output.prompt_token_ids, finished=output.finished,
+                        # Only the first copy was prefilled
+                        num_cached_tokens=output.num_cached_tokens if copy_idx == 0 or not output.prompt_token_ids
+                        else len(output.prompt_token_ids))
+        return results
+
+    def stats(self) -> Dict[str, float]:
+        return {"prompts": self.prompts_in, "sent": self.prompts_sent,
+                "dedup ratio": self.prompts_in / self.prompts_sent if self.prompts_sent else 1.0}
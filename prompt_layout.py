@@ -0,0 +1,55 @@
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def prefix_order(prompts: List[str]) -> np.ndarray:
+    """
+    Indices that sort `prompts` lexicographically, so prompts sharing a prefix (instructions,
+    questionnaire, persona, ...) are next to each other in a submission and hit the engine's
+    prefix cache while the shared blocks are still resident.
+    """
+    return np.asarray(sorted(range(len(prompts)), key=prompts.__getitem__), dtype=np.int64)
+
+
+class PrefixCacheStats:
+    """Prompt tokens served from the engine's prefix cache, per stage."""
+
+    def __init__(self):
+        self.cached_tokens: Dict[str, int] = defaultdict(int)
+        self.prompt_tokens: Dict[str, int] = defaultdict(int)
+
+    def record(self, stage: Optional[str], outputs):
+        for output in outputs:
+            cached = getattr(output, "num_cached_tokens", None)
+            # Engines without prefix caching (or cached responses) don't report it
+            if cached is None or not output.prompt_token_ids:
+                continue
+            self.cached_tokens[stage] += cached
+            self.prompt_tokens[stage] += len(output.prompt_token_ids)
+
+    def report(self) -> Dict[str, float]:
+        """{stage: fraction of prompt tokens that were prefix-cache hits}"""
+        return {stage: self.cached_tokens[stage] / total for stage, total in self.prompt_tokens.items() if total}
+
+    def reset(self):
+        self.cached_tokens.clear()
+        self.prompt_tokens.clear()
+
+
+prefix_cache_stats = PrefixCacheStats()
+
+
+def generate_in_prefix_order(llm, prompts: List[str], sampling_params, stage: Optional[str] = None) -> list:
+    """
+    `llm.generate` with the prompts submitted in prefix order. Outputs come back in the
+    original prompt order, and the prefix-cache hit rate is recorded under `stage`.
+    """
+    order = prefix_order(prompts)
+    outputs = llm.generate([prompts[i] for i in order], sampling_params, stage=stage)
+    prefix_cache_stats.record(stage, outputs)
+    restored = [None] * len(prompts)
+    for position, idx in enumerate(order):
+        restored[idx] = outputs[position]
+    return restored
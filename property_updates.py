@@ -1,60 +1,177 @@
-from typing import List
+import math
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 
-from judge_prompting import construct_judge_prompt
+import torch
 
+from judge_prompting import construct_chained_judge_prompt, construct_judge_prompt
+from prompt_chaining import chain_stats
+from prompt_layout import generate_in_prefix_order
+from stage_config import stage_profiles
 
-def llm_judge(llm, sampling_params, final_response: List[str], all_questions, all_replies) -> List[str]:
-    # Judge the agreement between the two agents
+
+def build_judge_prompts(final_response: List[str], all_questions, all_replies,
+                        chain_prefixes: Optional[List[str]] = None) -> List[str]:
+    """Judge prompts of every pair, or with `chain_prefixes`, continuations of those sequences."""
+    if chain_prefixes is not None:
+        return [construct_chained_judge_prompt(prefix) for prefix in chain_prefixes]
     all_judge_prompts = []
-    all_final_replies = []
     for idx, f_response in enumerate(final_response):
         question = all_questions[idx]
         reply_text = all_replies[idx]
         final_reply = f_response
-        all_final_replies.append(final_reply)
         all_judge_prompts.append(construct_judge_prompt(question, reply_text, final_reply))
+    return all_judge_prompts
+
 
-    grade = [r.outputs[0].text for r in llm.generate(all_judge_prompts, sampling_params)]
+def log_grades(grade: List[str], all_judge_prompts: List[str]):
     with open("./grade_log.txt", "a") as f:
         f.write(f"grade is {grade} for the conversation: \n"
                 f"{all_judge_prompts}\n\n\n")
+
+
+def llm_judge(llm, sampling_params, final_response: List[str], all_questions, all_replies,
+              chain_prefixes: Optional[List[str]] = None) -> List[str]:
+    # Judge the agreement between the two agents
+    all_judge_prompts = build_judge_prompts(final_response, all_questions, all_replies, chain_prefixes)
+    if chain_prefixes is not None:
+        chain_stats.check(llm, "judge", chain_prefixes, all_judge_prompts)
+    grade = [r.outputs[0].text for r in generate_in_prefix_order(
+        llm, all_judge_prompts, stage_profiles.sampling_params(sampling_params, "judge"), stage="judge")]
+    log_grades(grade, all_judge_prompts)
     return grade
 
 
-def update_properties(llm, sampling_params, final_response, all_questions, all_replies, all_pairs, agent_properties_lst,
-                      agents_loc, step_sz, cur_agreements):
-    grade = llm_judge(llm, sampling_params, final_response, all_questions, all_replies)
+# First generated token of each grade; "-1" may also be a single token
+GRADE_TOKENS = {"-": -1, "-1": -1, "0": 0, "1": 1}
+GRADE_VALUES = torch.tensor([-1.0, 0.0, 1.0])
+
+
+def grade_probabilities(output, strict=False) -> List[float]:
+    """
+    P(-1), P(0), P(1) of one judge output, from the logprobs of its first generated token
+    renormalised over the grade tokens.
+    """
+    probs = [0.0, 0.0, 0.0]
+    logprobs = output.outputs[0].logprobs
+    for logprob in (logprobs[0].values() if logprobs else ()):
+        grade = GRADE_TOKENS.get((logprob.decoded_token or "").strip())
+        if grade is not None:
+            probs[grade + 1] += math.exp(logprob.logprob)
+    total = sum(probs)
+    if total == 0:
+        if strict:
+            raise ValueError(f"no grade token among the judge logprobs of request {output.request_id}")
+        print("no grade token among the judge logprobs")
+        # Same as an unparsable sampled grade: assume average agreement
+        return [0.0, 1.0, 0.0]
+    return [p / total for p in probs]
+
+
+@dataclass
+class JudgeScoring:
+    """
+    Judging by the logprobs of the grade tokens, from a single prefill pass (max_tokens=1).
+
+    `rule` maps the result to movement: "hard" uses the most likely grade, "expected" the
+    expected agreement in [-1, 1], and "threshold" the sign of the expected agreement when it
+    is at least `threshold` away from 0 (else no movement).
+    """
+    rule: str = "hard"
+    threshold: float = 0.5
 
-    # Update the current positions of the agents
-    for idx, g in enumerate(grade):
-        idx_0 = all_pairs[idx][0]
-        idx_1 = all_pairs[idx][1]
+    def scores(self, outputs, strict=False) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Most likely grade (long) and expected agreement (float) of every judge output."""
+        probs = torch.tensor([grade_probabilities(output, strict) for output in outputs],
+                             dtype=torch.float32).reshape(-1, 3)
+        return probs.argmax(dim=1) - 1, probs @ GRADE_VALUES
 
+    def agreements(self, outputs, strict=False) -> torch.Tensor:
+        return self.apply(*self.scores(outputs, strict))
+
+    def agreements_from_probabilities(self, probs) -> torch.Tensor:
+        """`agreements` from (N, 3) grade probabilities of another judge, ordered -1, 0, 1."""
+        probs = torch.as_tensor(probs, dtype=torch.float32).reshape(-1, 3)
+        return self.apply(probs.argmax(dim=1) - 1, probs @ GRADE_VALUES)
+
+    def apply(self, grades: torch.Tensor, expected: torch.Tensor) -> torch.Tensor:
+        """Maps the most likely grades and expected agreements to movement under `rule`."""
+        if self.rule == "hard":
+            return grades
+        if self.rule == "expected":
+            return expected
+        if self.rule == "threshold":
+            return torch.where(expected.abs() >= self.threshold, expected.sign(), 0).long()
+        raise ValueError(f"unknown movement rule {self.rule!r}")
+
+
+def llm_judge_scores(llm, sampling_params, final_response: List[str], all_questions, all_replies,
+                     scoring: JudgeScoring, chain_prefixes: Optional[List[str]] = None) -> torch.Tensor:
+    """`llm_judge` in scoring mode: returns the agreement of every pair under `scoring.rule`."""
+    all_judge_prompts = build_judge_prompts(final_response, all_questions, all_replies, chain_prefixes)
+    if chain_prefixes is not None:
+        chain_stats.check(llm, "judge", chain_prefixes, all_judge_prompts)
+    outputs = generate_in_prefix_order(llm, all_judge_prompts, stage_profiles.sampling_params(sampling_params,
+                                                                                              "judge_scoring"),
+                                       stage="judge")
+    agreements = scoring.agreements(outputs, strict=stage_profiles.strict("judge_scoring"))
+    log_grades([f"{a:.3f}" for a in agreements.tolist()], all_judge_prompts)
+    return agreements
+
+
+def parse_grades(grade: List[str], strict=False) -> torch.Tensor:
+    """
+    Parses the judge outputs into an int tensor, one agreement score per pair.
+    With `strict` (constrained judge decoding), an output other than -1, 0 or 1 raises instead.
+    """
+    values = []
+    for g in grade:
         try:
-            g_val = int(g)
-            cur_agreements.append(g_val)
-        except:
+            value = int(g)
+            if strict and value not in (-1, 0, 1):
+                raise ValueError(f"judge grade out of range: {g!r}")
+            values.append(value)
+        except ValueError:
+            if strict:
+                raise ValueError(f"invalid judge output {g!r}")
             print("non-integer judge output")
             # Very rarely happens, but assume average agreement if reward not shown
-            cur_agreements.append(0)
-            continue
-
-        loc_1 = agents_loc[idx_0]
-        loc_2 = agents_loc[idx_1]
-        diff_vec = loc_1 - loc_2
-
-        # Don't move if g_val == 0
-        if g_val == -1:
-            # Move Apart by step_sz
-            agents_loc[idx_1] -= diff_vec * step_sz
-            agents_loc[idx_0] += diff_vec * step_sz
-        elif g_val == 1:
-            # Move Closer by step_sz
-            agents_loc[idx_1] += diff_vec * step_sz
-            agents_loc[idx_0] -= diff_vec * step_sz
+            values.append(0)
+    return torch.tensor(values, dtype=torch.long)
+
+
+def move_agents(agents_loc, all_pairs, grades, step_sz):
+    """
+    Moves every pair at once: closer by step_sz when the judge says they agree (1), apart when
+    they disagree (-1), not at all otherwise. Pairs are disjoint, so this matches updating
+    them one after another.
+    """
+    pairs = torch.as_tensor(all_pairs, dtype=torch.long).reshape(-1, 2)
+    idx_0, idx_1 = pairs[:, 0], pairs[:, 1]
+    if not grades.is_floating_point():
+        # Don't move if g_val == 0 (or anything but -1 / 1)
+        grades = torch.where(grades.abs() == 1, grades, 0)
+
+    diff_vec = agents_loc[idx_0] - agents_loc[idx_1]
+    step = diff_vec * step_sz * grades.to(agents_loc.dtype)[:, None]
+    agents_loc.index_add_(0, idx_0, -step)
+    agents_loc.index_add_(0, idx_1, step)
 
     # Adjust for agents that have went off the grid [0, 1] x [0, 1]
-    agents_loc[agents_loc > 1] = 1
-    agents_loc[agents_loc < 0] = 0
+    return agents_loc.clamp_(0, 1)
 
-    return agents_loc
+
+def update_properties(llm, sampling_params, final_response, all_questions, all_replies, all_pairs, agent_properties_lst,
+                      agents_loc, step_sz, scoring: Optional[JudgeScoring] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Judges every conversation and moves the agents accordingly, by sampled grades or, with
+    `scoring`, by the grade logprobs.
+    Returns the updated locations and the agreement score of every pair.
+    """
+    if scoring is not None:
+        cur_agreements = llm_judge_scores(llm, sampling_params, final_response, all_questions, all_replies, scoring)
+    else:
+        grade = llm_judge(llm, sampling_params, final_response, all_questions, all_replies)
+        cur_agreements = parse_grades(grade, strict=stage_profiles.strict("judge"))
+    agents_loc = move_agents(agents_loc, all_pairs, cur_agreements, step_sz)
+    return agents_loc, cur_agreements
@@ -0,0 +1,249 @@
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from assign_pairs import match_in_rounds
+
+# Random targets tried per rewired tie before it is kept with a fresh weight instead
+MAX_REWIRE_DRAWS = 64
+
+
+class SocialGraph:
+    """
+    Sparse social network over the agents, stored as CSR arrays.
+
+    Row i of (indptr, indices, weights) lists the agents i talks to and how strong each tie
+    is. Conversation partners are drawn from these ties instead of from Euclidean nearest
+    neighbors, so pairing costs O(edges sampled) and needs no distance computation.
+    Judge outcomes strengthen ties (agreement) or weaken them until they get rewired
+    to a random agent (disagreement).
+
+    Rewiring moves a tie from one row to another, so every row keeps a few free slots at its
+    start (index -1, weight 0) and its `degree` ties after them. A rewired tie is patched in
+    place; only when a row runs out of free slots does the layout get rebuilt.
+    """
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, weights: Optional[np.ndarray] = None,
+                 seed: Optional[int] = None):
+        indptr = np.asarray(indptr, dtype=np.int64)
+        indices = np.asarray(indices, dtype=np.int64)
+        weights = np.ones(len(indices), dtype=np.float32) if weights is None else np.asarray(weights, dtype=np.float32)
+        self.rng = np.random.default_rng(seed)
+        self._layout(np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)), indices, weights, len(indptr) - 1)
+
+    def _layout(self, src: np.ndarray, dst: np.ndarray, weights: np.ndarray, num_agents: int):
+        """
+        Lays the ties out row by row, sorted by neighbor id so (src, dst) ties can be looked
+        up with a binary search, with a quarter of each row's degree (at least 2) free slots.
+        """
+        order = np.lexsort((dst, src))
+        src, dst, weights = src[order], dst[order], weights[order]
+        self.degree = np.bincount(src, minlength=num_agents)
+        self.indptr = np.zeros(num_agents + 1, dtype=np.int64)
+        np.cumsum(self.degree + self.degree // 4 + 2, out=self.indptr[1:])
+        self.row_of_edge = np.repeat(np.arange(num_agents), np.diff(self.indptr))
+        self.indices = np.full(self.indptr[-1], -1, dtype=np.int64)
+        self.weights = np.zeros(self.indptr[-1], dtype=np.float32)
+        rank = np.arange(len(src)) - np.repeat(np.cumsum(self.degree) - self.degree, self.degree)
+        positions = self.indptr[1:][src] - self.degree[src] + rank
+        self.indices[positions] = dst
+        self.weights[positions] = weights
+        # Free slots get the key of (row - 1, last agent), so the keys stay sorted
+        self._keys = self.row_of_edge * num_agents + self.indices
+
+    @property
+    def num_agents(self) -> int:
+        return len(self.indptr) - 1
+
+    @property
+    def num_edges(self) -> int:
+        return int(self.degree.sum())
+
+    def edges(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """(src, dst, weight) of every tie, by row and neighbor."""
+        live = self.indices >= 0
+        return self.row_of_edge[live], self.indices[live], self.weights[live]
+
+    @classmethod
+    def from_edges(cls, src, dst, num_agents: int, symmetric=True, seed: Optional[int] = None) -> "SocialGraph":
+        """Builds the CSR arrays from edge endpoints, dropping self loops and duplicate edges."""
+        src, dst = np.asarray(src, dtype=np.int64), np.asarray(dst, dtype=np.int64)
+        if symmetric:
+            src, dst = np.concatenate([src, dst]), np.concatenate([dst, src])
+        keys = np.sort(src[src != dst] * num_agents + dst[src != dst])
+        keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+        indptr = np.zeros(num_agents + 1, dtype=np.int64)
+        np.cumsum(np.bincount(keys // num_agents, minlength=num_agents), out=indptr[1:])
+        return cls(indptr, keys % num_agents, seed=seed)
+
+    @classmethod
+    def from_edge_list(cls, path: str, num_agents: Optional[int] = None, symmetric=True,
+                       seed: Optional[int] = None) -> "SocialGraph":
+        """Loads a whitespace separated `src dst` edge list; lines starting with '#' are ignored."""
+        edges = np.loadtxt(path, dtype=np.int64, comments="#", ndmin=2)
+        if edges.size and edges.min() < 0:
+            raise ValueError(f"{path} has a negative agent id {edges.min()}")
+        if num_agents and edges.size and edges.max() >= num_agents:
+            raise ValueError(f"{path} has agent id {edges.max()}, but the simulation only has {num_agents} agents")
+        num_agents = num_agents or int(edges.max()) + 1
+        return cls.from_edges(edges[:, 0], edges[:, 1], num_agents, symmetric=symmetric, seed=seed)
+
+    @classmethod
+    def small_world(cls, num_agents: int, degree=10, rewire_prob=0.1, seed: Optional[int] = None) -> "SocialGraph":
+        """Watts-Strogatz: a ring lattice with `degree` neighbors per agent, each tie rewired with `rewire_prob`."""
+        rng = np.random.default_rng(seed)
+        src = np.repeat(np.arange(num_agents), degree // 2)
+        dst = (src + np.tile(np.arange(1, degree // 2 + 1), num_agents)) % num_agents
+        rewire = rng.random(len(dst)) < rewire_prob
+        dst[rewire] = rng.integers(0, num_agents, rewire.sum())
+        return cls.from_edges(src, dst, num_agents, seed=seed)
+
+    @classmethod
+    def scale_free(cls, num_agents: int, degree=10, exponent=2.5, seed: Optional[int] = None) -> "SocialGraph":
+        """
+        Chung-Lu graph with a power-law degree distribution P(k) ~ k^-exponent and `degree`
+        ties per agent on average. Unlike preferential attachment, it is sampled in one shot.
+        """
+        rng = np.random.default_rng(seed)
+        expected_degree = (np.arange(num_agents) + 1.0) ** (-1.0 / (exponent - 1))
+        p = expected_degree / expected_degree.sum()
+        num_ties = num_agents * degree // 2
+        return cls.from_edges(rng.choice(num_agents, num_ties, p=p), rng.choice(num_agents, num_ties, p=p),
+                              num_agents, seed=seed)
+
+    def _sort_rows(self, rows: np.ndarray):
+        """Re-sorts the ties of the given (distinct) rows by neighbor id after they were patched."""
+        lengths = self.indptr[rows + 1] - self.indptr[rows]
+        positions = np.repeat(self.indptr[rows], lengths) + np.arange(lengths.sum()) \
+            - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        # Free slots (-1) sort to the front of their row
+        by_dst = np.lexsort((self.indices[positions], self.row_of_edge[positions]))
+        self.indices[positions] = self.indices[positions][by_dst]
+        self.weights[positions] = self.weights[positions][by_dst]
+        self._keys[positions] = self.row_of_edge[positions] * self.num_agents + self.indices[positions]
+
+    def edge_positions(self, src, dst) -> np.ndarray:
+        """Position of each src -> dst tie in the CSR arrays, -1 if there is none."""
+        keys = np.asarray(src, dtype=np.int64) * self.num_agents + np.asarray(dst, dtype=np.int64)
+        if len(self._keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self._keys, keys), len(self._keys) - 1)
+        return np.where((self._keys[positions] == keys) & (self.indices[positions] >= 0), positions, -1)
+
+    def sample_candidates(self, num_samples=3, weights: Optional[np.ndarray] = None) -> torch.Tensor:
+        """
+        Draws `num_samples` neighbors of every agent, proportionally to the tie weights
+        (or to `weights`, one per edge, if given).
+        Returns an (N, num_samples) LongTensor, -1 for agents without ties.
+        """
+        weights = self.weights if weights is None else weights
+        cum_weights = np.concatenate([[0.0], np.cumsum(weights, dtype=np.float64)])
+        row_lo, row_hi = cum_weights[self.indptr[:-1]], cum_weights[self.indptr[1:]]
+        u = row_lo[:, None] + self.rng.random((self.num_agents, num_samples)) * (row_hi - row_lo)[:, None]
+        positions = np.searchsorted(cum_weights, u, side="right") - 1
+        # Stay inside the row despite floating point round-off
+        positions = np.clip(positions, (self.indptr[1:] - self.degree)[:, None], np.maximum(self.indptr[1:, None] - 1, 0))
+        candidates = np.where((row_hi > row_lo)[:, None], self.indices[np.minimum(positions, len(self.indices) - 1)], -1)
+        return torch.from_numpy(candidates)
+
+    def sample_pairs(self, num_samples=3, resolve="lowest_id", active: Optional[torch.Tensor] = None) -> List[Tuple[int, int]]:
+        """
+        Pairs agents with one of their sampled neighbors, see `assign_pairs.match_in_rounds`.
+        If `active` agent ids are given, everybody else is left out of the pairing and active
+        agents only sample among their active neighbors.
+        """
+        if self.num_edges == 0:
+            return []
+        if active is None:
+            candidates = self.sample_candidates(num_samples)
+        else:
+            is_active = np.zeros(self.num_agents, dtype=bool)
+            is_active[torch.as_tensor(active).cpu().numpy()] = True
+            candidates = self.sample_candidates(num_samples, self.weights * is_active[self.indices])
+            candidates[torch.from_numpy(~is_active)] = -1
+        agent1, agent2 = match_in_rounds(candidates, num_samples, resolve=resolve)
+        return list(zip(agent1.tolist(), agent2.tolist()))
+
+    def reinforce(self, all_pairs, grades, strength=0.1, min_weight=0.0) -> int:
+        """
+        Adds `strength * grade` to the ties between each pair, in both directions. Ties whose
+        weight drops to `min_weight` or below are rewired, together with their reverse tie, to a
+        uniformly random agent that isn't already a neighbor, with a fresh weight of 1.
+        Returns the number of rewired ties, counting each direction.
+        """
+        pairs = np.asarray(all_pairs, dtype=np.int64).reshape(-1, 2)
+        grades = torch.as_tensor(grades).cpu().numpy().astype(np.float32)
+        src = np.concatenate([pairs[:, 0], pairs[:, 1]])
+        dst = np.concatenate([pairs[:, 1], pairs[:, 0]])
+        positions = self.edge_positions(src, dst)
+        found = positions >= 0
+        np.add.at(self.weights, positions[found], strength * np.concatenate([grades, grades])[found])
+
+        weak = np.unique(positions[found][self.weights[positions[found]] <= min_weight])
+        if weak.size == 0:
+            return 0
+        weak = self.rng.permutation(weak)
+        return self._rewire(self.row_of_edge[weak], self.indices[weak], min_weight)
+
+    def _rewire(self, agents: np.ndarray, olds: np.ndarray, min_weight: float) -> int:
+        """
+        Moves the weak agent -> old ties, and their old -> agent reverses, to new targets in
+        place. Works in rounds: every tie draws a target, and of the valid ones, ties that touch
+        distinct rows are applied together. A tie that finds no valid target within
+        MAX_REWIRE_DRAWS draws keeps its neighbor with a fresh weight.
+        """
+        draws_left = np.full(len(agents), MAX_REWIRE_DRAWS)
+        rewired = 0
+        while len(agents):
+            positions = self.edge_positions(agents, olds)
+            # Ties already moved as the reverse of a tie rewired from the other end drop out
+            weak = positions >= 0
+            weak[weak] = self.weights[positions[weak]] <= min_weight
+            agents, olds, positions, draws_left = agents[weak], olds[weak], positions[weak], draws_left[weak]
+            if not len(agents):
+                break
+            reverse = self.edge_positions(olds, agents)
+            two_way = reverse >= 0
+            new = self.rng.integers(0, self.num_agents, len(agents))
+            valid = (new != agents) & (new != olds) & (self.edge_positions(agents, new) < 0)
+            valid &= ~two_way | (self.edge_positions(new, agents) < 0)
+            full = two_way & (self.degree[new] == self.indptr[new + 1] - self.indptr[new])
+
+            # Apply the first tie (in the random order) of every row the ties touch
+            candidates = np.flatnonzero(valid & ~full)
+            both = two_way[candidates]
+            owners = np.concatenate([candidates, candidates[both], candidates[both]])
+            rows = np.concatenate([agents[candidates], olds[candidates[both]], new[candidates[both]]])
+            by_row = np.lexsort((owners, rows))
+            first = np.ones(len(rows), dtype=bool)
+            first[1:] = rows[by_row][1:] != rows[by_row][:-1]
+            lost = np.zeros(len(agents), dtype=bool)
+            lost[owners[by_row][~first]] = True
+            applied = np.zeros(len(agents), dtype=bool)
+            applied[candidates] = ~lost[candidates]
+
+            idx = np.flatnonzero(applied)
+            self.indices[positions[idx]] = new[idx]
+            self.weights[positions[idx]] = 1.0
+            idx = idx[two_way[idx]]
+            # Fill each reverse tie's slot with its row's first tie, which becomes a free slot
+            firsts = self.indptr[olds[idx] + 1] - self.degree[olds[idx]]
+            self.indices[reverse[idx]], self.weights[reverse[idx]] = self.indices[firsts], self.weights[firsts]
+            self.indices[firsts], self.weights[firsts] = -1, 0.0
+            self.degree[olds[idx]] -= 1
+            slots = self.indptr[new[idx] + 1] - self.degree[new[idx]] - 1
+            self.indices[slots], self.weights[slots] = agents[idx], 1.0
+            self.degree[new[idx]] += 1
+            self._sort_rows(np.unique(np.concatenate([agents[applied], olds[idx], new[idx]])))
+            rewired += int(applied.sum()) + len(idx)
+
+            draws_left[~valid] -= 1
+            exhausted = draws_left == 0
+            self.weights[positions[exhausted]] = 1.0
+            if (valid & full).any():
+                # A new target's row is full: lay the ties out again with fresh free slots
+                self._layout(*self.edges(), self.num_agents)
+            keep = ~applied & ~exhausted
+            agents, olds, draws_left = agents[keep], olds[keep], draws_left[keep]
+        return rewired
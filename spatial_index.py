@@ -0,0 +1,138 @@
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+from knn_backends import _as_numpy, grid_knn_rows, grid_size
+
+
+class SpatialIndex:
+    """
+    Grid neighbor index over the agent locations that lives across iterations.
+
+    Agents only move by `diff_vec * step_sz` per iteration, so most of the cached k-NN table
+    stays valid. After each position update, `update` moves the agents that changed cells
+    between their cell buckets and recomputes only the rows whose search block touches a cell
+    a moved agent left or entered. The work per iteration therefore scales with the number
+    of moved agents, not N.
+
+    The buckets are laid out cell after cell in `slots`, like `knn_backends.bucket_points`,
+    but every cell keeps some free slots (-1) so agents can enter it without shifting the
+    others. Only when a cell runs out of room does the whole layout get rebuilt.
+    """
+
+    def __init__(self, locs, k, cells_per_side=None):
+        self.k = k
+        self.pts = _as_numpy(locs).copy()
+        self.g = cells_per_side or grid_size(len(self.pts), k)
+        self.cell_of = self._cells(self.pts)
+        self._layout()
+        self.neighbors, self.radii = grid_knn_rows(self.pts, np.arange(len(self.pts)), k, self.g,
+                                                   self.slots, self.cell_start)
+        # Rows by the block radius their search needed, to find the rows a changed cell affects
+        self.rows_by_radius = defaultdict(set)
+        for radius in np.unique(self.radii):
+            self.rows_by_radius[int(radius)] = set(np.flatnonzero(self.radii == radius).tolist())
+        # Number of rows recomputed by the last `update`, to keep an eye on the incremental cost
+        self.last_update_rows = len(self.pts)
+        self.rebuilds = 0
+
+    def _cells(self, pts):
+        xy = np.clip((pts * self.g).astype(np.int64), 0, self.g - 1)
+        return xy[:, 0] * self.g + xy[:, 1]
+
+    def _layout(self):
+        """Lays the buckets out again, with half a cell's count (at least 2) of free slots per cell."""
+        self.cell_count = np.bincount(self.cell_of, minlength=self.g * self.g)
+        capacity = self.cell_count + self.cell_count // 2 + 2
+        self.cell_start = np.zeros(self.g * self.g + 1, dtype=np.int64)
+        np.cumsum(capacity, out=self.cell_start[1:])
+        order = np.argsort(self.cell_of, kind="stable")
+        rank = np.arange(len(order)) - np.repeat(np.cumsum(self.cell_count) - self.cell_count, self.cell_count)
+        self.slot_of = np.empty(len(self.pts), dtype=np.int64)
+        self.slot_of[order] = self.cell_start[self.cell_of[order]] + rank
+        self.slots = np.full(self.cell_start[-1], -1, dtype=np.int64)
+        self.slots[self.slot_of] = np.arange(len(self.pts))
+
+    def _cell_members(self, cells) -> np.ndarray:
+        """Ids of the agents in `cells`."""
+        starts, counts = self.cell_start[cells], self.cell_count[cells]
+        flat = np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self.slots[flat]
+
+    def _move_buckets(self, ids, old_cells, new_cells):
+        """Takes `ids` out of their old cells and puts them into their new ones."""
+        for agent, cell in zip(ids.tolist(), old_cells.tolist()):
+            # Fill the hole with the cell's last agent
+            pos, last = self.slot_of[agent], self.cell_start[cell] + self.cell_count[cell] - 1
+            self.slots[pos] = self.slots[last]
+            self.slot_of[self.slots[pos]] = pos
+            self.slots[last] = -1
+            self.cell_count[cell] -= 1
+        cells, arrivals = np.unique(new_cells, return_counts=True)
+        if (self.cell_count[cells] + arrivals > self.cell_start[cells + 1] - self.cell_start[cells]).any():
+            self.rebuilds += 1
+            self._layout()
+            return
+        for agent, cell in zip(ids.tolist(), new_cells.tolist()):
+            pos = self.cell_start[cell] + self.cell_count[cell]
+            self.slots[pos] = agent
+            self.slot_of[agent] = pos
+            self.cell_count[cell] += 1
+
+    def _rows_near(self, changed_cells, radius) -> np.ndarray:
+        """Rows searched with `radius` whose block contains one of `changed_cells`."""
+        rows = self.rows_by_radius.get(radius)
+        if not rows:
+            return np.zeros(0, dtype=np.int64)
+        cx, cy = changed_cells // self.g, changed_cells % self.g
+        if len(rows) <= (2 * radius + 1) ** 2:
+            # Few rows this wide: check them against the changed cells directly
+            rows = np.fromiter(rows, dtype=np.int64, count=len(rows))
+            rx, ry = self.cell_of[rows] // self.g, self.cell_of[rows] % self.g
+            near = ((np.abs(rx[:, None] - cx[None, :]) <= radius) &
+                    (np.abs(ry[:, None] - cy[None, :]) <= radius)).any(axis=1)
+            return rows[near]
+        # Otherwise collect the agents of the cells within `radius` of a changed cell
+        offsets = np.arange(-radius, radius + 1)
+        nx = (cx[:, None, None] + offsets[None, :, None]).repeat(len(offsets), axis=2).ravel()
+        ny = (cy[:, None, None] + offsets[None, None, :]).repeat(len(offsets), axis=1).ravel()
+        inside = (nx >= 0) & (nx < self.g) & (ny >= 0) & (ny < self.g)
+        members = self._cell_members(np.unique(nx[inside] * self.g + ny[inside]))
+        return members[self.radii[members] == radius]
+
+    def update(self, moved_ids, locs):
+        """
+        Brings the index up to date with `locs` for the agents in `moved_ids`.
+        Agents not listed are assumed not to have moved.
+        """
+        moved = np.unique(torch.as_tensor(moved_ids, dtype=torch.long).cpu().numpy())
+        self.last_update_rows = 0
+        if moved.size == 0:
+            return
+
+        old_cells = self.cell_of[moved]
+        self.pts[moved] = _as_numpy(locs[torch.as_tensor(moved)])
+        new_cells = self._cells(self.pts[moved])
+        self.cell_of[moved] = new_cells
+        crossed = old_cells != new_cells
+        if crossed.any():
+            self._move_buckets(moved[crossed], old_cells[crossed], new_cells[crossed])
+
+        # A row searched the block of radius r around its cell, so it only needs recomputing when
+        # a changed cell lies within r cells of it
+        changed = np.unique(np.concatenate([old_cells, new_cells]))
+        rows = np.unique(np.concatenate([moved] + [self._rows_near(changed, radius)
+                                                   for radius in list(self.rows_by_radius)]))
+        old_radii = self.radii[rows]
+        self.neighbors[rows], self.radii[rows] = grid_knn_rows(self.pts, rows, self.k, self.g,
+                                                               self.slots, self.cell_start)
+        for row, old, new in zip(rows.tolist(), old_radii.tolist(), self.radii[rows].tolist()):
+            if old != new:
+                self.rows_by_radius[old].discard(row)
+                self.rows_by_radius[new].add(row)
+        self.last_update_rows = len(rows)
+
+    def knn(self):
+        """Cached (N, k) LongTensor of neighbor ids, nearest first, padded with -1."""
+        return torch.from_numpy(self.neighbors)
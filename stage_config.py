@@ -0,0 +1,114 @@
+import json
+from dataclasses import dataclass, field, replace
+from typing import Dict, List, Optional
+
+try:
+    import vllm
+except ImportError:
+    # CPU-only setups run on the mock backend
+    vllm = None
+
+if vllm is None:
+    from mock_llm import MockGuidedDecodingParams as GuidedDecodingParams
+else:
+    try:
+        from vllm.sampling_params import GuidedDecodingParams
+    except ImportError:
+        # Older vLLM: only the token limits and stop sequences apply
+        GuidedDecodingParams = None
+
+# Sampling fields every stage takes from the run's base parameters
+SHARED_FIELDS = ("temperature", "top_p", "n", "seed", "logprobs")
+
+
+@dataclass
+class StageProfile:
+    """
+    How one stage decodes. Unset fields keep the run's base sampling parameters.
+
+    With `per_item`, the output is one `regex` match per questionnaire item, separated by
+    ", ", and `max_tokens` is counted per item.
+    """
+    max_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    regex: Optional[str] = None
+    per_item: bool = False
+    temperature: Optional[float] = None
+    # Number of top logprobs to return per generated token
+    logprobs: Optional[int] = None
+
+    def full_regex(self, num_items: Optional[int] = None) -> Optional[str]:
+        if self.regex is None or not self.per_item:
+            return self.regex
+        return f"({self.regex})(, ({self.regex})){{{num_items - 1}}}"
+
+    def token_limit(self, num_items: Optional[int] = None) -> Optional[int]:
+        if self.max_tokens is None or not self.per_item:
+            return self.max_tokens
+        return self.max_tokens * num_items
+
+
+STOP = ["<|eot_id|>", "\n"]
+QUESTIONNAIRE_PROFILE = StageProfile(max_tokens=3, stop=STOP, regex="[01]", per_item=True)
+DEFAULT_PROFILES = {
+    "conversation": StageProfile(max_tokens=256),
+    "reply": StageProfile(max_tokens=256),
+    # "-1" can take two tokens
+    "judge": StageProfile(max_tokens=2, stop=STOP, regex="-1|0|1"),
+    # Only the prefill and the first token's logprobs are needed; greedy, so the cache keeps it
+    "judge_scoring": StageProfile(max_tokens=1, regex="-1|0|1", temperature=0.0, logprobs=5),
+    "questionnaire_scoring": StageProfile(max_tokens=1, regex="0|1", temperature=0.0, logprobs=5),
+    "questionnaire": QUESTIONNAIRE_PROFILE,
+    "initial_questionnaire": QUESTIONNAIRE_PROFILE,
+}
+
+
+@dataclass
+class StageProfiles:
+    """
+    The decoding profile of every simulation stage. Stages with a regex are decoded under that
+    constraint. When the backend enforces it (`supports_guided_decoding`), their outputs are
+    parsed strictly: an unparsable output is an error instead of a silent default grade or
+    answer.
+    """
+    profiles: Dict[str, StageProfile] = field(default_factory=lambda: dict(DEFAULT_PROFILES))
+    enabled: bool = True
+    # Whether the backend declared that it enforces the constraint, rather than e.g. a server
+    # that may ignore it
+    guided_decoding: bool = True
+
+    def load(self, path: str):
+        """Overrides profile fields from a JSON file like {"judge": {"max_tokens": 3}}."""
+        with open(path) as f:
+            for stage, fields in json.load(f).items():
+                self.profiles[stage] = replace(self.profiles.get(stage, StageProfile()), **fields)
+
+    def get(self, stage: str) -> Optional[StageProfile]:
+        return self.profiles.get(stage) if self.enabled else None
+
+    def constrained(self, stage: str) -> bool:
+        profile = self.get(stage)
+        return profile is not None and profile.regex is not None and GuidedDecodingParams is not None
+
+    def strict(self, stage: str) -> bool:
+        """Whether the stage's outputs can only be well formed, so others should raise."""
+        return self.guided_decoding and self.constrained(stage)
+
+    def sampling_params(self, base, stage: str, num_items: Optional[int] = None):
+        """`base` with the stage's token limit, stop sequences and output constraint applied."""
+        profile = self.get(stage)
+        if profile is None:
+            return base
+        params = {name: getattr(base, name) for name in SHARED_FIELDS}
+        limit = profile.token_limit(num_items)
+        params["max_tokens"] = limit if limit is not None else base.max_tokens
+        params["stop"] = profile.stop if profile.stop is not None else base.stop
+        for name in ("temperature", "logprobs"):
+            if getattr(profile, name) is not None:
+                params[name] = getattr(profile, name)
+        if self.constrained(stage):
+            params["guided_decoding"] = GuidedDecodingParams(regex=profile.full_regex(num_items))
+        return type(base)(**params)
+
+
+stage_profiles = StageProfiles()
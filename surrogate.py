@@ -0,0 +1,174 @@
+import argparse
+import json
+import sqlite3
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from calculate_latent_vec_score import latent_scores_from_matrix
+from log_schemas import StaticAgentProperty2
+from population import ATTRIBUTE_NAMES, Population
+from qeustionnaire_questions import questionnaire_questions
+
+GRADES = np.array([-1, 0, 1])
+FEATURE_NAMES = ["bias", "latent_similarity"] + [f"same_{name}" for name in ATTRIBUTE_NAMES]
+# Each latent dimension counts the points scored on 10 questionnaire items
+MAX_LATENT_SCORE = 10
+
+
+def pair_features(all_pairs, latent_vec, population: Population) -> np.ndarray:
+    """
+    Features of every pair, in FEATURE_NAMES order: a bias, how close the two agents' latent
+    vectors are (1 = identical), and whether they share each demographic attribute.
+    """
+    pairs = np.asarray(all_pairs, dtype=np.int64).reshape(-1, 2)
+    latent_vec = np.asarray(latent_vec, dtype=np.float32)
+    a, b = pairs[:, 0], pairs[:, 1]
+    features = [np.ones(len(pairs)),
+                1 - np.abs(latent_vec[a] - latent_vec[b]).mean(axis=1) / MAX_LATENT_SCORE]
+    features += [population.codes[name][a] == population.codes[name][b] for name in ATTRIBUTE_NAMES]
+    return np.stack(features, axis=1).astype(np.float32)
+
+
+def _softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=1, keepdims=True)
+    probs = np.exp(logits)
+    return probs / probs.sum(axis=1, keepdims=True)
+
+
+class SurrogateJudge:
+    """
+    LLM-free stand-in for the conversation + judge stages.
+
+    A multinomial logistic model over `pair_features` gives the probability of each grade
+    (-1, 0, 1) and grades are sampled from it for all pairs at once. The coefficients can be
+    fitted from the ConversationLog / AgentLog tables of earlier LLM runs with `fit`.
+    """
+
+    def __init__(self, coefficients: Optional[np.ndarray] = None, seed: Optional[int] = None):
+        if coefficients is None:
+            # Hand-set default: similar agents tend to agree, dissimilar ones to disagree
+            coefficients = np.zeros((len(FEATURE_NAMES), len(GRADES)), dtype=np.float32)
+            coefficients[0] = [1.5, 0.0, -1.5]
+            coefficients[1] = [-3.0, 0.0, 3.0]
+            coefficients[2:, 2] = 0.2
+        self.coefficients = np.asarray(coefficients, dtype=np.float32)
+        self.rng = np.random.default_rng(seed)
+
+    def probabilities(self, features: np.ndarray) -> np.ndarray:
+        return _softmax(features @ self.coefficients)
+
+    def judge(self, all_pairs, latent_vec, population: Population) -> torch.Tensor:
+        """Samples one agreement score per pair, like `parse_grades(llm_judge(...))`."""
+        if len(all_pairs) == 0:
+            return torch.zeros(0, dtype=torch.long)
+        probs = self.probabilities(pair_features(all_pairs, latent_vec, population))
+        u = self.rng.random((len(probs), 1))
+        choice = np.minimum((u > probs.cumsum(axis=1)).sum(axis=1), len(GRADES) - 1)
+        return torch.from_numpy(GRADES[choice])
+
+    @classmethod
+    def fit(cls, features: np.ndarray, grades: np.ndarray, l2=1e-3, lr=0.5, steps=2000,
+            seed: Optional[int] = None) -> "SurrogateJudge":
+        """Fits the coefficients by gradient descent on the L2-regularised cross entropy."""
+        targets = (np.asarray(grades)[:, None] == GRADES[None, :]).astype(np.float32)
+        coefficients = np.zeros((features.shape[1], len(GRADES)), dtype=np.float32)
+        for _ in range(steps):
+            grad = features.T @ (_softmax(features @ coefficients) - targets) / len(features)
+            coefficients -= lr * (grad + l2 * coefficients)
+        return cls(coefficients, seed=seed)
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"features": FEATURE_NAMES, "grades": GRADES.tolist(),
+                       "coefficients": self.coefficients.tolist()}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str, seed: Optional[int] = None) -> "SurrogateJudge":
+        with open(path) as f:
+            saved = json.load(f)
+        assert saved["features"] == FEATURE_NAMES, "Surrogate coefficients were fitted on different features"
+        return cls(np.asarray(saved["coefficients"]), seed=seed)
+
+
+def sample_questionnaire(num_agents: int, num_questions: int, rng: np.random.Generator) -> np.ndarray:
+    """Initial 0/1 questionnaire answers, one row per agent."""
+    return rng.integers(0, 2, (num_agents, num_questions), dtype=np.int8)
+
+
+def influence(answers: np.ndarray, all_pairs, grades, adopt_rate: float, rng: np.random.Generator) -> np.ndarray:
+    """
+    Stand-in for the post-conversation questionnaire: after agreeing, each agent adopts every
+    answer it differs on from its partner with probability `adopt_rate`.
+    """
+    pairs = np.asarray(all_pairs, dtype=np.int64).reshape(-1, 2)
+    agreed = pairs[torch.as_tensor(grades).cpu().numpy() == 1]
+    # Both members adopt from what their partner answered before the conversation
+    before = answers[agreed]
+    for side in (0, 1):
+        adopt = rng.random((len(agreed), answers.shape[1])) < adopt_rate
+        answers[agreed[:, side]] = np.where(adopt, before[:, 1 - side], before[:, side])
+    return answers
+
+
+def load_training_data(db_path: str, questions: List[str] = questionnaire_questions) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Features and judge grades of every logged conversation. The latent vectors are recomputed
+    from each agent's questionnaire answers of the iteration before the conversation.
+    """
+    with sqlite3.connect(db_path) as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT agent_id, age, gender, location, urbanicity, ethnicity, education "
+                       "FROM AgentProperties ORDER BY agent_id")
+        properties = cursor.fetchall()
+        cursor.execute("""
+            SELECT c.conv_member_1, c.conv_member_2, c.agreement_score, a1.questionnaire_r, a2.questionnaire_r
+            FROM ConversationLog c
+            JOIN AgentLog a1 ON a1.agent_id = c.conv_member_1 AND a1.iter_idx = c.iteration_idx - 1
+            JOIN AgentLog a2 ON a2.agent_id = c.conv_member_2 AND a2.iter_idx = c.iteration_idx - 1
+        """)
+        conversations = cursor.fetchall()
+
+    agent_codes = {}
+    for col, name in enumerate(ATTRIBUTE_NAMES, start=1):
+        vocab = {value: code for code, value in enumerate(StaticAgentProperty2.ATTRIBUTES[name]["values"])}
+        agent_codes[name] = np.array([vocab[row[col]] for row in properties], dtype=np.uint8)
+
+    members, grades, answers = [], [], []
+    for member_1, member_2, agreement_score, answers_1, answers_2 in conversations:
+        answers_1, answers_2 = json.loads(answers_1), json.loads(answers_2)
+        # Agents that weren't paired have no answers and failed parses are all -1
+        if any(len(a) != len(questions) or -1 in a for a in (answers_1, answers_2)) \
+                or agreement_score not in GRADES:
+            continue
+        members += [member_1, member_2]
+        answers += [answers_1, answers_2]
+        grades.append(agreement_score)
+
+    # One row per conversation member, so pair i is made of rows (2i, 2i + 1)
+    rows = Population({name: codes[np.asarray(members, dtype=np.int64)] for name, codes in agent_codes.items()})
+    latent_vec = latent_scores_from_matrix(questions, np.asarray(answers).reshape(-1, len(questions)))
+    pairs = np.arange(len(members)).reshape(-1, 2)
+    return pair_features(pairs, latent_vec, rows), np.asarray(grades)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit the surrogate judge from the logs of an LLM simulation")
+    parser.add_argument('--db', required=True, help="Path to a simulation's logs.db")
+    parser.add_argument('--out', required=True, help="Where to write the fitted coefficients (JSON)")
+    parser.add_argument('--l2', type=float, default=1e-3, help="L2 regularisation strength")
+    args = parser.parse_args()
+
+    features, grades = load_training_data(args.db)
+    print(f"Fitting the surrogate judge on {len(grades)} conversations")
+    judge = SurrogateJudge.fit(features, grades, l2=args.l2)
+    accuracy = (GRADES[judge.probabilities(features).argmax(axis=1)] == grades).mean()
+    print(f"Training accuracy: {accuracy:.3f}")
+    judge.save(args.out)
+
+
+if __name__ == "__main__":
+    main()
+
+# `python surrogate.py --db "simulations/<timestamp>/simulation_logs/logs.db" --out surrogate.json`
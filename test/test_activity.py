@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+
+from activity import ActivityScheduler
+from population import Population
+
+
+@pytest.mark.parametrize("mode", ["bernoulli", "poisson"])
+def test_activity_rate(mode):
+    scheduler = ActivityScheduler(np.full(10000, 0.2), mode=mode, seed=0)
+    counts = [len(scheduler.active(iter_idx)) for iter_idx in range(20)]
+    assert abs(np.mean(counts) / 10000 - 0.2) < 0.02
+
+
+def test_demographic_rates():
+    population = Population.sample(1000, seed=0)
+    scheduler = ActivityScheduler.from_demographics(population, 0.5, {"gender": {"male": 0.0}}, seed=0)
+    active = scheduler.active(0).numpy()
+    assert len(active) > 0
+    assert all(population.value("gender", agent_id) == "female" for agent_id in active)
@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import torch
+
+from assign_pairs import assign_pairs1, match_in_rounds, unpaired_fraction
+from knn_backends import KNN_BACKENDS
+from spatial_index import SpatialIndex
+
+
+def brute_force_knn_dists(locs, k):
+    all_dists = torch.cdist(locs, locs, compute_mode="donot_use_mm_for_euclid_dist")
+    all_dists.fill_diagonal_(float("inf"))
+    return torch.sort(all_dists, dim=1).values[:, :k]
+
+
+def check_pairs(pairs, num_agents):
+    members = [agent for pair in pairs for agent in pair]
+    assert len(members) == len(set(members)), "An agent was assigned to more than one pair"
+    assert all(0 <= agent < num_agents for agent in members)
+    assert all(agent1 != agent2 for agent1, agent2 in pairs)
+
+
+@pytest.mark.parametrize("backend", sorted(KNN_BACKENDS))
+def test_knn_backends_match_brute_force(backend):
+    torch.manual_seed(0)
+    locs = torch.rand(500, 2)
+    # A tight cluster makes the grid backend widen its search radius for the outliers
+    locs[:100] = 0.5 + locs[:100] * 1e-3
+    neighbors = KNN_BACKENDS[backend](locs, 5)
+
+    assert neighbors.shape == (500, 5)
+    assert not (neighbors == torch.arange(500)[:, None]).any()
+    dists = (locs[neighbors] - locs[:, None]).norm(dim=-1)
+    assert torch.allclose(dists, brute_force_knn_dists(locs, 5), atol=1e-5)
+
+
+@pytest.mark.parametrize("backend", sorted(KNN_BACKENDS))
+def test_knn_backends_pad_missing_neighbors(backend):
+    neighbors = KNN_BACKENDS[backend](torch.rand(3, 2), 4)
+    assert (neighbors[:, 2:] == -1).all()
+
+
+@pytest.mark.parametrize("backend", ["dense"] + sorted(KNN_BACKENDS))
+def test_assign_pairs_pairs_everyone(backend):
+    torch.manual_seed(0)
+    locs = torch.rand(301, 2)
+    pairs = assign_pairs1(locs, 3, backend=backend)
+    check_pairs(pairs, 301)
+    assert len(pairs) == 150
+
+
+@pytest.mark.parametrize("resolve", ["mutual", "lowest_id"])
+def test_parallel_matching(resolve):
+    torch.manual_seed(0)
+    locs = torch.rand(1000, 2)
+    pairs = assign_pairs1(locs, 3, backend="kdtree", matching="parallel", resolve=resolve)
+    check_pairs(pairs, 1000)
+    assert unpaired_fraction(pairs, 1000) == 0
+
+
+def test_match_in_rounds_respects_top_k():
+    torch.manual_seed(0)
+    candidates = KNN_BACKENDS["brute"](torch.rand(200, 2), 8)
+    agent1, agent2 = match_in_rounds(candidates, top_k=8, resolve="lowest_id")
+    check_pairs(list(zip(agent1.tolist(), agent2.tolist())), 200)
+    # Every pair comes from the proposer's candidate row
+    in_row = (candidates[agent1] == agent2[:, None]).any(dim=1) | (candidates[agent2] == agent1[:, None]).any(dim=1)
+    assert in_row.all()
+
+
+def test_spatial_index_tracks_moves():
+    torch.manual_seed(0)
+    locs = torch.rand(2000, 2)
+    index = SpatialIndex(locs, 6)
+    for _ in range(3):
+        moved_ids = torch.randperm(2000)[:50]
+        locs[moved_ids] = (locs[moved_ids] + 0.02 * torch.randn(50, 2)).clamp(0, 1)
+        index.update(moved_ids, locs)
+        assert index.last_update_rows < 2000
+        dists = (locs[index.knn()] - locs[:, None]).norm(dim=-1)
+        assert torch.allclose(dists, brute_force_knn_dists(locs, 6), atol=1e-5)
+
+    pairs = assign_pairs1(locs, 3, index=index)
+    check_pairs(pairs, 2000)
+    assert len(pairs) == 1000
+
+
+def test_spatial_index_keeps_its_buckets_incrementally():
+    torch.manual_seed(0)
+    locs = torch.rand(2000, 2)
+    index = SpatialIndex(locs, 6)
+    # Agents crowding into one corner overflow its cells and force a relayout
+    for step in range(6):
+        moved_ids = torch.randperm(2000)[:100]
+        locs[moved_ids] = (locs[moved_ids] * 0.9).clamp(0, 1) if step % 2 else torch.rand(100, 2)
+        index.update(moved_ids, locs)
+        filled = index.slots[index.slots >= 0]
+        assert sorted(filled.tolist()) == list(range(2000))
+        assert (index.slots[index.slot_of] == np.arange(2000)).all()
+        assert (np.bincount(index.cell_of, minlength=index.g ** 2) == index.cell_count).all()
+        dists = (locs[index.knn()] - locs[:, None]).norm(dim=-1)
+        assert torch.allclose(dists, brute_force_knn_dists(locs, 6), atol=1e-5)
+    assert index.rebuilds > 0
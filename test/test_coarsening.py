@@ -0,0 +1,33 @@
+import numpy as np
+import torch
+
+from coarsening import expand_questionnaire, group_pairs
+from population import ATTRIBUTE_NAMES, Population
+
+
+def test_group_pairs_shares_identical_prompts():
+    population = Population({name: np.zeros(8, dtype=np.uint8) for name in ATTRIBUTE_NAMES})
+    population.codes["gender"][7] = 1
+    agents_loc = torch.full((8, 2), 0.5)
+    all_pairs = [(0, 1), (2, 3), (4, 5), (6, 7)]
+    groups = group_pairs(all_pairs, ["q1", "q1", "q2", "q1"], population, agents_loc)
+    # Only the first two pairs have the same personas and question
+    group_of = groups.group_of.tolist()
+    assert group_of[0] == group_of[1]
+    assert len(groups) == len(set(group_of)) == 3
+    assert groups.select(all_pairs)[groups.group_of[1]] == (0, 1)
+
+    capped = group_pairs(all_pairs, ["q1"] * 4, population, agents_loc, max_group_size=1)
+    assert len(capped) == 4
+
+
+def test_expand_questionnaire_fans_out_by_position():
+    population = Population({name: np.zeros(4, dtype=np.uint8) for name in ATTRIBUTE_NAMES})
+    all_pairs = [(0, 1), (3, 2)]
+    groups = group_pairs(all_pairs, ["q", "q"], population, torch.zeros(4, 2))
+    rep_pairs = groups.select(all_pairs)
+    rep_answers = ["" for _ in range(4)]
+    rep_answers[0], rep_answers[1] = [1, 1], [0, 0]
+    answers = expand_questionnaire(groups, all_pairs, rep_pairs, rep_answers, 4)
+    assert answers == [[1, 1], [0, 0], [0, 0], [1, 1]]
+    assert groups.expand_tensor(torch.tensor([1])).tolist() == [1, 1]
@@ -7,6 +7,10 @@ TOP_K = 5
 SIMULATION_DIR = "./simulations"
 
 import argparse
+
+from convergence import ConvergenceMonitor
+
+
 def compute_value(cur_dir, top_k):
     # Load data from the specified directory
     full_dir = os.path.join("simulations", cur_dir)
@@ -83,6 +87,38 @@ def test_simulation_converge():
         assert all_vals[-1] > 0.7, "Simulation not converging"
 
 
+def test_convergence_monitor_stops_once_settled():
+    torch.manual_seed(0)
+    monitor = ConvergenceMonitor(window=5, seed=0)
+    locs = torch.rand(500, 2)
+    # Agents keep moving for 10 iterations, then settle
+    for iter_idx in range(30):
+        prev_locs = locs.clone()
+        if iter_idx < 10:
+            locs = (locs + 0.05 * torch.randn(500, 2)).clamp(0, 1)
+        reason = monitor.update(locs, prev_locs, agreement=0.5)
+        if reason is not None:
+            break
+    assert reason is not None
+    # One window of still iterations after the last move
+    assert iter_idx == 14
+
+
+def test_convergence_monitor_waits_for_the_ties_and_skips_empty_iterations():
+    monitor = ConvergenceMonitor(window=3, seed=0)
+    locs = torch.rand(100, 2)
+    # Agents on a social graph never move, but the ties keep rewiring for 5 iterations
+    for iter_idx in range(20):
+        agreement = float("nan") if iter_idx % 2 else 0.5
+        reason = monitor.update(locs, locs, agreement, rewired=0.2 if iter_idx < 5 else 0.0)
+        if reason is not None:
+            break
+    # A NaN agreement in the window would never compare within the tolerance
+    assert reason is not None and "ties were rewired" in reason
+    # One window of iterations without rewiring
+    assert iter_idx == 7
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compute values from simulation data.")
     parser.add_argument("--cur_dir", type=str, required=True, help="Directory containing simulation data.")
@@ -0,0 +1,92 @@
+from conversation import conversation_prefixes, generate_conversation, run_conversation
+from conversation_prompting import generate_initial_question_prompts
+from mock_llm import MockLLM, MockSamplingParams
+from population import Population
+from prompt_chaining import continue_prompt
+
+PAIRS = [(0, 1), (2, 3), (4, 5), (6, 7)]
+QUESTIONS = ["Are taxes too high?"] * len(PAIRS)
+
+
+def test_turns_extend_each_agents_sequence():
+    population = Population.sample(8, seed=0)
+    conversations = run_conversation(MockLLM(seed=0), MockSamplingParams(max_tokens=256), PAIRS, QUESTIONS,
+                                     population, turns=3)
+    assert conversations.turns.tolist() == [3] * len(PAIRS)
+    for idx, initial_prompt in enumerate(generate_initial_question_prompts(PAIRS, QUESTIONS, population)):
+        messages = conversations.messages[idx]
+        assert len(messages) == 6
+        primary, secondary = conversations.sequences[idx]
+        # Each turn appends the other agent's message and this agent's answer, nothing else changes
+        expected = initial_prompt + messages[0]
+        for turn in range(1, 3):
+            expected = continue_prompt(expected, messages[2 * turn - 1]) + messages[2 * turn]
+        assert primary == expected
+        assert secondary.startswith(conversation_prefixes(population, PAIRS[idx], QUESTIONS[idx], messages[0],
+                                                          messages[1])[1])
+        assert secondary.endswith(continue_prompt("", messages[-2]) + messages[-1])
+    assert conversations.replies == [messages[-2] for messages in conversations.messages]
+
+
+def test_single_turn_matches_the_two_message_conversation():
+    population = Population.sample(8, seed=0)
+    replies, finals = generate_conversation(MockLLM(seed=0), MockSamplingParams(max_tokens=256), PAIRS, QUESTIONS,
+                                            population)
+    conversations = run_conversation(MockLLM(seed=0), MockSamplingParams(max_tokens=256), PAIRS, QUESTIONS,
+                                     population)
+    assert (replies, finals) == (conversations.replies, conversations.final_responses)
+    assert [list(sequences) for sequences in conversations.sequences] == [
+        list(conversation_prefixes(population, pair, QUESTIONS[idx], replies[idx], finals[idx]))
+        for idx, pair in enumerate(PAIRS)]
+
+
+def test_later_turns_only_prefill_new_tokens():
+    population = Population.sample(8, seed=0)
+    sampling_params = MockSamplingParams(max_tokens=256)
+    one = run_conversation(MockLLM(seed=0), sampling_params, PAIRS, QUESTIONS, population, turns=1)
+    llm = MockLLM(seed=0)
+    three = run_conversation(llm, sampling_params, PAIRS, QUESTIONS, population, turns=3)
+    later_prompt = three.prompt_tokens.sum() - one.prompt_tokens.sum()
+    later_prefill = later_prompt - (three.cached_tokens.sum() - one.cached_tokens.sum())
+    later_new = three.new_tokens.sum() - one.new_tokens.sum()
+    # Two later turns of two requests per pair, each missing at most a partial block
+    assert later_prefill <= later_new + 4 * len(PAIRS) * llm.block_size
+    assert later_new < later_prompt / 3
+
+
+def test_pairs_that_end_early_drop_out():
+    population = Population.sample(8, seed=0)
+    calls = []
+
+    def stop_pairs(pair_idxs, replies, final_responses):
+        calls.append(list(pair_idxs))
+        return [idx == 1 for idx in pair_idxs]
+
+    llm = MockLLM(seed=0)
+    conversations = run_conversation(llm, MockSamplingParams(max_tokens=256), PAIRS, QUESTIONS, population,
+                                     turns=3, stop_pairs=stop_pairs)
+    assert calls == [[0, 1, 2, 3], [0, 2, 3]]
+    assert conversations.turns.tolist() == [3, 1, 3, 3]
+    assert len(conversations.messages[1]) == 2 and conversations.seconds[1] < conversations.seconds[0]
+    assert llm.stage_stats["conversation"].requests == 4 + 3 + 3
+
+    # A stop phrase in every message ends all conversations after the first round
+    conversations = run_conversation(MockLLM(seed=0), MockSamplingParams(max_tokens=256), PAIRS, QUESTIONS,
+                                     population, turns=3, stop_phrases=["."])
+    assert conversations.turns.tolist() == [1] * len(PAIRS)
+
+
+def test_conversations_end_before_outgrowing_the_context():
+    population = Population.sample(8, seed=0)
+    llm = MockLLM(seed=0)
+    sampling_params = MockSamplingParams(max_tokens=256)
+    one = run_conversation(llm, sampling_params, PAIRS, QUESTIONS, population, turns=1)
+    tokenizer = llm.get_tokenizer()
+    longest = max(len(tokenizer.encode(sequence)) for sequences in one.sequences for sequence in sequences)
+    # Room for about one more round
+    max_model_len = longest + 1000
+    conversations = run_conversation(MockLLM(seed=0), sampling_params, PAIRS, QUESTIONS, population, turns=10,
+                                     max_model_len=max_model_len)
+    assert 1 < conversations.turns.max() < 10
+    assert all(len(tokenizer.encode(sequence)) <= max_model_len
+               for sequences in conversations.sequences for sequence in sequences)
@@ -0,0 +1,60 @@
+import random
+from types import SimpleNamespace
+
+from dataflow import get_engine, run_pipelined_stages
+from mock_llm import MockSamplingParams
+from population import Population
+
+
+class ShuffledEngine:
+    """Finishes a random subset of the pending requests at every step, echoing a per-stage answer."""
+
+    def __init__(self):
+        self.pending = []
+        self.params = {}
+        self.rng = random.Random(0)
+
+    def add_request(self, request_id, prompt, params):
+        self.pending.append(request_id)
+        self.params[request_id.rsplit("-", 1)[0]] = params
+
+    def step(self):
+        self.rng.shuffle(self.pending)
+        done, self.pending = self.pending[:3], self.pending[3:]
+        return [SimpleNamespace(request_id=request_id, finished=True,
+                                outputs=[SimpleNamespace(text=self.answer(request_id))]) for request_id in done]
+
+    def has_unfinished_requests(self):
+        return bool(self.pending)
+
+    @staticmethod
+    def answer(request_id):
+        stage, idx = request_id.rsplit("-", 1)
+        if stage == "judge":
+            return str(int(idx) % 3 - 1)
+        if stage == "questionnaire":
+            return ", ".join(str(int(idx) % 2) for _ in range(4))
+        return f"{stage} {idx}"
+
+
+def test_pipeline_reassembles_stage_outputs(tmp_path, monkeypatch):
+    # The judge outputs go to ./grade_log.txt
+    monkeypatch.chdir(tmp_path)
+    population = Population.sample(10, seed=0)
+    all_pairs = [(0, 1), (5, 2), (3, 9)]
+    engine = ShuffledEngine()
+    replies, final_responses, answers, grades = run_pipelined_stages(
+        engine, MockSamplingParams(max_tokens=256), all_pairs, ["q"] * 3, population, ["a", "b", "c", "d"])
+    # Every stage decodes with its own profile
+    assert engine.params["conversation"].max_tokens == 256 and engine.params["judge"].max_tokens == 2
+    assert engine.params["questionnaire"].guided_decoding.regex == "([01])(, ([01])){3}"
+    assert replies == ["conversation 0", "conversation 1", "conversation 2"]
+    assert final_responses == ["reply 0", "reply 1", "reply 2"]
+    assert grades.tolist() == [-1, 0, 1]
+    # Primary agents answer 0s, secondary agents 1s
+    assert answers[5] == [0, 0, 0, 0] and answers[2] == [1, 1, 1, 1] and answers[4] == ""
+
+
+def test_get_engine_needs_step_api():
+    assert get_engine(SimpleNamespace()) is None
+    assert get_engine(SimpleNamespace(llm_engine=ShuffledEngine())) is not None
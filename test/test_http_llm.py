@@ -0,0 +1,77 @@
+import pytest
+
+from http_llm import HTTPError, HTTPLLM
+from http_stub_server import StubServer
+from judge_prompting import construct_judge_prompt
+from mock_llm import MockLLM, MockSamplingParams
+from property_updates import JudgeScoring
+from stage_config import StageProfiles
+
+
+@pytest.fixture
+def server():
+    server = StubServer(seed=0).start()
+    yield server
+    server.close()
+
+
+def test_http_outputs_match_the_local_mock(server):
+    client = HTTPLLM(server.url, "mock", concurrency=4)
+    prompts = [f"Question {i}?" for i in range(20)]
+    params = MockSamplingParams(temperature=0.5, max_tokens=64, n=2)
+    outputs = client.generate(prompts, params)
+    expected = MockLLM(seed=0).generate(prompts, params)
+
+    assert [output.prompt for output in outputs] == prompts
+    assert [[o.text for o in output.outputs] for output in outputs] == \
+        [[o.text for o in output.outputs] for output in expected]
+    # Keep-alive: the pool never opens more connections than its concurrency, across calls too
+    client.generate(prompts, params)
+    assert server.connections == client.connections_opened <= 4
+    client.close()
+
+
+def test_http_logprobs_feed_the_scoring_judge(server):
+    client = HTTPLLM(server.url, "mock")
+    params = StageProfiles().sampling_params(MockSamplingParams(), "judge_scoring")
+    prompts = [construct_judge_prompt(f"q{i}", "r", "f") for i in range(5)]
+    grades, expected = JudgeScoring().scores(client.generate(prompts, params), strict=True)
+    local_grades, local_expected = JudgeScoring().scores(MockLLM(seed=0).generate(prompts, params))
+    assert grades.tolist() == local_grades.tolist()
+    assert expected.tolist() == pytest.approx(local_expected.tolist(), abs=1e-6)
+    client.close()
+
+
+def test_http_retries_transient_failures():
+    server = StubServer(seed=1, failure_rate=0.3).start()
+    client = HTTPLLM(server.url, "mock", concurrency=8, max_retries=10, backoff=0.001, seed=0)
+    outputs = client.generate([f"p{i}" for i in range(30)], MockSamplingParams())
+    assert len(outputs) == 30 and client.retries > 0
+    client.close()
+    server.close()
+
+
+def test_http_gives_up_after_max_retries_and_times_out():
+    server = StubServer(failure_rate=1.0).start()
+    client = HTTPLLM(server.url, "mock", max_retries=2, backoff=0.001)
+    with pytest.raises(HTTPError):
+        client.generate(["p"], MockSamplingParams())
+    assert client.retries == 2
+    client.close()
+    server.close()
+
+    server = StubServer(delay=0.5).start()
+    client = HTTPLLM(server.url, "mock", timeout=0.05, max_retries=0)
+    with pytest.raises(Exception):
+        client.generate(["p"], MockSamplingParams())
+    client.close()
+    server.close()
+
+
+def test_canned_responses_are_replayed():
+    server = StubServer(canned=["1", "-1"]).start()
+    client = HTTPLLM(server.url, "mock", concurrency=1)
+    assert [output.outputs[0].text for output in client.generate(["a", "b", "c"], MockSamplingParams())] == \
+        ["1", "-1", "1"]
+    client.close()
+    server.close()
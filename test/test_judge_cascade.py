@@ -0,0 +1,127 @@
+import sys
+
+import numpy as np
+import pytest
+
+import judge_cascade
+from conversation import turn_stats
+from database_manager import SimLogger
+from judge_cascade import CascadeClassifier, JudgeCascade, evaluate, featurize, load_conversations
+from main import run_llm_stages
+from mock_llm import MockLLM, MockSamplingParams
+from population import Population
+from property_updates import JudgeScoring
+
+FINALS = {1: ["I agree, that is a fair point.", "Yes, you are right about that."],
+          0: ["Maybe, it depends on the details.", "I am not sure either way."],
+          -1: ["I disagree, that is wrong.", "No, you are mistaken about that."]}
+
+
+def corpus(size, seed=0):
+    rng = np.random.default_rng(seed)
+    grades = rng.choice([-1, 0, 1], size)
+    finals = [FINALS[grade][rng.integers(2)] for grade in grades]
+    return ["Are taxes too high?"] * size, ["Taxes should be lower."] * size, finals, grades
+
+
+def test_features_are_stable_and_normalised():
+    rows, cols, vals = featurize(["q"], ["Taxes, taxes"], ["taxes are fine"], 1 << 10)
+    assert (rows == 0).all() and len(set(cols.tolist())) == len(cols)
+    text = cols != 0
+    assert np.isclose(np.linalg.norm(vals[text]), 1.0) and vals[~text].tolist() == [1.0]
+    # crc32 rather than the salted str hash, so saved weights stay valid across processes
+    assert featurize(["q"], ["Taxes, taxes"], ["taxes are fine"], 1 << 10)[1].tolist() == cols.tolist()
+
+
+def test_classifier_learns_grades_and_round_trips(tmp_path):
+    classifier = CascadeClassifier.fit(*corpus(300), num_features=1 << 12)
+    questions, replies, finals, grades = corpus(100, seed=1)
+    result, = evaluate(classifier, questions, replies, finals, grades, [0.5])
+    assert result["accuracy"] == 1.0 and result["local share"] == 1.0
+
+    path = str(tmp_path / "cascade.npz")
+    classifier.save(path)
+    loaded = CascadeClassifier.load(path)
+    assert np.allclose(loaded.probabilities(questions, replies, finals),
+                       classifier.probabilities(questions, replies, finals))
+
+
+def test_only_unconfident_pairs_reach_the_llm(tmp_path, monkeypatch):
+    # The judge outputs go to ./grade_log.txt
+    monkeypatch.chdir(tmp_path)
+    classifier = CascadeClassifier.fit(*corpus(300), num_features=1 << 12)
+    questions, replies, finals, grades = corpus(20, seed=1)
+    finals[3] = replies[3] = "Completely unseen words here."
+    llm = MockLLM(seed=0)
+    sampling_params = MockSamplingParams(max_tokens=256)
+
+    cascade = JudgeCascade(classifier, threshold=0.9)
+    agreements = cascade.judge(llm, sampling_params, finals, questions, replies)
+    assert cascade.stats() == {"local": 19, "escalated": 1}
+    assert llm.stage_stats["judge"].requests == 1
+    assert np.delete(agreements.numpy(), 3).tolist() == np.delete(grades, 3).tolist()
+    assert agreements[3].item() in (-1, 0, 1)
+
+    # A threshold above every confidence sends all pairs to the LLM
+    cascade.reset()
+    cascade.threshold = 1.1
+    cascade.judge(llm, sampling_params, finals, questions, replies)
+    assert cascade.stats() == {"local": 0, "escalated": 20}
+
+
+def test_train_and_evaluate_from_logged_conversations(tmp_path, monkeypatch, capsys):
+    questions, replies, finals, grades = corpus(200)
+    logger = SimLogger(str(tmp_path))
+    logger.insert_conversation_logs_many(
+        [(str(idx), (2 * idx, 2 * idx + 1), 0, questions[idx], replies[idx], finals[idx], int(grades[idx]))
+         for idx in range(len(grades))] + [("x", (0, 1), 1, "q", "r", "f", 0.5)])
+    loaded = load_conversations([logger.db_path])
+    assert loaded[3].tolist() == grades.tolist()
+
+    model = str(tmp_path / "cascade.npz")
+    monkeypatch.setattr(sys, "argv", ["judge_cascade.py", "train", "--db", logger.db_path, "--out", model,
+                                      "--num-features", "4096", "--thresholds", "0.5"])
+    judge_cascade.main()
+    assert "Loaded 200 judged conversations" in capsys.readouterr().out
+    monkeypatch.setattr(sys, "argv", ["judge_cascade.py", "evaluate", "--db", logger.db_path, "--model", model,
+                                      "--thresholds", "0.5"])
+    judge_cascade.main()
+    assert "threshold 0.50: judged locally 100.0% with accuracy 1.000" in capsys.readouterr().out
+
+
+def test_stop_checks_judge_each_exchange_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    population = Population.sample(40, seed=0)
+    pairs = [(2 * idx, 2 * idx + 1) for idx in range(20)]
+    llm = MockLLM(seed=0)
+    cascade = JudgeCascade(CascadeClassifier.fit(*corpus(300), num_features=1 << 12), threshold=1.1)
+    turn_stats.reset()
+    _, _, _, agreements = run_llm_stages(llm, MockSamplingParams(max_tokens=256), pairs, ["Are taxes too high?"] * 20,
+                                         population, turns=3, stop_on_agreement=True, judge_cascade=cascade)
+    turns = turn_stats.totals["turns"]
+    turn_stats.reset()
+    # Some pairs stopped early, and every round each pair ran got judged once
+    assert 20 * 2 < turns < 20 * 3
+    assert llm.stage_stats["judge"].requests == turns
+    # Only the judgement each pair ends with is counted
+    assert cascade.stats() == {"local": 0, "escalated": 20}
+    assert set(agreements.tolist()) <= {-1, 0, 1}
+
+
+@pytest.mark.parametrize("rule", ["hard", "expected", "threshold"])
+def test_scoring_rules_follow_the_judge_scoring(rule):
+    classifier = CascadeClassifier.fit(*corpus(300), num_features=1 << 12)
+    questions, replies, finals, grades = corpus(10, seed=1)
+    agreements = JudgeCascade(classifier, threshold=0.0).judge(MockLLM(seed=0), MockSamplingParams(), finals,
+                                                               questions, replies, scoring=JudgeScoring(rule=rule))
+    if rule == "expected":
+        assert agreements.dtype.is_floating_point and (np.round(agreements.numpy()) == grades).all()
+    elif rule == "threshold":
+        # Confident pairs move by their sign, and none is confident enough for a 0.99 threshold
+        assert not agreements.dtype.is_floating_point and agreements.tolist() == grades.tolist()
+        strict = JudgeCascade(classifier, threshold=0.0).judge(MockLLM(seed=0), MockSamplingParams(), finals,
+                                                               questions, replies,
+                                                               scoring=JudgeScoring(rule=rule, threshold=0.99))
+        assert strict.tolist() == [0] * len(grades)
+    else:
+        assert agreements.tolist() == grades.tolist()
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+from llm_cache import CachedLLM
+from llm_outputs import CompletionOutput, RequestOutput
+
+
+class CountingLLM:
+    def __init__(self):
+        self.prompts = []
+
+    def generate(self, prompts, sampling_params, stage=None):
+        self.prompts.extend(prompts)
+        return [RequestOutput(str(i), prompt, [CompletionOutput(0, prompt.upper(), [1, 2])])
+                for i, prompt in enumerate(prompts)]
+
+
+def test_cache_only_sends_misses(tmp_path):
+    llm = CountingLLM()
+    greedy = SimpleNamespace(temperature=0, max_tokens=8)
+    cached = CachedLLM(llm, str(tmp_path / "cache.db"), "model")
+    assert [o.outputs[0].text for o in cached.generate(["a", "b", "a"], greedy)] == ["A", "B", "A"]
+    assert llm.prompts == ["a", "b"]
+
+    # A new process reuses the stored outputs
+    cached = CachedLLM(llm, str(tmp_path / "cache.db"), "model")
+    assert [o.outputs[0].text for o in cached.generate(["b", "c"], greedy)] == ["B", "C"]
+    assert llm.prompts == ["a", "b", "c"]
+    assert cached.stats()["hits"] == 1 and cached.stats()["misses"] == 1
+
+    # Different sampling parameters or seeds are different entries
+    cached.generate(["a"], SimpleNamespace(temperature=0, max_tokens=16))
+    CachedLLM(llm, str(tmp_path / "cache.db"), "model", seed=1).generate(["a"], greedy)
+    assert llm.prompts == ["a", "b", "c", "a", "a"]
+
+
+def test_sampled_stages_are_opt_in(tmp_path):
+    llm = CountingLLM()
+    sampled = SimpleNamespace(temperature=0.5, max_tokens=8)
+    cached = CachedLLM(llm, str(tmp_path / "cache.db"), "model", cache_stages=["judge"])
+    for _ in range(2):
+        cached.generate(["a"], sampled, stage="judge")
+        cached.generate(["b"], sampled, stage="conversation")
+    assert llm.prompts == ["a", "b", "b"]
+
+
+def test_sampled_duplicates_get_a_sample_each(tmp_path):
+    llm = CountingLLM()
+    sampled = SimpleNamespace(temperature=0.5, max_tokens=8)
+    cached = CachedLLM(llm, str(tmp_path / "cache.db"), "model", cache_stages=["initial_questionnaire"])
+    cached.generate(["a", "a", "b", "a"], sampled, stage="initial_questionnaire")
+    assert sorted(llm.prompts) == ["a", "a", "a", "b"]
+    # A rerun reuses each copy's own sample, and a fourth copy is new
+    cached.generate(["a", "b", "a", "a", "a"], sampled, stage="initial_questionnaire")
+    assert sorted(llm.prompts) == ["a", "a", "a", "a", "b"]
+    assert cached.stats()["hits"] == 4
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    llm = CountingLLM()
+    greedy = SimpleNamespace(temperature=0, max_tokens=8)
+    cached = CachedLLM(llm, str(tmp_path / "cache.db"), "model", max_bytes=250)
+    for prompt in ["a", "b", "c", "d"]:
+        cached.generate([prompt], greedy)
+    assert cached.size <= 250
+    cached.generate(["d"], greedy)
+    assert llm.prompts[-1] == "d" and len(llm.prompts) == 4
+    cached.generate(["a"], greedy)
+    assert llm.prompts[-1] == "a"
@@ -0,0 +1,62 @@
+import functools
+import os
+
+import numpy as np
+import pytest
+
+from llm_pool import BackendPool
+from mock_llm import MockLLM, MockSamplingParams
+from token_batching import shard_by_load
+
+
+class CrashingLLM(MockLLM):
+    """Mock replica whose first `generate` in any worker kills the process."""
+
+    def __init__(self, marker, **kwargs):
+        super().__init__(**kwargs)
+        self.marker = marker
+
+    def generate(self, prompts, sampling_params, **kwargs):
+        if not os.path.exists(self.marker):
+            open(self.marker, "w").close()
+            os._exit(1)
+        return super().generate(prompts, sampling_params, **kwargs)
+
+
+class FailingLLM(MockLLM):
+    def generate(self, prompts, sampling_params, **kwargs):
+        raise ValueError("bad sampling parameters")
+
+
+def test_shard_by_load_is_contiguous_and_balanced():
+    lengths = np.random.default_rng(0).integers(1, 100, 1000)
+    shards = shard_by_load(lengths, 4)
+    assert np.array_equal(np.concatenate(shards), np.arange(1000))
+    loads = [lengths[shard].sum() for shard in shards]
+    assert max(loads) - min(loads) <= 2 * lengths.max()
+    assert [len(shard) for shard in shard_by_load([5], 3)] == [1, 0, 0]
+
+
+def test_pool_matches_single_replica_in_prompt_order():
+    prompts = [f"Question {i}: {'more words ' * (i % 7)}" for i in range(40)]
+    params = MockSamplingParams(temperature=0.5, max_tokens=32)
+    expected = [output.outputs[0].text for output in MockLLM(seed=0).generate(prompts, params)]
+    with BackendPool(functools.partial(MockLLM, seed=0), num_workers=3) as pool:
+        assert [output.prompt for output in pool.generate(prompts, params, stage="conversation")] == prompts
+        assert [output.outputs[0].text for output in pool.stream(prompts, params)] == expected
+        assert pool.generate(prompts[:1], params)[0].outputs[0].text == expected[0]
+
+
+def test_pool_restarts_crashed_worker(tmp_path):
+    prompts = [f"prompt {i}" for i in range(8)]
+    factory = functools.partial(CrashingLLM, str(tmp_path / "crashed"), seed=0)
+    with BackendPool(factory, num_workers=2, poll_interval=0.2) as pool:
+        outputs = pool.generate(prompts, MockSamplingParams())
+        assert [output.prompt for output in outputs] == prompts
+        assert pool.restarts == 1
+
+
+def test_pool_reports_replica_errors():
+    with BackendPool(FailingLLM, num_workers=1) as pool:
+        with pytest.raises(RuntimeError, match="bad sampling parameters"):
+            pool.generate(["prompt"], MockSamplingParams())
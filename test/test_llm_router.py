@@ -0,0 +1,105 @@
+import json
+
+import pytest
+
+from judge_prompting import construct_judge_prompt
+from llm_outputs import CompletionOutput, RequestOutput
+from llm_router import Route, StageRouter, config_digest, output_is_valid
+from mock_llm import MockGuidedDecodingParams, MockLLM, MockSamplingParams
+
+JUDGE_PARAMS = MockSamplingParams(max_tokens=2, guided_decoding=MockGuidedDecodingParams(regex="-1|0|1"))
+
+
+class CannedLLM:
+    """Answers every prompt with `text`, or raises if `fail`."""
+
+    def __init__(self, text="maybe", fail=False):
+        self.text = text
+        self.fail = fail
+        self.calls = []
+
+    def generate(self, prompts, sampling_params, stage=None, **kwargs):
+        self.calls.append((stage, list(prompts)))
+        if self.fail:
+            raise RuntimeError("out of memory")
+        return [RequestOutput(request_id=str(idx), prompt=prompt, outputs=[CompletionOutput(index=0, text=self.text)])
+                for idx, prompt in enumerate(prompts)]
+
+
+def test_output_is_valid_follows_the_stage_regex():
+    def output(text, finish_reason="stop"):
+        return RequestOutput("0", "p", [CompletionOutput(index=0, text=text, finish_reason=finish_reason)])
+
+    assert output_is_valid(output(" -1"), JUDGE_PARAMS) and not output_is_valid(output("agree"), JUDGE_PARAMS)
+    assert output_is_valid(output("agree"), MockSamplingParams())
+    assert not output_is_valid(output("agree"), MockSamplingParams(), validate="0|1")
+    # A single-token scoring call can stop halfway through "-1"
+    scoring = MockSamplingParams(max_tokens=1, guided_decoding=MockGuidedDecodingParams(regex="-1|0|1"))
+    assert output_is_valid(output("-", "length"), scoring) and not output_is_valid(output("x", "length"), scoring)
+
+
+def test_stages_go_to_their_backends():
+    small, large = CannedLLM("1"), CannedLLM("Hello")
+    router = StageRouter({"small": small, "large": large}, {"judge": Route("small")}, default="large",
+                         costs={"small": 1.0, "large": 3.0})
+    assert router.generate(["a", "b"], JUDGE_PARAMS, stage="judge")[1].outputs[0].text == "1"
+    assert router.generate("c", MockSamplingParams(), stage="conversation")[0].outputs[0].text == "Hello"
+    assert small.calls == [("judge", ["a", "b"])] and large.calls == [("conversation", ["c"])]
+    stats = router.stats()
+    assert stats["judge small"]["requests"] == 2 and stats["conversation large"]["requests"] == 1
+    router.reset_stats()
+    assert router.stats() == {}
+
+
+def test_invalid_outputs_escalate_and_failures_fall_back():
+    small, large = CannedLLM("maybe"), MockLLM(seed=0)
+    with pytest.raises(ValueError):
+        StageRouter({"small": small}, {"judge": Route("small", escalate="large")}, default="small")
+
+    router = StageRouter({"small": small, "large": large, "broken": CannedLLM(fail=True)},
+                         {"judge": Route("small", escalate="large"), "reply": Route("broken", fallback="large")},
+                         default="large", costs={"small": 1.0, "large": 3.0})
+    prompts = [construct_judge_prompt("q", "r", str(idx)) for idx in range(3)]
+    outputs = router.generate(prompts, JUDGE_PARAMS, stage="judge")
+    assert [output.request_id for output in outputs] == ["0", "1", "2"]
+    assert all(output.outputs[0].text in ("-1", "0", "1") for output in outputs)
+    stats = router.stats()
+    assert stats["judge large"]["escalated"] == 3 and stats["judge large"]["requests"] == 3
+    # The mock's modelled engine time, weighted by the backend's cost
+    assert stats["judge large"]["cost"] == pytest.approx(3 * stats["judge large"]["seconds"])
+
+    assert len(router.generate(["x"], MockSamplingParams(), stage="reply")) == 1
+    assert router.stats()["reply large"]["fallbacks"] == 1
+
+
+def test_router_from_config(tmp_path):
+    config = {"backends": {"large": {"model": "big", "cost": 2.0}, "small": {"model": "tiny"}},
+              "routes": {"questionnaire": {"backend": "small", "escalate": "large"}},
+              "default": "large"}
+    path = tmp_path / "router.json"
+    path.write_text(json.dumps(config))
+    built = []
+
+    def build_backend(spec):
+        built.append(spec["model"])
+        return MockLLM(seed=0)
+
+    router = StageRouter.from_config(str(path), build_backend)
+    assert built == ["big", "tiny"] and router.costs == {"large": 2.0, "small": 1.0}
+    assert router.route("questionnaire") == Route("small", escalate="large")
+    assert router.route("judge") == Route("large")
+
+
+def test_config_digest_follows_the_routes_not_the_path(tmp_path):
+    config = {"backends": {"large": {"model": "big", "cost": 2.0}, "small": {"model": "tiny"}},
+              "routes": {"judge": {"backend": "large"}}, "default": "large"}
+    path = tmp_path / "router.json"
+    path.write_text(json.dumps(config))
+    digest = config_digest(str(path))
+    # Costs and formatting don't change what gets generated
+    config["backends"]["large"]["cost"] = 5.0
+    path.write_text(json.dumps(config, indent=2))
+    assert config_digest(str(path)) == digest
+    config["routes"]["judge"]["backend"] = "small"
+    path.write_text(json.dumps(config))
+    assert config_digest(str(path)) != digest
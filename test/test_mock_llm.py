@@ -0,0 +1,56 @@
+import math
+import os
+import subprocess
+import sys
+
+from generate_questionnaire_answer import build_questionnaire_prompts, parse_binary_strings
+from judge_prompting import construct_judge_prompt
+from mock_llm import MockLLM, MockSamplingParams
+from population import Population
+from qeustionnaire_questions import questionnaire_questions
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_mock_outputs_are_well_formed_and_deterministic():
+    llm = MockLLM(seed=0)
+    params = MockSamplingParams(temperature=0.5, max_tokens=256, n=2, logprobs=3)
+    population = Population.sample(2, seed=0)
+    questionnaire_prompt, _ = build_questionnaire_prompts(population, (0, 1), "q", "r", "f",
+                                                          questionnaire_questions)
+    judge_prompt = construct_judge_prompt("q", "r", "f")
+    outputs = llm.generate([judge_prompt, questionnaire_prompt, "Hello"], params)
+
+    assert all(len(output.outputs) == 2 for output in outputs)
+    assert outputs[0].outputs[0].text in ("-1", "0", "1")
+    first_token = outputs[0].outputs[0].logprobs[0]
+    assert math.isclose(sum(math.exp(lp.logprob) for lp in first_token.values()), 1.0)
+    answers = parse_binary_strings([outputs[1].outputs[0].text], len(questionnaire_questions))[0]
+    assert len(answers) == len(questionnaire_questions) and -1 not in answers
+    assert outputs[2].outputs[0].text
+
+    again = MockLLM(seed=0).generate([judge_prompt, questionnaire_prompt], params)
+    assert [o.outputs[1].text for o in again] == [o.outputs[1].text for o in outputs[:2]]
+    # Repeated prompts hit the modelled prefix cache
+    assert outputs[0].num_cached_tokens == 0
+    assert llm.generate([judge_prompt], params)[0].num_cached_tokens > 0
+
+
+def test_mock_engine_steps_until_done():
+    llm = MockLLM(seed=0)
+    for idx in range(5):
+        llm.llm_engine.add_request(str(idx), f"prompt {idx}", MockSamplingParams(max_tokens=64))
+    finished = []
+    while llm.llm_engine.has_unfinished_requests():
+        finished += [output.request_id for output in llm.llm_engine.step() if output.finished]
+    assert sorted(finished) == ["0", "1", "2", "3", "4"]
+
+
+def test_main_runs_on_mock_backend(tmp_path):
+    result = subprocess.run(
+        [sys.executable, os.path.join(REPO_DIR, "main.py"), "--num-agents=20", "--step-sz=.05", "--num-iterations=2",
+         "--topk=3", "--backend=mock", "--testing", "--seed=0"],
+        cwd=tmp_path, env={**os.environ, "PYTHONPATH": REPO_DIR}, capture_output=True, text=True, timeout=300)
+    assert result.returncode == 0, result.stderr
+    assert "Simulation finished" in result.stdout
+    assert os.path.exists(tmp_path / "temp_logs" / "simulation_logs" / "logs.db")
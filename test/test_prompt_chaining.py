@@ -0,0 +1,77 @@
+import numpy as np
+
+from conversation import conversation_prefixes, generate_conversation, run_conversation
+from generate_questionnaire_answer import build_chained_questionnaire_prompts, generate_questionnaire_answer
+from mock_llm import MockLLM, MockSamplingParams
+from population import Population
+from prompt_chaining import ChainStats, chain_stats, shared_prefix_lengths
+from property_updates import build_judge_prompts
+from qeustionnaire_questions import questionnaire_questions
+
+
+def test_shared_prefix_lengths_stop_at_the_first_differing_token():
+    lengths = shared_prefix_lengths([[1, 2, 3], [1, 2, 3], [4, 5]], [[1, 2, 3, 9], [1, 7, 3, 9], [4]])
+    assert lengths.tolist() == [3, 1, 1]
+
+
+def test_chain_check_counts_saved_tokens_and_seam_mismatches():
+    llm = MockLLM(seed=0)
+    stats = ChainStats()
+    # "ab" + "cd" tokenizes as one word, so the prefix's tokens aren't reused
+    stats.check(llm, "questionnaire", ["ab ", "ab"], ["ab cd", "abcd"])
+    assert stats.report() == {"questionnaire": {"prompts": 2, "prefill tokens saved": 2, "prefix mismatches": 1}}
+    stats.reset()
+    assert stats.report() == {}
+
+
+def test_chain_check_uses_the_engine_ids_of_the_sequences():
+    llm = MockLLM(seed=0)
+    tokenizer = llm.get_tokenizer()
+    population = Population.sample(2, seed=0)
+    conversations = run_conversation(llm, MockSamplingParams(max_tokens=256), [(0, 1)], ["q"], population,
+                                     keep_token_ids=True)
+    assert [tokenizer.decode(ids) for ids in conversations.sequence_ids[0]] == conversations.sequences[0]
+
+    stats = ChainStats()
+    # The engine generated "b" as its own token after "a", which re-tokenizing "ab" would merge
+    stats.add_sequences([["ab", "x"]], [[np.asarray(tokenizer.encode("a") + tokenizer.encode("b")), None]])
+    stats.check(llm, "judge", ["ab", "x"], ["ab cd", "x y"])
+    assert stats.report() == {"judge": {"prompts": 2, "prefill tokens saved": 1, "prefix mismatches": 1}}
+
+
+def test_chained_prompts_extend_the_conversation_sequences():
+    population = Population.sample(2, seed=0)
+    prefixes, prompts = build_chained_questionnaire_prompts(population, (0, 1), "q", "r", "f",
+                                                            questionnaire_questions)
+    assert prefixes == conversation_prefixes(population, (0, 1), "q", "r", "f")
+    assert prefixes[0].endswith("r") and prefixes[1].endswith("f")
+    assert all(prompt.startswith(prefix) for prefix, prompt in zip(prefixes, prompts))
+    # The primary agent gets the other agent's answer with the questionnaire
+    assert prompts[0][len(prefixes[0]):].count("f") > prompts[1][len(prefixes[1]):].count("f")
+    judge_prompt, = build_judge_prompts(["f"], ["q"], ["r"], chain_prefixes=[prefixes[1]])
+    assert judge_prompt.startswith(prefixes[1])
+
+
+def test_chained_questionnaire_reuses_the_conversation_cache():
+    llm = MockLLM(seed=0)
+    population = Population.sample(8, seed=0)
+    all_pairs = [(0, 1), (2, 3), (4, 5), (6, 7)]
+    questions = ["Are taxes too high?"] * len(all_pairs)
+    sampling_params = MockSamplingParams(max_tokens=256)
+    replies, finals = generate_conversation(llm, sampling_params, all_pairs, questions, population)
+
+    chain_stats.reset()
+    answers, _ = generate_questionnaire_answer(llm, sampling_params, all_pairs, population, questions, replies,
+                                               finals, questionnaire_questions, chain=True)
+    report = chain_stats.report()["questionnaire"]
+    chain_stats.reset()
+    assert report["prompts"] == 2 * len(all_pairs) and report["prefix mismatches"] == 0
+    tokenizer = llm.get_tokenizer()
+    prefix_tokens = sum(len(tokenizer.encode(prefix)) for pair_idx, pair in enumerate(all_pairs)
+                        for prefix in conversation_prefixes(population, pair, questions[pair_idx],
+                                                            replies[pair_idx], finals[pair_idx]))
+    assert report["prefill tokens saved"] == prefix_tokens
+    # The engine serves the conversation blocks (generated tokens included) from its cache
+    stats = llm.stage_stats["questionnaire"]
+    assert stats.cached_tokens >= prefix_tokens - 2 * len(all_pairs) * llm.block_size
+    assert all(np.isin(answers[agent], [0, 1]).all() for agent in range(8))
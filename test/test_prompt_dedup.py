@@ -0,0 +1,53 @@
+from llm_cache import CachedLLM
+from mock_llm import MockLLM, MockSamplingParams
+from prompt_dedup import DedupLLM
+
+
+class RecordingLLM(MockLLM):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.calls = []
+
+    def generate(self, prompts, sampling_params, **kwargs):
+        self.calls.append((list(prompts), sampling_params.n))
+        return super().generate(prompts, sampling_params, **kwargs)
+
+
+def test_duplicates_share_one_prefill_with_a_sample_each():
+    llm = RecordingLLM(seed=0)
+    dedup = DedupLLM(llm)
+    prompts = ["a", "b", "a", "c", "a", "b"]
+    outputs = dedup.generate(prompts, MockSamplingParams(temperature=0.5, n=2))
+
+    assert sorted(llm.calls) == [(["a"], 6), (["b"], 4), (["c"], 2)]
+    assert [output.prompt for output in outputs] == prompts
+    assert all([o.index for o in output.outputs] == [0, 1] for output in outputs)
+    # Every copy gets its own samples
+    copies_of_a = [tuple(o.text for o in outputs[i].outputs) for i in (0, 2, 4)]
+    assert len(set(copies_of_a)) == 3
+    assert dedup.stats()["dedup ratio"] == 2.0
+    assert outputs[2].num_cached_tokens == len(outputs[2].prompt_token_ids)
+
+
+def test_greedy_duplicates_are_sent_once_and_copied():
+    llm = RecordingLLM(seed=0)
+    outputs = DedupLLM(llm).generate(["a", "a", "b"], MockSamplingParams(temperature=0))
+    assert llm.calls == [(["a", "b"], 1)]
+    assert outputs[0].outputs[0].text == outputs[1].outputs[0].text
+
+
+def test_dedup_under_the_cache_still_samples_every_copy(tmp_path):
+    llm = RecordingLLM(seed=0)
+    dedup = DedupLLM(llm)
+    cached = CachedLLM(dedup, str(tmp_path / "cache.db"), "mock", cache_stages=["initial_questionnaire"])
+    sampling_params = MockSamplingParams(temperature=0.5)
+    prompts = ["a", "a", "a", "b"]
+    outputs = cached.generate(prompts, sampling_params, stage="initial_questionnaire")
+    # The cache passes the copies down and the dedup layer prefills "a" once for three samples
+    assert sorted(llm.calls) == [(["a"], 3), (["b"], 1)]
+    assert len({outputs[i].outputs[0].text for i in range(3)}) == 3
+
+    # A rerun is served from the cache, copy by copy
+    again = cached.generate(prompts, sampling_params, stage="initial_questionnaire")
+    assert len(llm.calls) == 2
+    assert [o.outputs[0].text for o in again] == [o.outputs[0].text for o in outputs]
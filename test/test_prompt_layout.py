@@ -0,0 +1,41 @@
+from generate_questionnaire_answer import build_questionnaire_prompts
+from judge_prompting import JUDGE_PREFIX, construct_judge_prompt
+from mock_llm import MockLLM, MockSamplingParams, count_questionnaire_items
+from population import Population
+from prompt_layout import PrefixCacheStats, generate_in_prefix_order, prefix_order
+from qeustionnaire_questions import questionnaire_questions
+
+
+def test_prefix_order_groups_shared_prefixes():
+    prompts = ["b-2", "a-1", "b-1", "a-2"]
+    order = prefix_order(prompts)
+    assert [prompts[i] for i in order] == ["a-1", "a-2", "b-1", "b-2"]
+
+
+def test_questionnaire_prompts_put_shared_content_first():
+    population = Population.sample(4, seed=1)
+    primary, secondary = build_questionnaire_prompts(population, (2, 3), "Are taxes too high?", "r", "f",
+                                                     questionnaire_questions)
+    other, _ = build_questionnaire_prompts(population, (0, 1), "Something else?", "x", "y",
+                                           questionnaire_questions)
+    # Each agent answers as itself
+    assert population.get_sys_prompt(2) in primary and population.get_sys_prompt(3) in secondary
+    # Instructions and the questionnaire come before any persona or pair material
+    shared = primary[:primary.index("=== End of Questionnaire ===")]
+    assert other.startswith(shared)
+    assert primary.index(population.get_sys_prompt(2)) < primary.index("Are taxes too high?")
+    assert count_questionnaire_items(primary) == len(questionnaire_questions)
+    assert construct_judge_prompt("q", "r", "f").startswith(JUDGE_PREFIX)
+
+
+def test_generate_in_prefix_order_restores_order_and_reports_hits(monkeypatch):
+    stats = PrefixCacheStats()
+    monkeypatch.setattr("prompt_layout.prefix_cache_stats", stats)
+    prompts = [construct_judge_prompt(f"q{i}", "r", "f") for i in range(6)]
+    outputs = generate_in_prefix_order(MockLLM(seed=0), prompts, MockSamplingParams(), stage="judge")
+
+    assert [output.prompt for output in outputs] == prompts
+    # Everything but the first prompt reuses the few-shot prefix
+    assert 0.5 < stats.report()["judge"] < 1
+    stats.reset()
+    assert stats.report() == {}
@@ -0,0 +1,72 @@
+import math
+from types import SimpleNamespace
+
+import torch
+
+from llm_cache import CachedLLM
+from llm_outputs import Logprob
+from mock_llm import MockLLM, MockSamplingParams
+from property_updates import JudgeScoring, llm_judge_scores, move_agents, parse_grades
+
+
+def sequential_update(agents_loc, all_pairs, grade, step_sz):
+    # Reference: the original one-pair-at-a-time update loop
+    for (idx_0, idx_1), g_val in zip(all_pairs, grade):
+        diff_vec = agents_loc[idx_0] - agents_loc[idx_1]
+        if g_val == -1:
+            agents_loc[idx_1] -= diff_vec * step_sz
+            agents_loc[idx_0] += diff_vec * step_sz
+        elif g_val == 1:
+            agents_loc[idx_1] += diff_vec * step_sz
+            agents_loc[idx_0] -= diff_vec * step_sz
+    agents_loc[agents_loc > 1] = 1
+    agents_loc[agents_loc < 0] = 0
+    return agents_loc
+
+
+def test_parse_grades_falls_back_to_zero():
+    grades = parse_grades(["1", " -1", "0\n", "agree", "2"])
+    assert grades.tolist() == [1, -1, 0, 0, 2]
+
+
+def test_vectorised_moves_match_sequential_update():
+    torch.manual_seed(0)
+    agents_loc = torch.rand(1000, 2)
+    order = torch.randperm(1000).tolist()
+    all_pairs = list(zip(order[0::2], order[1::2]))
+    grades = torch.randint(-1, 3, (len(all_pairs),))
+
+    expected = sequential_update(agents_loc.clone(), all_pairs, grades.tolist(), 0.6)
+    result = move_agents(agents_loc.clone(), all_pairs, grades, 0.6)
+    assert torch.allclose(result, expected)
+
+
+def judge_output(**probs):
+    first = {i: Logprob(math.log(p), decoded_token=token) for i, (token, p) in enumerate(probs.items())}
+    return SimpleNamespace(request_id="0", outputs=[SimpleNamespace(logprobs=[first])])
+
+
+def test_judge_scoring_rules():
+    outputs = [judge_output(**{"-": 0.6, "0": 0.3, "1": 0.1}), judge_output(**{"0": 0.2, " 1": 0.4, "x": 0.4})]
+    grades, expected = JudgeScoring().scores(outputs)
+    assert grades.tolist() == [-1, 1]
+    assert torch.allclose(expected, torch.tensor([-0.5, 2 / 3]))
+
+    assert JudgeScoring("hard").agreements(outputs).tolist() == [-1, 1]
+    assert torch.allclose(JudgeScoring("expected").agreements(outputs), expected)
+    assert JudgeScoring("threshold", threshold=0.6).agreements(outputs).tolist() == [0, 1]
+
+
+def test_logprob_judge_runs_prefill_only_and_survives_the_cache(tmp_path, monkeypatch):
+    # The judge outputs go to ./grade_log.txt
+    monkeypatch.chdir(tmp_path)
+    llm = MockLLM(seed=0)
+    cached = CachedLLM(llm, str(tmp_path / "cache.db"), "mock")
+    questions = [f"q{i}" for i in range(8)]
+    scoring = JudgeScoring("expected")
+    first = llm_judge_scores(cached, MockSamplingParams(temperature=0.5), ["f"] * 8, questions, ["r"] * 8, scoring)
+    # Greedy scoring is always cached, logprobs included
+    again = llm_judge_scores(cached, MockSamplingParams(temperature=0.5), ["f"] * 8, questions, ["r"] * 8, scoring)
+    assert llm.stage_stats["judge"].output_tokens == 8
+    assert cached.stats()["hits"] == 8
+    assert torch.allclose(first, again) and first.abs().max() <= 1
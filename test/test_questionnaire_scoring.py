@@ -0,0 +1,46 @@
+import numpy as np
+
+from calculate_latent_vec_score import expected_latent_scores, latent_scores_from_matrix
+from generate_questionnaire_answer import build_questionnaire_item_prompts, hard_answers, score_questionnaire_answers
+from mock_llm import MockLLM, MockSamplingParams
+from population import Population
+from qeustionnaire_questions import questionnaire_questions
+
+
+def test_expected_latent_scores_match_hard_answers():
+    rng = np.random.default_rng(0)
+    answers = rng.integers(0, 2, (5, len(questionnaire_questions)))
+    assert np.allclose(expected_latent_scores(questionnaire_questions, answers.astype(float)),
+                       latent_scores_from_matrix(questionnaire_questions, answers))
+    # Expectation is linear: P = 0.5 everywhere scores halfway between all-0 and all-1 answers
+    shape = (1, len(questionnaire_questions))
+    halves = expected_latent_scores(questionnaire_questions, np.full(shape, 0.5))
+    assert np.allclose(2 * halves, expected_latent_scores(questionnaire_questions, np.ones(shape))
+                       + expected_latent_scores(questionnaire_questions, np.zeros(shape)))
+
+
+def test_item_prompts_share_the_agent_prefix():
+    population = Population.sample(2, seed=0)
+    primary, secondary = build_questionnaire_item_prompts(population, (0, 1), "q", "r", "f", questionnaire_questions)
+    assert len(primary) == len(secondary) == len(questionnaire_questions)
+    prefix = primary[0][:primary[0].index("=== Questionnaire ===")]
+    assert all(prompt.startswith(prefix) for prompt in primary)
+    assert population.get_sys_prompt(1) in secondary[0] and not secondary[0].startswith(prefix)
+
+
+def test_score_questionnaire_answers_with_one_token_per_item():
+    llm = MockLLM(seed=0)
+    population = Population.sample(6, seed=0)
+    all_pairs = [(0, 3), (4, 1)]
+    probabilities = score_questionnaire_answers(llm, MockSamplingParams(max_tokens=256), all_pairs, population,
+                                                ["q", "q"], ["r", "r"], ["f", "f"], questionnaire_questions)
+
+    assert probabilities[2] == "" and probabilities[5] == ""
+    rows = np.asarray([probabilities[agent] for agent in (0, 1, 3, 4)])
+    assert rows.shape == (4, len(questionnaire_questions)) and ((rows > 0) & (rows < 1)).all()
+    answers = hard_answers(probabilities)
+    assert answers[2] == "" and answers[0] == [int(p > 0.5) for p in probabilities[0]]
+    # One generated token per item, and all but the first item of each agent reuse its prefix
+    stats = llm.stage_stats["questionnaire"]
+    assert stats.output_tokens == stats.requests == 4 * len(questionnaire_questions)
+    assert stats.cached_tokens > 0.8 * stats.prompt_tokens
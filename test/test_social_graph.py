@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import torch
+
+from social_graph import SocialGraph
+
+
+def test_sampled_pairs_follow_ties():
+    graph = SocialGraph.small_world(1000, degree=6, rewire_prob=0.2, seed=0)
+    assert (graph.degree > 0).all()
+
+    pairs = np.asarray(graph.sample_pairs(3))
+    assert len(np.unique(pairs)) == pairs.size
+    assert (graph.edge_positions(pairs[:, 0], pairs[:, 1]) >= 0).all()
+
+
+def test_disagreement_rewires_ties():
+    graph = SocialGraph.from_edges([0, 1, 2], [1, 2, 3], num_agents=4, seed=0)
+    assert graph.num_edges == 6
+
+    assert graph.reinforce([(0, 1)], torch.tensor([1]), strength=0.5) == 0
+    assert graph.weights[graph.edge_positions([0], [1])[0]] == 1.5
+
+    assert graph.reinforce([(1, 2)], torch.tensor([-1]), strength=1.0) == 2
+    # Rewired ties start over with a fresh weight, never point back at the agent itself,
+    # and the rows stay sorted for the edge lookup
+    src, dst, weights = graph.edges()
+    assert (weights > 0).all()
+    assert (dst != src).all()
+    assert (np.diff(src * 4 + dst) >= 0).all()
+
+
+def test_sample_pairs_leaves_out_inactive_agents():
+    graph = SocialGraph.small_world(1000, degree=6, seed=0)
+    active = torch.arange(0, 1000, 2)
+    pairs = np.asarray(graph.sample_pairs(3, active=active))
+    assert len(pairs) > 0
+    assert (pairs % 2 == 0).all()
+
+
+def test_rewiring_keeps_the_graph_simple_and_symmetric():
+    graph = SocialGraph.small_world(6, degree=2, seed=0)
+    rng = np.random.default_rng(0)
+    rewired = 0
+    for _ in range(50):
+        pairs = graph.sample_pairs(2)
+        rewired += graph.reinforce(pairs, torch.from_numpy(rng.choice([-1, 1], len(pairs))), strength=1.0)
+        src, dst, _ = graph.edges()
+        keys = src * 6 + dst
+        assert len(np.unique(keys)) == graph.num_edges == len(keys)
+        assert (dst != src).all() and (np.diff(keys) >= 0).all()
+        assert set(keys.tolist()) == set((dst * 6 + src).tolist())
+        assert (graph.edge_positions(src, dst) >= 0).all()
+    assert rewired > 0
+
+
+def test_rewiring_gives_up_without_a_valid_target():
+    # Every other agent already points at 0 and 1, so 0 <-> 1 has nowhere to go from either end
+    graph = SocialGraph.from_edges([0, 1, 2, 3, 4, 2, 3, 4], [1, 0, 0, 0, 0, 1, 1, 1], num_agents=5, symmetric=False,
+                                   seed=0)
+    assert graph.reinforce([(0, 1)], torch.tensor([-1]), strength=5.0) == 0
+    assert graph.weights[graph.edge_positions([0, 1], [1, 0])].tolist() == [1.0, 1.0]
+
+
+def test_rewiring_patches_rows_in_place():
+    graph = SocialGraph.small_world(1000, degree=6, seed=0)
+    indptr = graph.indptr
+    src, dst, _ = graph.edges()
+    pairs = list(zip(src[src < dst][:20].tolist(), dst[src < dst][:20].tolist()))
+    assert graph.reinforce(pairs, torch.full((20,), -1), strength=1.0) > 0
+    # No row ran out of free slots, so the layout wasn't rebuilt
+    assert graph.indptr is indptr
+    assert (graph.edge_positions([a for a, _ in pairs], [b for _, b in pairs]) < 0).all()
+    assert graph.num_edges == len(src)
+
+
+def test_edge_list_ids_must_fit_the_population(tmp_path):
+    path = tmp_path / "edges.txt"
+    path.write_text("# src dst\n0 1\n1 7\n")
+    assert SocialGraph.from_edge_list(str(path)).num_agents == 8
+    with pytest.raises(ValueError, match="agent id 7"):
+        SocialGraph.from_edge_list(str(path), num_agents=5)
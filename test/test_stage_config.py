@@ -0,0 +1,70 @@
+import json
+import re
+
+import pytest
+
+from generate_questionnaire_answer import parse_binary_strings
+from http_llm import HTTPLLM
+from mock_llm import MockLLM, MockSamplingParams
+from judge_prompting import construct_judge_prompt
+from llm_router import StageRouter
+from property_updates import parse_grades
+from stage_config import StageProfiles
+
+
+def test_profiles_constrain_judge_and_questionnaire():
+    profiles = StageProfiles()
+    base = MockSamplingParams(temperature=0.5, top_p=0.9, max_tokens=256)
+
+    judge = profiles.sampling_params(base, "judge")
+    assert (judge.temperature, judge.top_p, judge.max_tokens) == (0.5, 0.9, 2)
+    assert all(re.fullmatch(judge.guided_decoding.regex, grade) for grade in ("-1", "0", "1"))
+    assert not re.fullmatch(judge.guided_decoding.regex, "2")
+
+    questionnaire = profiles.sampling_params(base, "questionnaire", num_items=3)
+    assert questionnaire.max_tokens == 9
+    assert re.fullmatch(questionnaire.guided_decoding.regex, "0, 1, 1")
+    assert not re.fullmatch(questionnaire.guided_decoding.regex, "0, 1")
+    assert profiles.sampling_params(base, "conversation").guided_decoding is None
+
+    profiles.enabled = False
+    assert profiles.sampling_params(base, "judge") is base and not profiles.constrained("judge")
+
+
+def test_profiles_load_overrides(tmp_path):
+    path = tmp_path / "stages.json"
+    path.write_text(json.dumps({"judge": {"max_tokens": 3}, "summary": {"max_tokens": 64}}))
+    profiles = StageProfiles()
+    profiles.load(str(path))
+    assert profiles.get("judge").max_tokens == 3 and profiles.get("judge").regex == "-1|0|1"
+    assert profiles.get("summary").max_tokens == 64
+
+
+def test_mock_outputs_fit_the_profiles():
+    profiles = StageProfiles()
+    judge_params = profiles.sampling_params(MockSamplingParams(), "judge")
+    prompts = [construct_judge_prompt(f"q{i}", "r", "f") for i in range(20)]
+    grades = [output.outputs[0].text for output in MockLLM(seed=0).generate(prompts, judge_params)]
+    assert set(parse_grades(grades, strict=True).tolist()) <= {-1, 0, 1}
+
+
+def test_only_backends_enforcing_the_regex_parse_strictly():
+    profiles = StageProfiles()
+    profiles.guided_decoding = HTTPLLM.supports_guided_decoding
+    judge = profiles.sampling_params(MockSamplingParams(), "judge")
+    # The constraint is still sent along
+    assert judge.guided_decoding is not None and profiles.constrained("judge") and not profiles.strict("judge")
+    profiles.guided_decoding = MockLLM.supports_guided_decoding
+    assert profiles.strict("judge") and not profiles.strict("conversation")
+    router = StageRouter({"mock": MockLLM(seed=0), "http": HTTPLLM("http://localhost:8000", "model")}, {}, "mock")
+    assert not router.supports_guided_decoding
+    router.close()
+
+
+def test_strict_parsing_raises_instead_of_defaulting():
+    assert parse_grades(["1", "oops"]).tolist() == [1, 0]
+    with pytest.raises(ValueError):
+        parse_grades(["1", "oops"], strict=True)
+    assert parse_binary_strings(["0, 1"], 3) == [[-1, -1, -1]]
+    with pytest.raises(ValueError):
+        parse_binary_strings(["0, 1"], 3, strict=True)
@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+from calculate_latent_vec_score import calculate_score, latent_scores_from_matrix
+from database_manager import SimLogger
+from population import Population
+from qeustionnaire_questions import questionnaire_questions
+from surrogate import GRADES, SurrogateJudge, influence, load_training_data, pair_features
+
+
+def test_latent_scores_match_calculate_score():
+    answers = np.random.default_rng(0).integers(0, 2, (20, len(questionnaire_questions)))
+    expected = [calculate_score(questionnaire_questions, row.tolist()) for row in answers]
+    assert latent_scores_from_matrix(questionnaire_questions, answers).tolist() == expected
+
+
+def test_surrogate_fit_recovers_similarity_effect():
+    rng = np.random.default_rng(0)
+    population = Population.sample(2000, seed=0)
+    latent_vec = rng.integers(0, 11, (2000, 4))
+    pairs = rng.permutation(2000).reshape(-1, 2)
+    grades = SurrogateJudge(seed=0).judge(pairs, latent_vec, population).numpy()
+    assert set(grades.tolist()) <= set(GRADES.tolist())
+
+    fitted = SurrogateJudge.fit(pair_features(pairs, latent_vec, population), grades)
+    # More similar pairs should be more likely to agree
+    similar = np.zeros((1, fitted.coefficients.shape[0]), dtype=np.float32)
+    similar[0, 0], similar[0, 1] = 1, 1
+    dissimilar = similar.copy()
+    dissimilar[0, 1] = 0
+    assert fitted.probabilities(similar)[0, 2] > fitted.probabilities(dissimilar)[0, 2]
+
+
+def test_influence_only_moves_agreeing_pairs():
+    answers = np.array([[0, 0], [1, 1], [0, 0], [1, 1]], dtype=np.int8)
+    out = influence(answers.copy(), [(0, 1), (2, 3)], torch.tensor([1, -1]), 1.0, np.random.default_rng(0))
+    assert out[:2].tolist() == [[1, 1], [0, 0]]
+    assert out[2:].tolist() == answers[2:].tolist()
+
+
+def test_load_training_data_from_logs(tmp_path):
+    logger = SimLogger(str(tmp_path))
+    population = Population.sample(4, seed=0)
+    logger.insert_agent_properties_many(population.records())
+    rng = np.random.default_rng(0)
+    answers = rng.integers(0, 2, (4, len(questionnaire_questions))).tolist()
+    logger.insert_agent_logs_many((agent_id, -1, (0, 0), answers[agent_id], [0, 0, 0, 0]) for agent_id in range(4))
+    logger.insert_conversation_logs_many([("a", (0, 1), 0, "q", "", "", 1), ("b", (2, 3), 0, "q", "", "", -1)])
+
+    features, grades = load_training_data(logger.db_path)
+    latent_vec = latent_scores_from_matrix(questionnaire_questions, np.array(answers))
+    assert grades.tolist() == [1, -1]
+    assert np.allclose(features, pair_features([(0, 1), (2, 3)], latent_vec, population))
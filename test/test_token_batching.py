@@ -0,0 +1,21 @@
+import numpy as np
+
+from token_batching import estimate_lengths, generate_in_batches, plan_batches
+
+
+def test_plan_batches_respects_budget():
+    lengths = np.random.default_rng(0).integers(10, 500, 1000)
+    batches = plan_batches(lengths, token_budget=4096, max_new_tokens=64)
+    assert sorted(np.concatenate(batches).tolist()) == list(range(1000))
+    assert all((lengths[batch] + 64).sum() <= 4096 for batch in batches)
+    # A prompt over the budget still gets a submission
+    assert [len(batch) for batch in plan_batches([10, 5000, 10], token_budget=100)] == [1, 2]
+    assert len(plan_batches(lengths, token_budget=None)) == 1
+
+
+def test_generate_in_batches_keeps_prompt_order():
+    prompts = ["x" * n for n in np.random.default_rng(0).integers(1, 400, 300)]
+    batches = plan_batches(estimate_lengths(prompts), token_budget=500)
+    assert len(batches) > 1
+    outputs = generate_in_batches(lambda batch: [len(prompt) for prompt in batch], prompts, batches)
+    assert outputs == [len(prompt) for prompt in prompts]
@@ -0,0 +1,64 @@
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+
+# Rough characters per token of Llama tokenizers on English text, for when no tokenizer is at hand
+CHARS_PER_TOKEN = 4
+
+
+def estimate_lengths(prompts: Sequence[str], tokenizer=None) -> np.ndarray:
+    """Prompt lengths in tokens, approximated from the character count without a tokenizer."""
+    if tokenizer is not None:
+        return np.array([len(ids) for ids in tokenizer(list(prompts), add_special_tokens=False)["input_ids"]],
+                        dtype=np.int64)
+    return np.array([len(prompt) // CHARS_PER_TOKEN + 1 for prompt in prompts], dtype=np.int64)
+
+
+def plan_batches(lengths, token_budget: Optional[int], max_new_tokens=0) -> List[np.ndarray]:
+    """
+    Splits prompts into submissions of at most `token_budget` tokens, counting each prompt's
+    length plus the `max_new_tokens` it may generate. Prompts are sorted by length first so
+    each submission holds prompts of similar length; a prompt larger than the budget gets a
+    submission of its own. Returns the prompt indices of every submission.
+    Without a budget, everything goes in one submission.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    order = np.argsort(-lengths, kind="stable")
+    if token_budget is None or len(lengths) == 0:
+        return [order] if len(lengths) else []
+
+    cost = np.cumsum(lengths[order] + max_new_tokens)
+    batches = []
+    start, spent = 0, 0
+    while start < len(order):
+        # Last prompt that still fits into this submission, but at least one prompt
+        end = max(int(np.searchsorted(cost, spent + token_budget, side="right")), start + 1)
+        batches.append(order[start:end])
+        spent = cost[end - 1]
+        start = end
+    return batches
+
+
+def generate_in_batches(generate: Callable[[List[str]], list], prompts: Sequence[str],
+                        batches: List[np.ndarray]) -> list:
+    """Runs `generate` on every submission and puts the outputs back in prompt order."""
+    outputs = [None] * len(prompts)
+    for batch in batches:
+        for idx, output in zip(batch.tolist(), generate([prompts[i] for i in batch.tolist()])):
+            outputs[idx] = output
+    return outputs
+
+
+def shard_by_load(lengths, num_shards: int, max_new_tokens=0) -> List[np.ndarray]:
+    """
+    Splits prompts into `num_shards` contiguous index ranges of about equal token load
+    (prompt length plus `max_new_tokens`). Contiguous, so prompts that were put in prefix
+    order keep their shared prefixes on the same replica. Shards may be empty.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    cost = np.cumsum(lengths + max_new_tokens)
+    total = int(cost[-1]) if len(cost) else 0
+    # A shard ends after the first prompt whose cumulative load reaches its share
+    bounds = np.searchsorted(cost, total * np.arange(1, num_shards) / num_shards, side="left") + 1
+    bounds = np.minimum(bounds, len(lengths))
+    return np.split(np.arange(len(lengths)), bounds)
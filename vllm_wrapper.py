@@ -1,32 +1,51 @@
+import time
+
 from vllm import LLM, SamplingParams
 
+from token_batching import estimate_lengths, generate_in_batches, plan_batches
+
+
 class BatchedLLM(LLM):
     """
     A subclass of vllm.LLM that overwrites the `generate` method
-    to process multiple prompts in smaller batches.
+    to process multiple prompts in token-budgeted submissions.
     """
+    supports_guided_decoding = True
 
-    def __init__(self, *args, batch_size=8, **kwargs):
+    def __init__(self, *args, batch_size=None, token_budget=None, **kwargs):
         """
         Args:
-            batch_size (int): Maximum number of prompts to process at once.
+            batch_size (int): Maximum number of prompts to process at once. Kept for the old fixed-size
+                chunking; prefer `token_budget`.
+            token_budget (int): Maximum prompt + generated tokens per submission. With neither limit, each
+                call is handed to the engine at once and its scheduler does the batching.
             *args: Passed through to the base LLM class.
             **kwargs: Passed through to the base LLM class.
         """
         super().__init__(*args, **kwargs)
         self.batch_size = batch_size
+        self.token_budget = token_budget
 
-    def generate(self, prompts, sampling_params, testing=False):
+    def prompt_lengths(self, prompts):
+        try:
+            tokenizer = self.get_tokenizer()
+        except Exception:
+            tokenizer = None
+        return estimate_lengths(prompts, tokenizer)
+
+    def generate(self, prompts, sampling_params, testing=False, stage=None, **kwargs):
         """
         Overwrites the default `generate` method to handle lists of prompts in batches.
 
         Args:
             prompts (str or List[str]): The prompt(s) to generate responses for.
             sampling_params (SamplingParams): Sampling parameters.
+            stage (str): Simulation stage the prompts belong to, for wrappers like `CachedLLM`. Unused here.
 
         Returns:
             List[str] or str: A list of generated responses if multiple prompts,
                               or a single response if a single prompt.
+            Responses are in the same order as the prompts.
         """
 
         # If it's just a single prompt (string), call parent directly.
@@ -34,19 +53,54 @@ class BatchedLLM(LLM):
             if testing:  # skip llm invoke
                 return "[TEST_RESPONSE]"
             else:
-                return super().generate(prompts, sampling_params)
-
-        # Otherwise, handle a list of prompts in batches.
-        all_responses = []
-        total_prompts = len(prompts)
+                return super().generate(prompts, sampling_params, **kwargs)
 
         if testing:  # skip llm invoke
             return ["[TEST_RESPONSE]" for _ in prompts]
 
-        for i in range(0, total_prompts, self.batch_size):
-            batch_prompts = prompts[i : i + self.batch_size]
-            # Use the parent class's generate method for each batch
-            batch_responses = super().generate(batch_prompts, sampling_params)
-            all_responses.extend(batch_responses)
+        if self.batch_size is not None:
+            # Old behaviour: fixed-size chunks in prompt order
+            all_responses = []
+            for i in range(0, len(prompts), self.batch_size):
+                all_responses.extend(super().generate(prompts[i: i + self.batch_size], sampling_params, **kwargs))
+            return all_responses
+
+        if self.token_budget is None:
+            return super().generate(prompts, sampling_params, **kwargs)
 
-        return all_responses
\ No newline at end of file
+        # Similar-length prompts share a submission; outputs are put back in prompt order
+        batches = plan_batches(self.prompt_lengths(prompts), self.token_budget, sampling_params.max_tokens or 0)
+        return generate_in_batches(lambda batch: super(BatchedLLM, self).generate(batch, sampling_params, **kwargs),
+                                   prompts, batches)
+
+    def autotune(self, prompts, sampling_params, budgets=(8192, 32768, 131072, None), num_warmup=8):
+        """
+        Times `generate` with each candidate token budget (None = one submission) and keeps the
+        one with the highest throughput. Returns {budget: tokens per second}.
+
+        Each budget runs on its own interleaved share of `prompts`, from an empty prefix cache,
+        so no candidate reuses the KV blocks an earlier one computed. An untimed call on the
+        first `num_warmup` prompts absorbs the engine's start-up cost first.
+        """
+        reset_prefix_cache = getattr(self, "reset_prefix_cache", None)
+        batch_size, self.batch_size = self.batch_size, None
+        self.token_budget = None
+        self.generate(prompts[:num_warmup], sampling_params)
+        throughput = {}
+        for idx, budget in enumerate(budgets):
+            sample = prompts[idx::len(budgets)]
+            if reset_prefix_cache is not None:
+                reset_prefix_cache()
+            self.token_budget = budget
+            start = time.perf_counter()
+            outputs = self.generate(sample, sampling_params)
+            elapsed = time.perf_counter() - start
+            generated = sum(len(completion.token_ids) for output in outputs for completion in output.outputs)
+            throughput[budget] = (int(self.prompt_lengths(sample).sum()) + generated) / elapsed
+            print(f"Token budget {budget}: {throughput[budget]:.0f} tokens/s on {len(sample)} prompts")
+        if reset_prefix_cache is not None:
+            reset_prefix_cache()
+        self.batch_size = batch_size
+        self.token_budget = max(throughput, key=throughput.get)
+        print(f"Using a token budget of {self.token_budget}")
+        return throughput